@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Copyright (c) 2010 HomeAway, Inc.
+All rights reserved.  http://www.homeaway.com
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import sys
+import socket
+import struct
+import xml.etree.ElementTree
+from array import array
+from optparse import OptionParser
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Severity levels, from open ports (0) to critical (4)
+SEVERITIES = 5
+
+# What findings can be grouped by
+KEYS = ('host', 'plugin', 'subnet', 'port')
+
+
+def _aton(address):
+    try:
+        return struct.unpack('!I', socket.inet_aton(address))[0]
+    except (socket.error, TypeError):
+        return None
+
+
+class ReportColumns(object):
+    def __init__(self):
+        """
+        The host, port, plugin ID and severity of every ReportItem of one or more reports, stored as compact
+        columns (one array per field) rather than one object per finding. Host names are stored once and
+        referenced by number. Aggregations run on NumPy arrays when NumPy is installed.
+        """
+        self.names = []  # Host names, indexed by host number
+        self.numbers = {}  # Host name -> host number
+        self.addresses = array('l')  # IPv4 address of each host number as an integer, -1 for names
+        self.host = array('l')
+        self.port = array('l')
+        self.plugin = array('l')
+        self.severity = array('b')
+
+    def __len__(self):
+        return len(self.severity)
+
+    def _hostnumber(self, name, address=None):
+        number = self.numbers.get(name)
+        if number is None:
+            number = self.numbers[name] = len(self.names)
+            self.names.append(name)
+            address = _aton(address or name)
+            self.addresses.append(-1 if address is None else address)
+        return number
+
+    def add(self, host, port, plugin, severity, address=None):
+        """
+        Append a single finding.
+        """
+        self.host.append(self._hostnumber(host, address))
+        self.port.append(port)
+        self.plugin.append(plugin)
+        self.severity.append(severity)
+
+    def load(self, source):
+        """
+        Stream the ReportItems of a .nessus (v2) report into the columns, dropping each host once it is read.
+
+        @type   source: file
+        @param  source: A filename or file object containing the report XML.
+        """
+        host = None
+        parent = None
+        # Columns are appended to straight from the parser loop; these save an attribute lookup per item
+        hosts, ports, plugins, severities = self.host.append, self.port.append, self.plugin.append, self.severity.append
+        for event, elem in xml.etree.ElementTree.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                if elem.tag == 'ReportHost':
+                    host = self._hostnumber(elem.attrib['name'])
+                elif elem.tag == 'Report':
+                    parent = elem
+                continue
+            if elem.tag == 'ReportItem':
+                attrib = elem.attrib
+                hosts(host)
+                ports(int(attrib.get('port', 0)))
+                plugins(int(attrib['pluginID']))
+                severities(int(attrib['severity']))
+                elem.clear()
+            elif elem.tag == 'tag' and elem.attrib.get('name') == 'host-ip' and host is not None:
+                address = _aton(elem.text)
+                if address is not None:
+                    self.addresses[host] = address
+            elif elem.tag == 'ReportHost':
+                elem.clear()
+                if parent is not None:
+                    parent.remove(elem)
+        return self
+
+    @classmethod
+    def from_reports(cls, sources):
+        """
+        Columns holding every finding of several reports.
+        """
+        columns = cls()
+        for source in sources:
+            columns.load(source)
+        return columns
+
+    @classmethod
+    def from_index(cls, index, latest=True):
+        """
+        Columns holding the findings of a Findings.FindingsIndex; with latest, only the most recent report of
+        each scan name.
+        """
+        columns = cls()
+        sql = "SELECT hosts.name, hosts.ip, items.port, items.plugin, items.severity FROM items " \
+              "JOIN hosts ON hosts.id = items.host"
+        if latest:
+            sql += " WHERE items.report IN (SELECT MAX(id) FROM reports GROUP BY name)"
+        for name, address, port, plugin, severity in index.query(sql):
+            columns.add(name, port or 0, plugin, severity, address)
+        return columns
+
+    def keys(self, key, prefix=24):
+        """
+        The column to group by, one value per finding: a host number, plugin ID, port or the network part of the
+        host address (-1 for hosts named rather than addressed).
+
+        @type   key:    string
+        @param  key:    One of KEYS.
+        @type   prefix: number
+        @param  prefix: The prefix length of a subnet.
+        """
+        if key == 'host':
+            return self.host
+        elif key == 'plugin':
+            return self.plugin
+        elif key == 'port':
+            return self.port
+        elif key == 'subnet':
+            shift = 32 - prefix
+            if numpy is not None:
+                addresses = numpy.frombuffer(self.addresses, dtype=numpy.int_)
+                networks = numpy.where(addresses >= 0, addresses >> shift, -1)
+                return networks[numpy.frombuffer(self.host, dtype=numpy.int_)]
+            networks = [address >> shift if address >= 0 else -1 for address in self.addresses]
+            return array('l', (networks[host] for host in self.host))
+        raise ValueError("Unknown key: %s" % key)
+
+    def label(self, key, value, prefix=24):
+        """
+        Turn a value of keys() back into something readable.
+        """
+        if key == 'host':
+            return self.names[value]
+        elif key == 'subnet':
+            if value < 0:
+                return '(named hosts)'
+            return "%s/%d" % (socket.inet_ntoa(struct.pack('!I', int(value) << (32 - prefix))), prefix)
+        return value
+
+
+def severity_by(columns, key, prefix=24):
+    """
+    Count findings of each severity per host, plugin, port or subnet. Returns {label: [count per severity]}.
+
+    @type   columns:    ReportColumns
+    @param  columns:    The findings.
+    @type   key:        string
+    @param  key:        One of KEYS.
+    @type   prefix:     number
+    @param  prefix:     The prefix length of a subnet.
+    """
+    keys = columns.keys(key, prefix)
+    if numpy is not None:
+        values, inverse = numpy.unique(numpy.asarray(keys), return_inverse=True)
+        severity = numpy.frombuffer(columns.severity, dtype=numpy.int8)
+        counts = numpy.bincount(inverse * SEVERITIES + severity, minlength=len(values) * SEVERITIES)
+        counts = counts.reshape(len(values), SEVERITIES)
+        return dict((columns.label(key, value, prefix), row.tolist()) for value, row in zip(values.tolist(), counts))
+    totals = {}
+    for value, severity in zip(keys, columns.severity):
+        row = totals.get(value)
+        if row is None:
+            row = totals[value] = [0] * SEVERITIES
+        row[severity] += 1
+    return dict((columns.label(key, value, prefix), row) for value, row in totals.items())
+
+
+def top(columns, key, n=10, severity=1, prefix=24):
+    """
+    The n hosts, plugins, ports or subnets with the most findings of at least the given severity, as
+    [(label, count)], most first.
+
+    @type   severity:   number
+    @param  severity:   The lowest severity counted; the default leaves out open ports.
+    """
+    keys = columns.keys(key, prefix)
+    if numpy is not None:
+        mask = numpy.frombuffer(columns.severity, dtype=numpy.int8) >= severity
+        values, counts = numpy.unique(numpy.asarray(keys)[mask], return_counts=True)
+        order = numpy.argsort(-counts, kind='mergesort')[:n]
+        return [(columns.label(key, value, prefix), count)
+                for value, count in zip(values[order].tolist(), counts[order].tolist())]
+    counts = {}
+    for value, level in zip(keys, columns.severity):
+        if level >= severity:
+            counts[value] = counts.get(value, 0) + 1
+    ranked = sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:n]
+    return [(columns.label(key, value, prefix), count) for value, count in ranked]
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] report.xml ... | --index findings.sqlite")
+    parser.add_option("--index", help="aggregate the latest reports in a findings index instead of report files")
+    parser.add_option("--by", default='host', help="group by %s (default: host)" % ', '.join(KEYS))
+    parser.add_option("--prefix", type='int', default=24, help="subnet prefix length (default: 24)")
+    parser.add_option("--top", type='int', help="only list the N groups with the most findings")
+    parser.add_option("--severity", type='int', default=1, help="lowest severity counted by --top (default: 1)")
+    (options, args) = parser.parse_args()
+    if options.by not in KEYS:
+        parser.error("--by must be one of %s" % ', '.join(KEYS))
+
+    if options.index is not None:
+        from Findings import FindingsIndex
+        index = FindingsIndex(options.index)
+        try:
+            columns = ReportColumns.from_index(index)
+        finally:
+            index.close()
+    elif args:
+        columns = ReportColumns.from_reports(args)
+    else:
+        parser.error("no reports given")
+
+    if options.top is not None:
+        for label, count in top(columns, options.by, options.top, options.severity, options.prefix):
+            print "%s\t%d" % (label, count)
+    else:
+        for label, row in sorted(severity_by(columns, options.by, options.prefix).items()):
+            print "%s\t%s" % (label, "\t".join(str(count) for count in row))
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: expandtab sw=4 ts=4 ai
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Copyright (c) 2010 HomeAway, Inc.
+All rights reserved.  http://www.homeaway.com
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import os
+import zipfile
+import zlib
+from time import localtime
+
+# Size of the reads used when streaming files into an archive
+CHUNKSIZE = 64 * 1024
+
+
+class ZipMember(object):
+    def __init__(self, archive, arcname, level=zlib.Z_DEFAULT_COMPRESSION, date_time=None):
+        """
+        A file-like object that streams whatever is written to it into a new member of an open ZipFile, so the
+        member never has to fit in memory. Nothing else may be written to the archive until close() is called.
+
+        @type   archive:    zipfile.ZipFile
+        @param  archive:    An archive opened for writing on a regular (seekable) file.
+        @type   arcname:    string
+        @param  arcname:    The name of the member inside the archive.
+        @type   level:      number
+        @param  level:      The zlib compression level, 0 (none) to 9 (best).
+        @type   date_time:  tuple
+        @param  date_time:  The modification time stored for the member (defaults to now).
+        """
+        if date_time is None:
+            date_time = localtime()[0:6]
+        self.archive = archive
+        self.info = zipfile.ZipInfo(arcname, date_time)
+        self.info.external_attr = 0644 << 16L
+        self.info.compress_type = archive.compression
+        self.info.flag_bits = 0x00
+        self.info.header_offset = archive.fp.tell()
+        self.info.CRC = 0
+        self.info.file_size = 0
+        self.info.compress_size = 0
+        # The final size is not known up front, so always leave room for the ZIP64 sizes in the header
+        self.zip64 = archive._allowZip64
+
+        self.compressor = None
+        if self.info.compress_type == zipfile.ZIP_DEFLATED:
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        archive.fp.write(self.info.FileHeader(self.zip64))
+        self.closed = False
+
+    def write(self, data):
+        """
+        @type   data:   string
+        @param  data:   The next chunk of the member's contents.
+        """
+        self.info.file_size += len(data)
+        self.info.CRC = zipfile.crc32(data, self.info.CRC) & 0xffffffff
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.info.compress_size += len(data)
+        self.archive.fp.write(data)
+
+    def close(self):
+        """
+        Finish the member: flush the compressor, rewrite the local header with the final sizes and CRC, and
+        register the member with the archive.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self.compressor is not None:
+            data = self.compressor.flush()
+            self.info.compress_size += len(data)
+            self.archive.fp.write(data)
+
+        if not self.zip64 and max(self.info.file_size, self.info.compress_size) > zipfile.ZIP64_LIMIT:
+            raise zipfile.LargeZipFile("Filesize would require ZIP64 extensions")
+        position = self.archive.fp.tell()
+        self.archive.fp.seek(self.info.header_offset, 0)
+        self.archive.fp.write(self.info.FileHeader(self.zip64))
+        self.archive.fp.seek(position, 0)
+        self.archive.filelist.append(self.info)
+        self.archive.NameToInfo[self.info.filename] = self.info
+        self.archive._didModify = True
+
+
+def zipfile_write(archive, path, arcname=None, level=zlib.Z_DEFAULT_COMPRESSION):
+    """
+    Like ZipFile.write(), but with a choice of compression level. The file is streamed in chunks.
+
+    @type   archive:    zipfile.ZipFile
+    @param  archive:    An archive opened for writing on a regular (seekable) file.
+    @type   path:       string
+    @param  path:       The file to add.
+    @type   arcname:    string
+    @param  arcname:    The name of the member inside the archive (defaults to the file's base name).
+    @type   level:      number
+    @param  level:      The zlib compression level, 0 (none) to 9 (best).
+    """
+    if arcname is None:
+        arcname = os.path.basename(path)
+    member = ZipMember(archive, arcname, level, localtime(os.stat(path).st_mtime)[0:6])
+    source = open(path, "rb")
+    try:
+        while True:
+            chunk = source.read(CHUNKSIZE)
+            if not chunk:
+                break
+            member.write(chunk)
+    finally:
+        source.close()
+    member.close()
+
+
+# vim: expandtab sw=4 ts=4 ai
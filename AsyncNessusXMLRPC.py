@@ -0,0 +1,599 @@
+#!/usr/bin/python
+# coding=utf-8
+
+"""
+Copyright (c) 2010 HomeAway, Inc.
+All rights reserved.  http://www.homeaway.com
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncore
+import socket
+import ssl
+import sys
+from collections import deque
+from time import time
+from urllib import urlencode
+from random import randint
+
+from NessusXMLRPC import ScannerBase, PolicyIndex, RequestError, LoginError, ScanError, SEQMIN, SEQMAX
+
+from Logger import get_logger
+
+
+class AsyncResult(object):
+    def __init__(self, map=None):
+        """
+        The eventual outcome of an AsyncScanner call. Callbacks run from inside the event loop once the value
+        (or the exception) is known.
+
+        @type   map:    dict
+        @param  map:    The asyncore socket map driving the request; wait() runs this map.
+        """
+        self.map = map
+        self.done = False
+        self.value = None
+        self.exc_info = None
+        self.callbacks = []
+
+    def add_callback(self, callback, errback=None):
+        """
+        @type   callback:   function
+        @param  callback:   Called with the value on success.
+        @type   errback:    function
+        @param  errback:    Called with the exception on failure (optional).
+        """
+        if self.done:
+            self._run(callback, errback)
+        else:
+            self.callbacks.append((callback, errback))
+        return self
+
+    def then(self, func):
+        """
+        Chain func onto this result and return a new AsyncResult for its outcome. func may return a plain value
+        or another AsyncResult.
+
+        @type   func:   function
+        @param  func:   Called with the value of this result on success.
+        """
+        chained = AsyncResult(self.map)
+
+        def _callback(value):
+            try:
+                value = func(value)
+            except Exception:
+                chained.set_exception(sys.exc_info())
+                return
+            if isinstance(value, AsyncResult):
+                value.add_callback(chained.set_result, chained.set_exception)
+            else:
+                chained.set_result(value)
+
+        self.add_callback(_callback, chained.set_exception)
+        return chained
+
+    def set_result(self, value):
+        self.value = value
+        self._finish()
+
+    def set_exception(self, exc_info):
+        """
+        @type   exc_info:   tuple
+        @param  exc_info:   The sys.exc_info() of the failure.
+        """
+        self.exc_info = exc_info
+        self._finish()
+
+    def _finish(self):
+        self.done = True
+        callbacks = self.callbacks
+        self.callbacks = []
+        for callback, errback in callbacks:
+            self._run(callback, errback)
+
+    def _run(self, callback, errback):
+        if self.exc_info is None:
+            callback(self.value)
+        elif errback is not None:
+            errback(self.exc_info)
+
+    def result(self):
+        """
+        Return the value, re-raising the exception if the call failed.
+        """
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+    def wait(self, timeout=None):
+        """
+        Run the event loop until this result is known, then return it like result().
+
+        @type   timeout:    number
+        @param  timeout:    Give up (raising RequestError) after this many seconds (optional).
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time() + timeout
+        while not self.done:
+            if deadline is not None and time() > deadline:
+                raise RequestError("Timed out waiting for result", timeout)
+            poll(self.map)
+        return self.result()
+
+
+class _HTTPSRequest(asyncore.dispatcher):
+    def __init__(self, scanner, method, target, params, headers, result):
+        """
+        A single request over its own non-blocking TLS connection, driven by the asyncore loop. The request is
+        sent as HTTP/1.0 so the reply is simply everything read up to the server closing the connection.
+        """
+        asyncore.dispatcher.__init__(self, map=scanner.map)
+        self.scanner = scanner
+        self.target = target
+        self.result = result
+        self.deadline = time() + scanner.timeout
+        self.handshaking = True
+        self.want_write = True
+        self.received = []
+        self.size = 0  # Bytes of the reply received so far
+        self.length = None  # Total size of the reply, once known
+
+        lines = ["%s %s HTTP/1.0" % (method, target), "Host: %s:%s" % (scanner.host, scanner.port),
+                 "Content-Length: %d" % len(params)]
+        for (name, value) in headers.items():
+            lines.append("%s: %s" % (name, value))
+        self.outgoing = "\r\n".join(lines) + "\r\n\r\n" + params
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect((scanner.host, scanner.port))
+
+    def handle_connect(self):
+        self.socket = self.scanner.context.wrap_socket(self.socket, do_handshake_on_connect=False,
+                                                       server_hostname=self.scanner.host)
+        self._handshake()
+
+    def _handshake(self):
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLError as err:
+            if err.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self.want_write = False
+                return
+            if err.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self.want_write = True
+                return
+            raise
+        self.handshaking = False
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        if not self.connected or self.handshaking:
+            return self.want_write
+        return len(self.outgoing) > 0
+
+    def handle_write(self):
+        if self.handshaking:
+            self._handshake()
+            return
+        try:
+            sent = self.socket.send(self.outgoing)
+        except ssl.SSLError as err:
+            if err.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                return
+            raise
+        self.outgoing = self.outgoing[sent:]
+
+    def handle_read(self):
+        if self.handshaking:
+            if self.connected and isinstance(self.socket, ssl.SSLSocket):
+                self._handshake()
+            return
+        try:
+            data = self.socket.recv(65536)
+            while data and self.socket.pending():
+                self._append(data)
+                data = self.socket.recv(self.socket.pending())
+        except ssl.SSLError as err:
+            if err.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                return
+            if not self.received:
+                raise
+            # Servers often drop the connection without a TLS close_notify; treat it as the end of the reply
+            data = ''
+        if data:
+            self._append(data)
+            if self.length is not None and 0 < self.length <= self.size:
+                self._finish()
+        else:
+            self._eof()
+
+    def _append(self, data):
+        self.received.append(data)
+        self.size += len(data)
+        if self.length is None:
+            self._read_length()
+
+    def _read_length(self):
+        """
+        Work out the total size of the reply from its Content-Length header, once the headers are in.
+        """
+        response = "".join(self.received)
+        self.received = [response]
+        end = response.find("\r\n\r\n")
+        if end < 0:
+            return
+        for line in response[:end].split("\r\n")[1:]:
+            name, sep, value = line.partition(":")
+            if name.strip().lower() == "content-length":
+                try:
+                    self.length = end + 4 + int(value.strip())
+                except ValueError:
+                    pass
+                return
+        self.length = -1  # Read until the server closes the connection
+
+    def handle_close(self):
+        self._eof()
+
+    def _eof(self):
+        """
+        The server closed the connection: that ends the reply, unless it came before all of its Content-Length.
+        """
+        if self.length is not None and self.size >= self.length:
+            self._finish()
+            return
+        self.close()
+        if not self.result.done:
+            self.scanner._release(self)
+            try:
+                raise RequestError("Connection closed after %d bytes of the reply to:" % self.size, self.target)
+            except RequestError:
+                self.result.set_exception(sys.exc_info())
+
+    def handle_error(self):
+        self.close()
+        if not self.result.done:
+            self.scanner._release(self)
+            self.result.set_exception(sys.exc_info())
+
+    def expire(self):
+        """
+        Abort the request once its deadline has passed.
+        """
+        self.close()
+        if not self.result.done:
+            self.scanner._release(self)
+            try:
+                raise socket.timeout("Request to %s timed out" % self.target)
+            except socket.timeout:
+                self.result.set_exception(sys.exc_info())
+
+    def _finish(self):
+        self.close()
+        if self.result.done:
+            return
+        self.scanner._release(self)
+        response = "".join(self.received)
+        head, sep, body = response.partition("\r\n\r\n")
+        try:
+            status = int(head.split(None, 2)[1])
+        except (IndexError, ValueError):
+            try:
+                raise RequestError("Malformed response to request:", self.target)
+            except RequestError:
+                self.result.set_exception(sys.exc_info())
+            return
+        self.result.set_result((status, body))
+
+
+def poll(map=None, timeout=1.0):
+    """
+    Run one pass of the event loop over map, expiring requests that passed their deadline.
+
+    @type   map:        dict
+    @param  map:        The asyncore socket map (defaults to the global one).
+    @type   timeout:    number
+    @param  timeout:    The longest time to block waiting for socket activity.
+    """
+    if map is None:
+        map = asyncore.socket_map
+    if map:
+        asyncore.loop(timeout=timeout, map=map, count=1)
+    now = time()
+    for dispatcher in map.values():
+        if isinstance(dispatcher, _HTTPSRequest) and dispatcher.deadline < now:
+            dispatcher.expire()
+
+
+def loop(map=None, timeout=1.0):
+    """
+    Run the event loop until every request on map has finished.
+
+    @type   map:        dict
+    @param  map:        The asyncore socket map (defaults to the global one).
+    @type   timeout:    number
+    @param  timeout:    The longest time to block waiting for socket activity in each pass.
+    """
+    if map is None:
+        map = asyncore.socket_map
+    while map:
+        poll(map, timeout)
+
+
+class AsyncScanner(ScannerBase):
+    def __init__(self, host, port, login=None, password=None, timeout=60, debug=False, limit=8, map=None,
+                 context=None, policy_ttl=300):
+        """
+        Initialize a non-blocking scanner. Nothing is sent until the first call; call login() (and wait on it)
+        before anything else when credentials are provided. Every API call returns an AsyncResult.
+
+        Many AsyncScanners can share one socket map so a single process keeps requests to a whole fleet of
+        Nessus servers in flight at once.
+
+        @type   host:       string
+        @param  host:       The hostname of the running Nessus server.
+        @type   port:       number
+        @param  port:       The port number for the XMLRPC interface on the Nessus server.
+        @type   login:      string
+        @param  login:      The username for logging in to Nessus.
+        @type   password:   string
+        @param  password:   The password for logging in to Nessus.
+        @type   timeout:    number
+        @param  timeout:    Seconds allowed for each request.
+        @type   debug:      bool
+        @param  debug:      turn on debugging.
+        @type   limit:      number
+        @param  limit:      The most requests in flight to this server at once; the rest are queued.
+        @type   map:        dict
+        @param  map:        The asyncore socket map to run requests on (defaults to the global one).
+        @type   context:    ssl.SSLContext
+        @param  context:    The SSL context used for connections (defaults to ssl.create_default_context()).
+        @type   policy_ttl: number
+        @param  policy_ttl: Seconds quickScan() trusts its index of policy names before listing policies again.
+        """
+        self.token = None
+        self.isadmin = None
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.debug = debug
+        self.limit = max(1, limit)
+        self.logger = get_logger('AsyncScanner')
+        self.headers = {"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain"}
+        if map is None:
+            map = asyncore.socket_map
+        self.map = map
+        if context is None:
+            context = ssl.create_default_context()
+        self.context = context
+        self.active = 0  # Requests currently on the wire
+        self.queued = deque()  # Requests waiting for a free slot
+        self.relogin = None  # The login in progress after a 403, shared by every request that hit it
+        self.policies = PolicyIndex(policy_ttl)
+
+        self.username = login
+        self.password = password
+
+    def _send(self, method, target, params):
+        """
+        Internal method returning an AsyncResult for the (status, body) of a request, queueing it while the
+        server is at its limit.
+        """
+        result = AsyncResult(self.map)
+        request = (method, target, params, result)
+        if self.active < self.limit:
+            self._start(request)
+        else:
+            self.queued.append(request)
+        return result
+
+    def _start(self, request):
+        method, target, params, result = request
+        self.active += 1
+        if self.debug is True:
+            self.logger.debug("Sending request: %s %s" % (method, target))
+            self.logger.debug("Params: %s" % params)
+        try:
+            _HTTPSRequest(self, method, target, params, dict(self.headers), result)
+        except Exception:
+            self.active -= 1
+            result.set_exception(sys.exc_info())
+
+    def _release(self, dispatcher):
+        """
+        Free the slot held by a finished request and start the next queued one.
+        """
+        self.active -= 1
+        if self.queued and self.active < self.limit:
+            self._start(self.queued.popleft())
+
+    def _request(self, method, target, params, relogin=True):
+        """
+        Internal method returning an AsyncResult for the body of a request. A 403 triggers one login (shared by
+        every request that hit it) and a single retry, like Scanner._request.
+
+        @type   method:     string
+        @param  method:     The HTTP verb/method used in the request (almost always POST).
+        @type   target:     string
+        @param  target:     The target path (or function) of the request.
+        @type   params:     string
+        @param  params:     The URL encoded parameters used in the request.
+        @type   relogin:    bool
+        @param  relogin:    Whether a 403 should log in again and retry.
+        """
+        cookie = self.headers.get("Cookie")
+
+        def _response(response):
+            status, body = response
+            if self.debug is True:
+                self.logger.debug("Response: %s" % status)
+                self.logger.debug(body)
+            if status == 200:
+                return body
+            if status == 403:
+                if not relogin or self.username is None or self.password is None:
+                    raise LoginError("Login credentials needed to access: ", target)
+                if cookie != self.headers.get("Cookie"):
+                    # Someone else has logged in again since this request went out
+                    return self._request(method, target, params, relogin=False)
+                return self._login_once().then(lambda ok: self._request(method, target, params, relogin=False))
+            raise RequestError("Error sending request:", (target, status))
+
+        return self._send(method, target, params).then(_response)
+
+    def _login_once(self):
+        """
+        Log in again, sharing a single login between all requests that need one at the same time.
+        """
+        relogin = self.relogin
+        if relogin is None:
+            relogin = self.relogin = self.login()
+
+            def _clear(value):
+                self.relogin = None
+            relogin.add_callback(_clear, _clear)
+        return relogin
+
+    def login(self, seq=randint(SEQMIN, SEQMAX)):
+        """
+        Log in to the Nessus server and preserve the token value for subsequent requests.
+        Resolves to True for successful login, False when credentials weren't set; login failure raises LoginError.
+
+        @type   seq:        number
+        @param  seq:        A sequence number that will be echoed back for unique identification (optional).
+        """
+        if self.username is None or self.password is None:
+            result = AsyncResult(self.map)
+            result.set_result(False)
+            return result
+
+        params = urlencode({'login': self.username, 'password': self.password, 'seq': seq})
+        return self._request("POST", "/login", params, relogin=False).then(
+            lambda response: self._handle_login(self.parse(response)))
+
+    def logout(self, seq=randint(SEQMIN, SEQMAX)):
+        """
+        Log out of the Nessus server, invalidating the current token value.
+
+        @type   seq:        number
+        @param  seq:        A sequence number that will be echoed back for unique identification (optional).
+        """
+        params = urlencode({'seq': seq})
+        return self._request("POST", "/logout", params).then(
+            lambda response: self._handle_logout(self.parse(response)))
+
+    def policyList(self, seq=randint(SEQMIN, SEQMAX)):
+        """
+        List the current policies configured on the server.
+
+        @type   seq:        number
+        @param  seq:        A sequence number that will be echoed back for unique identification (optional).
+        """
+        params = urlencode({'seq': seq})
+        return self._request("POST", "/policy/list", params).then(
+            lambda response: self._handle_policyList(self.parse(response)))
+
+    def getErrors(self, scan, seq=randint(SEQMIN, SEQMAX)):
+        """
+        @type   scan:       dict
+        @param  scan:       The scan (as returned by scanNew()) to collect errors for.
+        @type   seq:        number
+        @param  seq:        A sequence number that will be echoed back for unique identification (optional).
+        """
+        params = urlencode({'report': scan['uuid'], 'seq': seq})
+        return self._request("POST", "/report/errors", params).then(
+            lambda response: self._handle_getErrors(self.parse(response), scan))
+
+    def scanNew(self, scan_name, target, policy_id, seq=randint(SEQMIN, SEQMAX)):
+        """
+        Start up a new scan on the Nessus server immediately.
+
+        @type   scan_name:  string
+        @param  scan_name:  The desired name of the scan.
+        @type   target:     string
+        @param  target:     A Nessus-compatible target string (comma separation, CIDR notation, etc.)
+        @type   policy_id:  number
+        @param  policy_id:  The unique ID of the policy to be used in the scan.
+        @type   seq:        number
+        @param  seq:        A sequence number that will be echoed back for unique identification (optional).
+        """
+        params = urlencode({'target': target, 'policy_id': policy_id, 'scan_name': scan_name, 'seq': seq})
+        return self._request("POST", "/scan/new", params).then(
+            lambda response: self._handle_scanNew(self.parse(response)))
+
+    def quickScan(self, scan_name, target, policy_name, seq=randint(SEQMIN, SEQMAX)):
+        """
+        Look up a policy by name and start a scan with it immediately.
+
+        @type   scan_name:   string
+        @param  scan_name:   The desired name of the scan.
+        @type   target:      string
+        @param  target:      A Nessus-compatible target string (comma separation, CIDR notation, etc.)
+        @type   policy_name: string
+        @param  policy_name: The name of the policy to be used in the scan.
+        @type   seq:         number
+        @param  seq:         A sequence number that will be echoed back for unique identification (optional).
+        """
+        policy_id = self.policies.get(policy_name)
+        if policy_id is None:
+            return self.policyList().then(lambda policies: self.scanNew(
+                scan_name, target, self._policy_id(policies, scan_name, target, policy_name), seq=seq))
+
+        result = AsyncResult(self.map)
+
+        def _refused(exc_info):
+            if not issubclass(exc_info[0], ScanError):
+                result.set_exception(exc_info)
+                return
+
+            # The policy may have been recreated under a new ID since the index was refreshed; try once more
+            def _retry(policies):
+                fresh = self._policy_id(policies, scan_name, target, policy_name)
+                if fresh == policy_id:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                return self.scanNew(scan_name, target, fresh, seq=seq)
+            self.policies.invalidate()
+            self.policyList().then(_retry).add_callback(result.set_result, result.set_exception)
+
+        self.scanNew(scan_name, target, policy_id, seq=seq).add_callback(result.set_result, _refused)
+        return result
+
+    def reportList(self, seq=randint(SEQMIN, SEQMAX)):
+        """
+        Generate a list of reports available on the Nessus server.
+
+        @type   seq:        number
+        @param  seq:        A sequence number that will be echoed back for unique identification (optional).
+        """
+        params = urlencode({'seq': seq})
+        return self._request("POST", "/report/list", params).then(
+            lambda response: self._handle_reportList(self.parse(response)))
+
+    def reportDownload(self, report, version="v2"):
+        """
+        Download a report (XML) for a completed scan.
+
+        @type   report:     string
+        @param  report:     The UUID of the report or completed scan.
+        @type   version:    string
+        @param  version:    The version of the .nessus XML file you wish to download.
+        """
+        return self._request("POST", "/file/report/download", self._download_params(report, version))
+
+
+# vim: expandtab sw=4 ts=4 ai
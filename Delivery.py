@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Copyright (c) 2010 HomeAway, Inc.
+All rights reserved.  http://www.homeaway.com
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import os
+import smtplib
+import threading
+from base64 import encodestring
+from email.header import Header
+from email.mime.text import MIMEText
+from email.utils import formatdate, make_msgid
+from uuid import uuid4
+
+import chardet
+
+from Logger import get_logger
+
+# Attachments are read in multiples of 57 bytes, which base64 encodes to whole 76 character lines
+ENCODE_CHUNK = 57 * 1024
+
+
+def encode_body(body):
+    """
+    Return the body as a byte string along with its charset. ASCII and UTF-8 are recognised directly; chardet
+    is only consulted for anything else.
+
+    @type   body:   string
+    @param  body:   The text of the message.
+    """
+    if isinstance(body, unicode):
+        return body.encode('utf-8'), 'utf-8'
+    for charset in ('us-ascii', 'utf-8'):
+        try:
+            body.decode(charset)
+            return body, charset
+        except UnicodeDecodeError:
+            pass
+    return body, chardet.detect(body)['encoding'] or 'utf-8'
+
+
+class Mailer(object):
+    def __init__(self, server, port, emailfrom, emailto):
+        """
+        Sends report emails, keeping one SMTP session open for a whole batch of messages. Attachments are
+        base64 encoded and sent in chunks, so they are never held in memory as a whole.
+
+        @type   server:     string
+        @param  server:     The SMTP server.
+        @type   port:       number
+        @param  port:       The SMTP port.
+        @type   emailfrom:  string
+        @param  emailfrom:  The sender address.
+        @type   emailto:    string
+        @param  emailto:    The recipient address(es), comma separated.
+        """
+        self.server = server
+        self.port = port
+        self.emailfrom = emailfrom
+        self.emailto = emailto
+        self.recipients = [address.strip() for address in emailto.split(',') if address.strip()]
+        self.connection = None
+        self.lock = threading.Lock()
+        self.logger = get_logger('Mailer')
+        self.sent = 0  # Messages sent
+        self.sessions = 0  # SMTP sessions opened
+
+    def _connect(self):
+        if self.connection is None:
+            self.connection = smtplib.SMTP(self.server, self.port)
+            self.sessions += 1
+        return self.connection
+
+    def _drop(self):
+        # Callers hold the lock
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+            self.connection = None
+
+    def close(self):
+        """
+        End the SMTP session, if one is open.
+        """
+        with self.lock:
+            if self.connection is not None:
+                try:
+                    self.connection.quit()
+                except smtplib.SMTPException:
+                    self.connection.close()
+                except Exception:
+                    pass
+                self.connection = None
+
+    def send(self, subject, body, attachments=()):
+        """
+        Send one message over the current session, opening a new session if there is none or the server has
+        dropped it. Any failure ends the session, as it may have left a transaction open, or even half of a
+        message in DATA, that the next message would otherwise end up in.
+
+        @type   subject:        string
+        @param  subject:        The subject of the email message.
+        @type   body:           string
+        @param  body:           The body of the email message.
+        @type   attachments:    list
+        @param  attachments:    (path, apptype) pairs of files to attach, e.g. ('report.zip', 'zip').
+        """
+        with self.lock:
+            try:
+                try:
+                    self._send(self._connect(), subject, body, attachments)
+                except smtplib.SMTPServerDisconnected:
+                    # The session went stale between messages; try once more on a fresh one
+                    self.connection = None
+                    self._send(self._connect(), subject, body, attachments)
+            except Exception:
+                self._drop()
+                raise
+            self.sent += 1
+
+    def _send(self, connection, subject, body, attachments):
+        # Fail on an unreadable attachment before the server is told a message is coming
+        for path, apptype in attachments:
+            open(path, 'rb').close()
+        connection.ehlo_or_helo_if_needed()
+        code, response = connection.mail(self.emailfrom)
+        if code != 250:
+            raise smtplib.SMTPSenderRefused(code, response, self.emailfrom)
+        refused = {}
+        for recipient in self.recipients:
+            code, response = connection.rcpt(recipient)
+            if code not in (250, 251):
+                refused[recipient] = (code, response)
+        if len(refused) == len(self.recipients):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        if refused:
+            self.logger.warning("Recipients refused: %s" % ", ".join(sorted(refused)))
+        code, response = connection.docmd("data")
+        if code != 354:
+            raise smtplib.SMTPDataError(code, response)
+        for chunk in self._message(subject, body, attachments):
+            connection.send(smtplib.quotedata(chunk))
+        connection.send(".\r\n")
+        code, response = connection.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, response)
+
+    def _message(self, subject, body, attachments):
+        """
+        Generate the message as a sequence of chunks made of whole lines.
+        """
+        boundary = "===============%s==" % uuid4().hex
+        yield ("From: %s\r\nTo: %s\r\nSubject: %s\r\nDate: %s\r\nMessage-ID: %s\r\nMIME-Version: 1.0\r\n"
+               "Content-Type: multipart/mixed; boundary=\"%s\"\r\n\r\n" % (
+                   self.emailfrom, self.emailto, Header(subject, 'utf-8').encode(), formatdate(localtime=True),
+                   make_msgid(), boundary))
+
+        body, charset = encode_body(body)
+        yield "--%s\r\n%s\r\n" % (boundary, MIMEText(body, _charset=charset).as_string())
+
+        for path, apptype in attachments:
+            filename = Header(os.path.basename(path), charset='utf-8').encode()
+            yield ("--%s\r\nContent-Type: application/%s\r\nMIME-Version: 1.0\r\n"
+                   "Content-Transfer-Encoding: base64\r\n"
+                   "Content-Disposition: attachment; filename=\"%s\"\r\n\r\n" % (boundary, apptype, filename))
+            source = open(path, 'rb')
+            try:
+                while True:
+                    chunk = source.read(ENCODE_CHUNK)
+                    if not chunk:
+                        break
+                    yield encodestring(chunk)
+            finally:
+                source.close()
+        yield "--%s--\r\n" % boundary
+
+
+# vim: expandtab sw=4 ts=4 ai
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Copyright (c) 2010 HomeAway, Inc.
+All rights reserved.  http://www.homeaway.com
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+# How each severity level is shown
+SEVERITY_NAMES = {4: 'Critical', 3: 'High', 2: 'Medium', 1: 'Low', 0: 'Open Port'}
+
+
+def report_items(source):
+    """
+    Stream the ReportItems of a .nessus (v2) report as (host, port, pluginID, attributes) tuples, dropping every
+    host from the tree once it is read.
+
+    @type   source: file
+    @param  source: A filename or file object containing the report XML.
+    """
+    host = None
+    parent = None
+    for event, elem in ElementTree.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if elem.tag == 'ReportHost':
+                host = elem.attrib['name']
+            elif elem.tag == 'Report':
+                parent = elem
+            continue
+        if elem.tag == 'ReportItem':
+            attrib = dict(elem.attrib)
+            elem.clear()
+            yield host, int(attrib.get('port', 0)), int(attrib['pluginID']), attrib
+        elif elem.tag == 'ReportHost':
+            elem.clear()
+            if parent is not None:
+                parent.remove(elem)
+
+
+class Delta(object):
+    def __init__(self, limit=50):
+        """
+        What changed between two reports: findings that are new, fixed or unchanged, counted per severity. Only
+        the first limit new and fixed findings are kept in detail.
+        """
+        self.limit = limit
+        self.new = []  # (host, port, pluginID, severity, pluginName)
+        self.fixed = []
+        self.newcount = dict((level, 0) for level in SEVERITY_NAMES)
+        self.fixedcount = dict((level, 0) for level in SEVERITY_NAMES)
+        self.unchanged = 0
+
+    def _add(self, findings, counts, host, port, plugin, attrib):
+        severity = int(attrib['severity'])
+        counts[severity] = counts.get(severity, 0) + 1
+        if len(findings) < self.limit:
+            findings.append((host, port, plugin, severity, attrib.get('pluginName', '')))
+
+    def format(self, severity=1):
+        """
+        A plain text summary of the changes, listing new and fixed findings of at least the given severity.
+        """
+        def totals(counts):
+            total = sum(counts.values())
+            parts = ["%s %d" % (SEVERITY_NAMES[level], counts[level]) for level in sorted(counts, reverse=True)
+                     if counts[level] and level >= severity]
+            return "%5d%s" % (total, " (%s)" % ", ".join(parts) if parts else "")
+
+        lines = ["Changes since the previous report", '-' * 36,
+                 "%-10s %s" % ("New:", totals(self.newcount)),
+                 "%-10s %s" % ("Fixed:", totals(self.fixedcount)),
+                 "%-10s %5d" % ("Unchanged:", self.unchanged)]
+        for title, findings, counts in (("New findings", self.new, self.newcount),
+                                        ("Fixed findings", self.fixed, self.fixedcount)):
+            shown = [finding for finding in findings if finding[3] >= severity]
+            if not shown:
+                continue
+            lines.extend(["", "%s:" % title])
+            for host, port, plugin, level, name in sorted(shown, key=lambda finding: (-finding[3], finding[0])):
+                lines.append("  %-21s [%s] %s (%d)" % ("%s:%d" % (host, port), SEVERITY_NAMES.get(level, level),
+                                                       name, plugin))
+            more = sum(count for level, count in counts.items() if level >= severity) - len(shown)
+            if more > 0:
+                lines.append("  ... and %d more" % more)
+        return "\n".join(lines)
+
+
+def diff(old, new, limit=50):
+    """
+    Compare two reports of the same scan, keying every finding on (host, port, pluginID). Both reports are
+    streamed, the old one twice; only the hashed keys of their findings are held in memory.
+
+    @type   old:    string
+    @param  old:    Path of the previous report.
+    @type   new:    string
+    @param  new:    Path of the current report.
+    @type   limit:  number
+    @param  limit:  The most new and fixed findings kept in detail.
+    """
+    delta = Delta(limit)
+    before = set(hash((host, port, plugin)) for host, port, plugin, attrib in report_items(old))
+
+    after = set()
+    for host, port, plugin, attrib in report_items(new):
+        key = hash((host, port, plugin))
+        if key in after:
+            continue
+        after.add(key)
+        if key in before:
+            delta.unchanged += 1
+        else:
+            delta._add(delta.new, delta.newcount, host, port, plugin, attrib)
+
+    fixed = before - after
+    del before, after
+    if fixed:
+        for host, port, plugin, attrib in report_items(old):
+            key = hash((host, port, plugin))
+            if key in fixed:
+                fixed.discard(key)
+                delta._add(delta.fixed, delta.fixedcount, host, port, plugin, attrib)
+    return delta
+
+
+# vim: expandtab sw=4 ts=4 ai
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Copyright (c) 2010 HomeAway, Inc.
+All rights reserved.  http://www.homeaway.com
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import os
+import sys
+import sqlite3
+import threading
+import xml.etree.ElementTree
+from optparse import OptionParser
+from time import time
+
+# Rows written per executemany() while ingesting
+BATCHSIZE = 5000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reports (
+    id INTEGER PRIMARY KEY,
+    uuid TEXT UNIQUE NOT NULL,
+    name TEXT,
+    policy TEXT,
+    target TEXT,
+    ingested REAL
+);
+CREATE TABLE IF NOT EXISTS hosts (
+    id INTEGER PRIMARY KEY,
+    report INTEGER NOT NULL REFERENCES reports(id),
+    name TEXT NOT NULL,
+    ip TEXT
+);
+CREATE TABLE IF NOT EXISTS plugins (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    family TEXT
+);
+CREATE TABLE IF NOT EXISTS items (
+    report INTEGER NOT NULL REFERENCES reports(id),
+    host INTEGER NOT NULL REFERENCES hosts(id),
+    port INTEGER,
+    protocol TEXT,
+    service TEXT,
+    plugin INTEGER NOT NULL,
+    severity INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS hosts_name ON hosts(name);
+CREATE INDEX IF NOT EXISTS hosts_report ON hosts(report);
+CREATE INDEX IF NOT EXISTS items_plugin ON items(plugin);
+CREATE INDEX IF NOT EXISTS items_report ON items(report, severity);
+CREATE INDEX IF NOT EXISTS items_host ON items(host);
+CREATE INDEX IF NOT EXISTS reports_name ON reports(name, ingested);
+"""
+
+
+class FindingsIndex(object):
+    def __init__(self, path):
+        """
+        An SQLite index of the hosts, findings and plugins of every report fed to it, so questions across reports
+        are answered with a query instead of parsing the .nessus files again. Safe to share between threads.
+
+        @type   path:   string
+        @param  path:   The database file; created with its schema when missing.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+
+    def ingested(self, uuid):
+        """
+        Whether the report with this uuid is already in the index.
+        """
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM reports WHERE uuid = ?", (uuid, )).fetchone() is not None
+
+    def ingest(self, source, uuid, name=None):
+        """
+        Stream a .nessus (v2) report into the index, writing findings in batches. A report already ingested under
+        the same uuid is skipped. Returns the number of findings added.
+
+        @type   source: file
+        @param  source: A filename or file object containing the report XML.
+        @type   uuid:   string
+        @param  uuid:   The uuid of the report, or anything else identifying it for good.
+        @type   name:   string
+        @param  name:   The name to file the report under; defaults to the name in the report.
+        """
+        with self.lock:
+            if self.db.execute("SELECT 1 FROM reports WHERE uuid = ?", (uuid, )).fetchone() is not None:
+                return 0
+            try:
+                count = self._ingest(source, uuid, name)
+            except Exception:
+                self.db.rollback()
+                raise
+            self.db.commit()
+            return count
+
+    def _ingest(self, source, uuid, name):
+        cursor = self.db.cursor()
+        cursor.execute("INSERT INTO reports (uuid, name, ingested) VALUES (?, ?, ?)", (uuid, name, time()))
+        report = cursor.lastrowid
+        items = []
+        plugins = {}
+        count = 0
+        policy = None
+        target = None
+        host = None
+        parent = None
+        for event, elem in xml.etree.ElementTree.iterparse(source, events=('start', 'end')):
+            tag = elem.tag
+            if event == 'start':
+                if tag == 'Report':
+                    if name is None:
+                        name = elem.attrib.get('name')
+                    parent = elem
+                elif tag == 'ReportHost':
+                    cursor.execute("INSERT INTO hosts (report, name) VALUES (?, ?)", (report, elem.attrib['name']))
+                    host = cursor.lastrowid
+                continue
+
+            if tag == 'ReportItem':
+                attrib = elem.attrib
+                plugin = int(attrib['pluginID'])
+                if plugin not in plugins:
+                    plugins[plugin] = (plugin, attrib.get('pluginName'), attrib.get('pluginFamily'))
+                items.append((report, host, int(attrib.get('port', 0)), attrib.get('protocol'),
+                              attrib.get('svc_name'), plugin, int(attrib['severity'])))
+                elem.clear()
+                if len(items) >= BATCHSIZE:
+                    count += self._flush(cursor, items, plugins)
+            elif tag == 'tag' and elem.attrib.get('name') == 'host-ip' and host is not None:
+                cursor.execute("UPDATE hosts SET ip = ? WHERE id = ?", (elem.text, host))
+            elif tag == 'ReportHost':
+                elem.clear()
+                if parent is not None:
+                    parent.remove(elem)
+            elif tag == 'policyName' and policy is None:
+                policy = elem.text
+            elif tag == 'preference' and target is None:
+                if elem.findtext('name') == 'TARGET':
+                    target = elem.findtext('value')
+            elif tag == 'Policy':
+                elem.clear()
+        count += self._flush(cursor, items, plugins)
+        cursor.execute("UPDATE reports SET name = ?, policy = ?, target = ? WHERE id = ?",
+                       (name, policy, target, report))
+        return count
+
+    def _flush(self, cursor, items, plugins):
+        cursor.executemany("INSERT OR IGNORE INTO plugins (id, name, family) VALUES (?, ?, ?)", plugins.values())
+        cursor.executemany("INSERT INTO items (report, host, port, protocol, service, plugin, severity) "
+                           "VALUES (?, ?, ?, ?, ?, ?, ?)", items)
+        count = len(items)
+        del items[:]
+        plugins.clear()
+        return count
+
+    def query(self, sql, params=()):
+        """
+        Run any read-only query against the index and return every row.
+        """
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def hosts_with_plugin(self, plugin, latest=True):
+        """
+        Return (host, port, severity, report name) for every finding of a plugin; with latest, only from the most
+        recent report of each scan name.
+
+        @type   plugin: number
+        @param  plugin: The Nessus plugin ID.
+        """
+        sql = ("SELECT DISTINCT hosts.name, items.port, items.severity, reports.name FROM items "
+               "JOIN hosts ON hosts.id = items.host JOIN reports ON reports.id = items.report "
+               "WHERE items.plugin = ?")
+        if latest:
+            sql += " AND reports.id IN (SELECT MAX(id) FROM reports GROUP BY name)"
+        return self.query(sql + " ORDER BY hosts.name, items.port", (plugin, ))
+
+    def severity_history(self, name):
+        """
+        Return (ingested, {severity: count}) for every report filed under a scan name, oldest first, to see how
+        the totals changed from one run to the next.
+
+        @type   name:   string
+        @param  name:   The scan name.
+        """
+        history = []
+        index = {}
+        rows = self.query("SELECT reports.id, reports.ingested, items.severity, COUNT(*) FROM reports "
+                          "LEFT JOIN items ON items.report = reports.id WHERE reports.name = ? "
+                          "GROUP BY reports.id, items.severity ORDER BY reports.id", (name, ))
+        for report, ingested, severity, count in rows:
+            if report not in index:
+                index[report] = {}
+                history.append((ingested, index[report]))
+            if severity is not None:
+                index[report][severity] = count
+        return history
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] database [report.xml ...]")
+    parser.add_option("--plugin", type='int', help="list the hosts with findings from this plugin ID")
+    parser.add_option("--history", metavar='NAME', help="show the severity totals of every run of a scan")
+    (options, args) = parser.parse_args()
+    if not args:
+        parser.error("no database given")
+
+    index = FindingsIndex(args[0])
+    try:
+        # Backfill reports already on disk, keyed by their full path
+        for path in args[1:]:
+            count = index.ingest(path, os.path.abspath(path))
+            sys.stderr.write("%s: %d finding(s) added\n" % (path, count))
+        if options.plugin is not None:
+            for host, port, severity, report in index.hosts_with_plugin(options.plugin):
+                print "%s\t%s\t%s\t%s" % (host, port, severity, report)
+        if options.history is not None:
+            for ingested, severity in index.severity_history(options.history):
+                print "%.0f\t%s" % (ingested, "\t".join(str(severity.get(level, 0)) for level in range(5)))
+    finally:
+        index.close()
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: expandtab sw=4 ts=4 ai
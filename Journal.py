@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Copyright (c) 2010 HomeAway, Inc.
+All rights reserved.  http://www.homeaway.com
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import os
+import json
+import threading
+from time import time
+
+from Logger import get_logger
+
+# Journal events, in the order a scan goes through them
+LAUNCHED = 'launched'
+COMPLETED = 'completed'
+DELIVERED = 'delivered'
+
+
+def scan_key(scan):
+    """
+    The identity of a queued scan across runs: the name, target and policy it was given in the input and, for
+    scans read from a file, the line they were read from, so that repeated lines remain separate scans.
+
+    @type   scan:   dict
+    @param  scan:   A queued scan, with 'name', 'target', 'policy' and optionally 'line'.
+    """
+    key = "%s|%s|%s" % (scan['name'], scan['target'], scan['policy'])
+    if 'line' in scan:
+        key += "|%d" % scan['line']
+    return key
+
+
+class Journal(object):
+    def __init__(self, path):
+        """
+        An append-only record of scan launches, completions and report deliveries, one JSON object per line.
+        Every entry is flushed to disk before the call returns, so a run that dies part way through can be picked
+        up again by replaying the journal.
+
+        @type   path:   string
+        @param  path:   The journal file; created when the first entry is written.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.logger = get_logger('Journal')
+        self.handle = None
+
+    def record(self, event, **fields):
+        """
+        Append one entry to the journal.
+
+        @type   event:  string
+        @param  event:  One of LAUNCHED, COMPLETED or DELIVERED.
+        """
+        fields['event'] = event
+        fields['time'] = time()
+        line = json.dumps(fields, sort_keys=True) + "\n"
+        with self.lock:
+            if self.handle is None:
+                self.handle = open(self.path, "a")
+            self.handle.write(line)
+            self.handle.flush()
+            os.fsync(self.handle.fileno())
+
+    def replay(self):
+        """
+        Read the journal back and return the last known state of every scan it mentions, as a dict keyed by
+        scan_key(). Each value is the launch entry (name, target, policy, uuid, node, ...) with 'event' set to the
+        latest event seen for that scan. A line left incomplete by a crash is ignored.
+        """
+        state = {}
+        byuuid = {}
+        if not os.path.exists(self.path):
+            return state
+        f = open(self.path, "r")
+        try:
+            for number, line in enumerate(f):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    self.logger.warning("Ignoring unreadable journal entry at %s:%d" % (self.path, number + 1))
+                    continue
+                if entry.get('event') == LAUNCHED:
+                    state[entry['key']] = entry
+                    byuuid[entry['uuid']] = entry
+                elif entry.get('uuid') in byuuid:
+                    byuuid[entry['uuid']]['event'] = entry['event']
+        finally:
+            f.close()
+        return state
+
+    def clear(self):
+        """
+        Remove the journal once every scan in it has been delivered, so the next run starts from scratch.
+        """
+        with self.lock:
+            if self.handle is not None:
+                self.handle.close()
+                self.handle = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def close(self):
+        with self.lock:
+            if self.handle is not None:
+                self.handle.close()
+                self.handle = None
+
+
+# vim: expandtab sw=4 ts=4 ai
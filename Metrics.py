@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Copyright (c) 2010 HomeAway, Inc.
+All rights reserved.  http://www.homeaway.com
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import os
+import json
+import threading
+from time import time
+
+# Upper bounds, in seconds, of the request latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# States a NessusXMLRPC.CircuitBreaker can be in
+CIRCUIT_STATES = ('closed', 'half-open', 'open')
+
+
+class EndpointStats(object):
+    def __init__(self, buckets):
+        """
+        Counters for every request made to one target path.
+
+        @type   buckets:    tuple
+        @param  buckets:    Upper bounds of the latency histogram buckets, in seconds, in increasing order.
+        """
+        self.buckets = buckets
+        self.histogram = [0] * (len(buckets) + 1)  # The last bucket catches everything slower than buckets[-1]
+        self.count = 0  # Requests answered, whatever the status
+        self.errors = 0  # Requests that failed in transport or came back with a status other than 200
+        self.latency = 0.0  # Seconds spent waiting on the server, summed over requests
+        self.sent = 0  # Bytes of request parameters sent
+        self.received = 0  # Bytes of response body received
+        self.parses = 0  # Responses parsed
+        self.parsing = 0.0  # Seconds spent parsing responses
+        self.reconnects = 0  # Connections rebuilt before the request could be sent
+        self.relogins = 0  # Sessions renewed after a 403
+        self.retries = 0  # Requests sent again after a transport failure or a 5xx
+        self.refused = 0  # Requests not sent at all because the circuit was open
+
+    def observe(self, seconds):
+        position = 0
+        for bound in self.buckets:
+            if seconds <= bound:
+                break
+            position += 1
+        self.histogram[position] += 1
+        self.latency += seconds
+
+    def snapshot(self):
+        """
+        Return the counters as a dict; the histogram is cumulative, as (bound, count) pairs ending with 'inf'.
+        """
+        cumulative = []
+        total = 0
+        for bound, count in zip(list(self.buckets) + ['inf'], self.histogram):
+            total += count
+            cumulative.append((bound, total))
+        return {'count': self.count,
+                'errors': self.errors,
+                'latency': self.latency,
+                'histogram': cumulative,
+                'bytes_sent': self.sent,
+                'bytes_received': self.received,
+                'parses': self.parses,
+                'parse_time': self.parsing,
+                'reconnects': self.reconnects,
+                'relogins': self.relogins,
+                'retries': self.retries,
+                'refused': self.refused}
+
+
+class RequestMetrics(object):
+    def __init__(self, buckets=BUCKETS):
+        """
+        Request counts, latency, bytes transferred, parse time, reconnects, re-logins and retries of one Scanner,
+        kept per target path so a slow run can be pinned on the server, the network or our own parsing, along with
+        the state of its circuit breaker and how often it changed.
+
+        @type   buckets:    tuple
+        @param  buckets:    Upper bounds of the latency histogram buckets, in seconds.
+        """
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.state = 'closed'  # Circuit breaker state
+        self.transitions = {}  # Circuit breaker changes, by the state changed to
+
+    def _endpoint(self, target):
+        # Callers hold the lock
+        stats = self.endpoints.get(target)
+        if stats is None:
+            stats = self.endpoints[target] = EndpointStats(self.buckets)
+        return stats
+
+    def request(self, target, seconds, sent, received, failed=False):
+        """
+        Record one request that has been answered, or has failed, after the given number of seconds.
+
+        @type   target:     string
+        @param  target:     The target path of the request.
+        @type   seconds:    number
+        @param  seconds:    Time from sending the request until the response was read.
+        @type   sent:       number
+        @param  sent:       Bytes of parameters sent.
+        @type   received:   number
+        @param  received:   Bytes of response body received.
+        @type   failed:     bool
+        @param  failed:     The request failed in transport or did not come back with a 200.
+        """
+        with self.lock:
+            stats = self._endpoint(target)
+            stats.count += 1
+            stats.observe(seconds)
+            stats.sent += sent
+            stats.received += received
+            if failed:
+                stats.errors += 1
+
+    def parsed(self, target, seconds):
+        with self.lock:
+            stats = self._endpoint(target)
+            stats.parses += 1
+            stats.parsing += seconds
+
+    def reconnect(self, target):
+        with self.lock:
+            self._endpoint(target).reconnects += 1
+
+    def relogin(self, target):
+        with self.lock:
+            self._endpoint(target).relogins += 1
+
+    def retry(self, target):
+        with self.lock:
+            self._endpoint(target).retries += 1
+
+    def refused(self, target):
+        with self.lock:
+            self._endpoint(target).refused += 1
+
+    def circuit(self, state):
+        """
+        Record a change of the circuit breaker to the given state.
+        """
+        with self.lock:
+            self.state = state
+            self.transitions[state] = self.transitions.get(state, 0) + 1
+
+    def breaker(self):
+        """
+        Return the circuit breaker state and its changes so far, as a dict.
+        """
+        with self.lock:
+            return {'state': self.state, 'transitions': dict(self.transitions)}
+
+    def snapshot(self):
+        """
+        Return the stats of every target path seen so far, as a dict keyed by path.
+        """
+        with self.lock:
+            return dict((target, stats.snapshot()) for target, stats in self.endpoints.items())
+
+    def prometheus(self):
+        """
+        Return the metrics in the Prometheus text exposition format.
+        """
+        return prometheus([({}, self)])
+
+
+def _labels(labels):
+    return ",".join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for name, value in sorted(labels.items()))
+
+
+def prometheus(sources):
+    """
+    Render the metrics of several scanners in the Prometheus text exposition format, for instance one per
+    scanner node with a 'node' label.
+
+    @type   sources:    list
+    @param  sources:    (labels dict, RequestMetrics) pairs.
+    """
+    families = [('nessus_requests_total', 'counter', 'Requests sent to the Nessus server.', 'count'),
+                ('nessus_request_errors_total', 'counter', 'Requests that failed or were not answered with a 200.',
+                 'errors'),
+                ('nessus_request_sent_bytes_total', 'counter', 'Bytes of request parameters sent.', 'bytes_sent'),
+                ('nessus_request_received_bytes_total', 'counter', 'Bytes of response bodies received.',
+                 'bytes_received'),
+                ('nessus_response_parse_seconds_total', 'counter', 'Seconds spent parsing responses.', 'parse_time'),
+                ('nessus_response_parses_total', 'counter', 'Responses parsed.', 'parses'),
+                ('nessus_reconnects_total', 'counter', 'Connections rebuilt before sending a request.', 'reconnects'),
+                ('nessus_relogins_total', 'counter', 'Sessions renewed after a 403.', 'relogins'),
+                ('nessus_retries_total', 'counter', 'Requests sent again after a transport failure or a 5xx.',
+                 'retries'),
+                ('nessus_refused_total', 'counter', 'Requests not sent because the circuit was open.', 'refused')]
+    snapshots = [(labels, metrics.snapshot()) for labels, metrics in sources]
+    lines = []
+
+    lines.append("# HELP nessus_request_duration_seconds Time from sending a request until its response was read.")
+    lines.append("# TYPE nessus_request_duration_seconds histogram")
+    for labels, snapshot in snapshots:
+        for target, stats in sorted(snapshot.items()):
+            series = dict(labels, target=target)
+            for bound, count in stats['histogram']:
+                bound = '+Inf' if bound == 'inf' else repr(float(bound))
+                lines.append('nessus_request_duration_seconds_bucket{%s} %d' % (_labels(dict(series, le=bound)),
+                                                                                  count))
+            lines.append('nessus_request_duration_seconds_sum{%s} %r' % (_labels(series), stats['latency']))
+            lines.append('nessus_request_duration_seconds_count{%s} %d' % (_labels(series), stats['count']))
+
+    for name, kind, text, key in families:
+        lines.append("# HELP %s %s" % (name, text))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for labels, snapshot in snapshots:
+            for target, stats in sorted(snapshot.items()):
+                lines.append('%s{%s} %r' % (name, _labels(dict(labels, target=target)), stats[key]))
+
+    breakers = [(labels, metrics.breaker()) for labels, metrics in sources]
+    lines.append("# HELP nessus_circuit_state Circuit breaker state; 1 for the current one.")
+    lines.append("# TYPE nessus_circuit_state gauge")
+    for labels, breaker in breakers:
+        for state in CIRCUIT_STATES:
+            lines.append('nessus_circuit_state{%s} %d' % (_labels(dict(labels, state=state)),
+                                                         breaker['state'] == state))
+    lines.append("# HELP nessus_circuit_transitions_total Circuit breaker changes, by the state changed to.")
+    lines.append("# TYPE nessus_circuit_transitions_total counter")
+    for labels, breaker in breakers:
+        for state in CIRCUIT_STATES:
+            lines.append('nessus_circuit_transitions_total{%s} %d' % (_labels(dict(labels, state=state)),
+                                                                     breaker['transitions'].get(state, 0)))
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(path, sources):
+    """
+    Write the metrics of several scanners to a file, replacing it in one step so readers never see it half
+    written. A path ending in .prom gets the Prometheus text format (as read by node_exporter's textfile
+    collector); anything else gets JSON, with the labels and per-path stats of each source.
+
+    @type   path:       string
+    @param  path:       The file to write.
+    @type   sources:    list
+    @param  sources:    (labels dict, RequestMetrics) pairs.
+    """
+    if path.endswith('.prom'):
+        contents = prometheus(sources)
+    else:
+        document = {'time': time(),
+                    'scanners': [{'labels': labels, 'endpoints': metrics.snapshot(), 'circuit': metrics.breaker()}
+                                 for labels, metrics in sources]}
+        contents = json.dumps(document, indent=2, sort_keys=True) + "\n"
+    temporary = "%s.%d.tmp" % (path, os.getpid())
+    output = open(temporary, "w")
+    try:
+        output.write(contents)
+    finally:
+        output.close()
+    os.rename(temporary, path)
+
+
+# vim: expandtab sw=4 ts=4 ai
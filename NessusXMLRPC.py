@@ -18,22 +18,52 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import os
 import sys
-import xml.etree.ElementTree
-
-from httplib import HTTPSConnection, CannotSendRequest, ImproperConnectionState
+import zlib
+import threading
+from Queue import Queue, Empty
+from collections import OrderedDict
+
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+from cStringIO import StringIO
+from httplib import HTTPSConnection, HTTPException, CannotSendRequest, ImproperConnectionState
 from urllib import urlencode
-from random import randint
-from time import sleep
+from random import randint, uniform
+from time import sleep, time
+from timeit import default_timer
 
 from exceptions import Exception
 
 from Logger import get_logger
+from Metrics import RequestMetrics
+from Trace import TraceRing
 
 # Arbitary minimum and maximum values for random sequence num
 SEQMIN = 10000
 SEQMAX = 99999
 
+# Size of the reads used when streaming a response body to a file
+CHUNKSIZE = 64 * 1024
+
+# Seconds a ResponseCache keeps the parsed reply of each read-only call. Completed scans never change their
+# errors; the report list is only kept long enough to spare callers polling at the same moment.
+CACHE_TTLS = {'/policy/list': 300,
+              '/report/list': 5,
+              '/report/errors': 3600}
+
+# Calls that must not be sent twice: a transport failure may hide a request the server already acted on
+NONIDEMPOTENT = ('/scan/new', )
+
+# States of a CircuitBreaker
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
 
 # Simple exceptions for error handling
 class NessusError(Exception):
@@ -91,8 +121,556 @@ class ParseError(NessusError):
     pass
 
 
-class Scanner(object):
-    def __init__(self, host, port, login=None, password=None, timeout=60, debug=False):
+class CircuitOpenError(RequestError):
+    """
+    Requests refused without being sent while the server is considered unhealthy.
+    """
+    pass
+
+
+class ConnectionPool(object):
+    def __init__(self, host, port, timeout=60, size=1):
+        """
+        A bounded, thread-safe pool of keep-alive HTTPS connections to a single Nessus server. Callers block
+        in get() once all connections are handed out.
+
+        @type   host:       string
+        @param  host:       The hostname of the running Nessus server.
+        @type   port:       number
+        @param  port:       The port number for the XMLRPC interface on the Nessus server.
+        @type   timeout:    number
+        @param  timeout:    Socket timeout for each connection, in seconds.
+        @type   size:       number
+        @param  size:       The maximum number of connections open at once.
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.size = max(1, size)
+        self.idle = []  # Connections ready for reuse, most recently used last
+        self.open = 0  # Connections currently created (idle or handed out)
+        self.waits = 0  # Number of times get() had to wait for a connection
+        self.reconnects = 0  # Number of connections rebuilt after a connection error
+        self.condition = threading.Condition()
+
+    def _connect(self):
+        """
+        Internal method for connecting to the target Nessus server.
+        """
+        return HTTPSConnection(self.host, self.port, timeout=self.timeout)
+
+    def get(self):
+        """
+        Hand out an idle connection, creating one while under the size limit and waiting otherwise.
+        """
+        self.condition.acquire()
+        try:
+            waited = False
+            while not self.idle and self.open >= self.size:
+                if not waited:
+                    self.waits += 1
+                    waited = True
+                self.condition.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.open += 1
+        finally:
+            self.condition.release()
+        return self._connect()
+
+    def put(self, connection):
+        """
+        Return a connection to the pool once its response has been read completely.
+
+        @type   connection: HTTPSConnection
+        @param  connection: A connection previously handed out by get().
+        """
+        self.condition.acquire()
+        try:
+            self.idle.append(connection)
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def discard(self, connection):
+        """
+        Close a broken connection and free its slot in the pool.
+
+        @type   connection: HTTPSConnection
+        @param  connection: A connection previously handed out by get().
+        """
+        connection.close()
+        self.condition.acquire()
+        try:
+            self.open -= 1
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def reconnect(self, connection):
+        """
+        Replace a connection that is no longer usable, keeping its slot in the pool.
+
+        @type   connection: HTTPSConnection
+        @param  connection: A connection previously handed out by get().
+        """
+        connection.close()
+        self.condition.acquire()
+        try:
+            self.reconnects += 1
+        finally:
+            self.condition.release()
+        return self._connect()
+
+    def close(self):
+        """
+        Close every idle connection; connections currently handed out are left to their callers.
+        """
+        self.condition.acquire()
+        try:
+            idle = self.idle
+            self.idle = []
+            self.open -= len(idle)
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+        for connection in idle:
+            connection.close()
+
+    def stats(self):
+        """
+        Return a dict describing the pool: its size, open and idle connections, waits and reconnects.
+        """
+        self.condition.acquire()
+        try:
+            return {'size': self.size,
+                    'open': self.open,
+                    'idle': len(self.idle),
+                    'waits': self.waits,
+                    'reconnects': self.reconnects}
+        finally:
+            self.condition.release()
+
+
+class PolicyIndex(object):
+    def __init__(self, ttl=300):
+        """
+        Policy IDs keyed by policy name, as last seen in policyList(). Entries expire together after ttl seconds.
+
+        @type   ttl:    number
+        @param  ttl:    Seconds the index stays valid after a refresh; with 0 every lookup lists the policies again.
+        """
+        self.ttl = ttl
+        self.ids = {}
+        self.loaded = None  # When the index was last refreshed
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        """
+        Return the ID of the named policy, or None when it is unknown or the index has expired.
+
+        @type   name:   string
+        @param  name:   The name of the policy.
+        """
+        self.lock.acquire()
+        try:
+            if self.loaded is None or time() - self.loaded >= self.ttl:
+                return None
+            return self.ids.get(name)
+        finally:
+            self.lock.release()
+
+    def update(self, policies):
+        """
+        Rebuild the index from the output of policyList(), returning the new dict of IDs keyed by name (which
+        holds even when the index itself will not serve them).
+
+        @type   policies:   dict
+        @param  policies:   A single {'policy': {...}} or a list of policies, as returned by policyList().
+        """
+        if type(policies) is dict:
+            # There appears to be only one configured policy
+            policies = [policies['policy']]
+        ids = {}
+        for policy in policies:
+            ids[policy['policyName']] = policy['policyID']
+        self.lock.acquire()
+        try:
+            self.ids = ids
+            self.loaded = time()
+        finally:
+            self.lock.release()
+        return ids
+
+    def invalidate(self):
+        """
+        Forget every policy, forcing the next lookup to fetch the policy list again.
+        """
+        self.lock.acquire()
+        try:
+            self.ids = {}
+            self.loaded = None
+        finally:
+            self.lock.release()
+
+
+class ResponseCache(object):
+    def __init__(self, ttls=None, size=256):
+        """
+        Parsed replies of read-only calls (policyList, reportList, getErrors), each kept for the TTL of its target
+        path and evicted least recently used first once size entries are held. Cached values are shared between
+        callers and must not be modified.
+
+        @type   ttls:   dict
+        @param  ttls:   Seconds to keep replies for, by target path; merged over CACHE_TTLS. Paths with a TTL of 0
+                        or none at all are never cached.
+        @type   size:   number
+        @param  size:   The most replies held at once.
+        """
+        self.ttls = dict(CACHE_TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self.size = max(1, size)
+        self.entries = OrderedDict()  # (target, key) -> (expiry, value), least recently used first
+        self.hits = {}  # Lookups answered from the cache, per target path
+        self.misses = {}  # Lookups that had to go to the server, per target path
+        self.lock = threading.Lock()
+
+    def get(self, target, key=None):
+        """
+        Return (True, value) for a fresh cached reply, (False, None) otherwise.
+
+        @type   target: string
+        @param  target: The target path of the call.
+        @type   key:    string
+        @param  key:    Whatever tells calls to the same path apart, such as a report uuid.
+        """
+        with self.lock:
+            entry = self.entries.pop((target, key), None)
+            if entry is not None and entry[0] > time():
+                self.entries[(target, key)] = entry  # Now the most recently used
+                self.hits[target] = self.hits.get(target, 0) + 1
+                return True, entry[1]
+            self.misses[target] = self.misses.get(target, 0) + 1
+            return False, None
+
+    def put(self, target, key, value):
+        ttl = self.ttls.get(target, 0)
+        if ttl <= 0:
+            return
+        with self.lock:
+            self.entries.pop((target, key), None)
+            self.entries[(target, key)] = (time() + ttl, value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, target=None):
+        """
+        Drop every cached reply for a target path, or everything when no path is given.
+        """
+        with self.lock:
+            if target is None:
+                self.entries.clear()
+            else:
+                for entry in [entry for entry in self.entries if entry[0] == target]:
+                    del self.entries[entry]
+
+    def stats(self):
+        """
+        Return the hits, misses and held entries of every target path, as a dict keyed by path.
+        """
+        with self.lock:
+            stats = {}
+            for target in set(self.hits) | set(self.misses) | set(entry[0] for entry in self.entries):
+                stats[target] = {'hits': self.hits.get(target, 0),
+                                 'misses': self.misses.get(target, 0),
+                                 'entries': len([entry for entry in self.entries if entry[0] == target])}
+            return stats
+
+
+class RetryPolicy(object):
+    def __init__(self, attempts=3, backoff=0.5, backoffmax=30.0, logins=1):
+        """
+        How Scanner._request() retries: transport failures and 5xx replies are retried up to attempts times, each
+        after a random wait of up to backoff * 2 ** n seconds (capped at backoffmax), so clients that failed
+        together do not come back together. A 403 is answered by logging in again, at most logins times per
+        request, with no wait.
+
+        @type   attempts:   number
+        @param  attempts:   Further attempts after the first one fails in transport or with a 5xx; 0 never retries.
+        @type   backoff:    number
+        @param  backoff:    Seconds the wait before the first retry is drawn from; doubles with each retry.
+        @type   backoffmax: number
+        @param  backoffmax: The longest wait between attempts.
+        @type   logins:     number
+        @param  logins:     Re-logins allowed per request before a 403 is raised as a LoginError.
+        """
+        self.attempts = max(0, attempts)
+        self.backoff = backoff
+        self.backoffmax = backoffmax
+        self.logins = max(0, logins)
+
+    def delay(self, retry):
+        """
+        Seconds to wait before the given retry (counting from 1).
+        """
+        return uniform(0, min(self.backoffmax, self.backoff * 2 ** (retry - 1)))
+
+
+class CircuitBreaker(object):
+    def __init__(self, failures=5, cooldown=60):
+        """
+        Fail fast while a server is unhealthy. After failures transport errors or 5xx replies in a row the circuit
+        opens and every request is refused with a CircuitOpenError for cooldown seconds. After that a single
+        request is let through as a probe (half-open): its success closes the circuit, its failure opens it again.
+
+        @type   failures:   number
+        @param  failures:   Consecutive failures that open the circuit; 0 never opens it.
+        @type   cooldown:   number
+        @param  cooldown:   Seconds the circuit stays open before a probe is let through.
+        """
+        self.failures = failures
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.streak = 0  # Consecutive failures seen while closed
+        self.opened = 0  # When the circuit last opened
+        self.probing = False  # A half-open probe is in flight
+        self.listeners = []  # Called with (old state, new state) on every change
+        self.lock = threading.Lock()
+
+    def _change(self, state):
+        # Callers hold the lock
+        old, self.state = self.state, state
+        if state == OPEN:
+            self.opened = time()
+        for listener in self.listeners:
+            listener(old, state)
+
+    def allow(self):
+        """
+        Return whether a request may be sent now; when True, success() or failure() must follow.
+        """
+        with self.lock:
+            if self.state == OPEN:
+                if time() - self.opened < self.cooldown:
+                    return False
+                self._change(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self.probing:
+                    return False
+                self.probing = True
+            return True
+
+    def success(self):
+        with self.lock:
+            self.streak = 0
+            self.probing = False
+            if self.state != CLOSED:
+                self._change(CLOSED)
+
+    def failure(self):
+        with self.lock:
+            self.probing = False
+            if self.state == HALF_OPEN:
+                self._change(OPEN)
+                return
+            self.streak += 1
+            if self.state == CLOSED and 0 < self.failures <= self.streak:
+                self._change(OPEN)
+
+    def retry_after(self):
+        """
+        Seconds until an open circuit lets a probe through.
+        """
+        with self.lock:
+            if self.state != OPEN:
+                return 0
+            return max(0, self.cooldown - (time() - self.opened))
+
+
+class ScannerBase(object):
+    """
+    Response parsing and result handling shared by the blocking Scanner and the AsyncScanner. Subclasses only
+    differ in how a request reaches the server.
+    """
+
+    def parse(self, response):
+        """
+        Parse the XML response from the server.
+
+        The response is parsed in a single, non-recursive pass over the parser events. Elements with children
+        become a dict() keyed by tag; as soon as a tag repeats among its siblings the container becomes a list()
+        of every child value, in document order. Elements without children map to their text.
+
+        @type   response:   string
+        @param  response:   Response XML from the server following a request.
+        """
+        # Each frame is [children, values]; the first holds children by tag, the second is only set once a tag
+        # repeats and then collects every child value in order.
+        stack = [[None, None]]
+        try:
+            for event, element in ElementTree.iterparse(StringIO(response), events=('start', 'end')):
+                if event == 'start':
+                    stack.append([None, None])
+                    continue
+
+                children, values = stack.pop()
+                if values is not None:
+                    value = values
+                elif children is not None:
+                    value = children[0]
+                else:
+                    # Okay, for some reason there's a bug with how expat handles newlines
+                    value = element.text
+                    if value:
+                        value = value.replace("\n", "") or None
+                element.clear()
+
+                frame = stack[-1]
+                if frame[1] is not None:
+                    frame[1].append(value)
+                elif frame[0] is None:
+                    frame[0] = ({element.tag: value}, [value])
+                else:
+                    result, ordered = frame[0]
+                    ordered.append(value)
+                    if element.tag in result:
+                        # Repeated tag; switch the container over to a list of every value seen so far
+                        frame[1] = ordered
+                    else:
+                        result[element.tag] = value
+        except Exception:
+            raise ParseError("Error parsing XML", response)
+
+        root = stack[0][0]
+        if root is None:
+            raise ParseError("Error parsing XML", response)
+        parsed = root[0].values()[0]
+        if not isinstance(parsed, (dict, list)):
+            return dict()
+        return parsed
+
+    def _handle_login(self, parsed):
+        """
+        Keep the token from a /login reply, raising LoginError on failure.
+
+        @type   parsed:     dict
+        @param  parsed:     The parsed /login reply.
+        """
+        contents = parsed['contents']
+        if parsed['status'] == "OK":
+            self.token = contents['token']  # Actual token value
+            user = contents['user']  # User dict (admin status, user name)
+            self.isadmin = user['admin']  # Is the logged in user an admin?
+
+            self.headers["Cookie"] = "token=%s" % self.token  # Persist token value for subsequent requests
+        else:
+            raise LoginError("Unable to login", contents)
+
+        return True
+
+    def _handle_logout(self, parsed):
+        """
+        @type   parsed:     dict
+        @param  parsed:     The parsed /logout reply.
+        """
+        if parsed['status'] == "OK" and parsed['contents'] == "OK":
+            return True
+        else:
+            return False
+
+    def _handle_policyList(self, parsed):
+        """
+        @type   parsed:     dict
+        @param  parsed:     The parsed /policy/list reply.
+        """
+        contents = parsed['contents']
+        if parsed['status'] == "OK":
+            policies = contents['policies']  # Should be an iterable list of policies
+        else:
+            raise PolicyError("Unable to get policy list", contents)
+        return policies
+
+    def _handle_getErrors(self, parsed, scan):
+        """
+        @type   parsed:     dict
+        @param  parsed:     The parsed /report/errors reply.
+        @type   scan:       dict
+        @param  scan:       The scan the errors were requested for.
+        """
+        contents = parsed['contents']
+
+        if parsed['status'] == "OK":
+            return contents['errors']  # Return the collected errors.
+        else:
+            raise ReportError("Unable to get error status for scan job: ", (scan['uuid'], contents['errors']))
+
+    def _handle_scanNew(self, parsed):
+        """
+        @type   parsed:     dict
+        @param  parsed:     The parsed /scan/new reply.
+        """
+        contents = parsed['contents']
+        if parsed['status'] == "OK":
+            return contents['scan']  # Return what you can about the scan
+        else:
+            raise ScanError("Unable to start scan", contents)
+
+    def _policy_id(self, policies, scan_name, target, policy_name):
+        """
+        Refresh the policy index from the output of policyList() and look up the ID of a policy by name.
+
+        @type   policies:    dict
+        @param  policies:    The policies returned by policyList().
+        @type   scan_name:   string
+        @param  scan_name:   The desired name of the scan.
+        @type   target:      string
+        @param  target:      A Nessus-compatible target string (comma separation, CIDR notation, etc.)
+        @type   policy_name: string
+        @param  policy_name: The name of the policy to be used in the scan.
+        """
+        try:
+            ids = self.policies.update(policies)
+        except (KeyError, TypeError):
+            raise PolicyError("Unable to parse policies from policyList()", (scan_name, target, policy_name))
+        policy_id = ids.get(policy_name)
+        if policy_id is None:
+            raise PolicyError("Unable to find policy", (scan_name, target, policy_name))
+        return policy_id
+
+    def _handle_reportList(self, parsed):
+        """
+        @type   parsed:     dict
+        @param  parsed:     The parsed /report/list reply.
+        """
+        contents = parsed['contents']
+        if parsed['status'] == "OK":
+            reports = contents['reports']
+            if type(reports) is dict:
+                # We've only got one report, put it into a list
+                temp = reports
+                reports = list()
+                reports.append(temp['report'])
+            return reports  # Return an iterable list of reports
+        else:
+            raise ReportError("Unable to get reports.", contents)
+
+    def _download_params(self, report, version):
+        """
+        @type   report:     string
+        @param  report:     The UUID of the report or completed scan.
+        @type   version:    string
+        @param  version:    The version of the .nessus XML file you wish to download.
+        """
+        if version == "v1":
+            return urlencode({'report': report, 'v1': version})
+        else:
+            return urlencode({'report': report})
+
+
+class Scanner(ScannerBase):
+    def __init__(self, host, port, login=None, password=None, timeout=60, debug=False, poolsize=1, policy_ttl=300,
+                 trace=0, tracebody=2048, cache=None, retry=None, breaker=None):
         """
         Initialize the scanner instance by setting up a connection and authenticating
         if credentials are provided.
@@ -107,6 +685,25 @@ class Scanner(object):
         @param  password:   The password for logging in to Nessus.
         @type   debug:      bool
         @param  debug:      turn on debugging.
+        @type   poolsize:   number
+        @param  poolsize:   The number of keep-alive connections shared by threads using this scanner.
+        @type   policy_ttl: number
+        @param  policy_ttl: Seconds quickScan() trusts its index of policy names before listing policies again.
+        @type   trace:      number
+        @param  trace:      Keep this many recent exchanges in self.trace (a Trace.TraceRing), logged only when a
+                            request or parse fails or dumptrace() is called; 0 disables tracing.
+        @type   tracebody:  number
+        @param  tracebody:  Bytes of each response body kept in the trace.
+        @type   cache:      ResponseCache
+        @param  cache:      Serve policyList(), reportList() and getErrors() from this cache while fresh; scanNew()
+                            and logout() invalidate what they change. Anything with the same get(), put() and
+                            invalidate() methods will do (optional).
+        @type   retry:      RetryPolicy
+        @param  retry:      How failed requests are retried (default: RetryPolicy()).
+        @type   breaker:    CircuitBreaker
+        @param  breaker:    The circuit breaker of this server (default: CircuitBreaker()).
+
+        Every request is counted per target path in self.metrics (a Metrics.RequestMetrics).
         """
         self.token = None
         self.isadmin = None
@@ -115,24 +712,35 @@ class Scanner(object):
         self.timeout = timeout
         self.debug = debug
         self.logger = get_logger('Scanner')
-        self.connection = None
+        self.pool = ConnectionPool(host, port, timeout=timeout, size=poolsize)
+        self.policies = PolicyIndex(policy_ttl)
+        self.metrics = RequestMetrics()
+        self.cache = cache
+        self.retry = retry or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker()
+        self.trace = None
+        if trace > 0:
+            self.trace = TraceRing(trace, tracebody)
         self.headers = {"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain"}
+        self.login_lock = threading.RLock()
 
         self.username = login
         self.password = password
-        self._connect()
-        self.login()
-
-    def _connect(self):
-        """
-        Internal method for connecting to the target Nessus server.
-        """
-        self.connection = HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        # The breaker outlives a scanner that fails to log in, and so must not keep it as a listener
+        with self.breaker.lock:
+            self.breaker.listeners.append(self._circuitchanged)
+        try:
+            self.login()
+        except Exception:
+            with self.breaker.lock:
+                self.breaker.listeners.remove(self._circuitchanged)
+            raise
 
-    def _request(self, method, target, params):
+    def _request(self, method, target, params, output=None, compressed=False, offset=0, retry=True):
         """
-        Internal method for submitting requests to the target Nessus server, rebuilding
-        the connection if needed.
+        Internal method for submitting requests to the target Nessus server over a pooled connection,
+        rebuilding the connection if needed. Failures are retried as self.retry says, and refused up front with a
+        CircuitOpenError while self.breaker is open.
 
         @type   method:     string
         @param  method:     The HTTP verb/method used in the request (almost always POST).
@@ -140,6 +748,116 @@ class Scanner(object):
         @param  target:     The target path (or function) of the request.
         @type   params:     string
         @param  params:     The URL encoded parameters used in the request.
+        @type   output:     file
+        @param  output:     Stream a successful response body into this file object in chunks and return the
+                            number of bytes written, rather than returning the body (optional).
+        @type   compressed: bool
+        @param  compressed: Ask for a gzip-encoded response; it is decompressed as it is read, so callers always
+                            see the plain body (optional).
+        @type   offset:     number
+        @param  offset:     Ask for the body from this byte on, to resume streaming into output; output must be
+                            seekable, and is rewound and truncated when the server sends the whole body instead.
+        @type   retry:      bool
+        @param  retry:      Retry failures as self.retry says; False leaves retrying to the caller, as when it
+                            resumes transfers itself (optional).
+        """
+        # A partial (206) reply is only good for ranged requests
+        success = (200, )
+        if offset:
+            success = (200, 206)
+        attempts = self.retry.attempts if retry else 0
+        retries = 0
+        logins = 0
+        while True:
+            if not self.breaker.allow():
+                self.metrics.refused(target)
+                raise CircuitOpenError("Circuit open, not sending request to %s:%s; retry in %.1fs" % (
+                    self.host, self.port, self.breaker.retry_after()), target)
+
+            headers = dict(self.headers)
+            progress = {'status': None, 'streamed': 0}
+            try:
+                response, response_page, written = self._exchange(method, target, params, headers, output,
+                                                                  compressed, offset, success, progress)
+            except (IOError, HTTPException) as e:
+                # A reply cut short still shows the server is up; it says more about the link than its health
+                if progress['status'] is None:
+                    self.breaker.failure()
+                else:
+                    self.breaker.success()
+                # Body already streamed into output cannot be taken back; resuming is up to the caller
+                if retries >= attempts or target in NONIDEMPOTENT or progress['streamed']:
+                    raise
+                retries += 1
+                self._backoff(method, target, retries, e)
+                continue
+            except BaseException:
+                # Anything else, from a corrupt gzip stream or a bad certificate to a KeyboardInterrupt, must still
+                # settle a probe
+                self.breaker.failure()
+                raise
+
+            status = int(response.status)
+            if status in success:
+                self.breaker.success()
+                if response_page is None:
+                    return written
+                return response_page
+
+            if status >= 500:
+                self.breaker.failure()
+                if retries < attempts and target not in NONIDEMPOTENT:
+                    retries += 1
+                    self._backoff(method, target, retries, "%s %s" % (response.status, response.reason))
+                    continue
+                self.dumptrace("%s %s: %s %s" % (method, target, response.status, response.reason))
+                raise RequestError("Error sending request:", response)
+
+            # The server answered; whatever is wrong is not its health
+            self.breaker.success()
+            if status == 403 and target != "/login":
+                # Session times out? Only log in again if no other thread has done so since we sent the request
+                relogged = False
+                if logins < self.retry.logins:
+                    logins += 1
+                    self.login_lock.acquire()
+                    try:
+                        relogged = headers.get("Cookie") != self.headers.get("Cookie") or self.login()
+                    finally:
+                        self.login_lock.release()
+                if relogged:
+                    self.metrics.relogin(target)
+                    continue
+                self.dumptrace("%s %s: login credentials needed" % (method, target))
+                raise LoginError("Login credentials needed to access: ", target)
+
+            self.dumptrace("%s %s: %s %s" % (method, target, response.status, response.reason))
+            raise RequestError("Error sending request:", response)
+
+    def _backoff(self, method, target, retry, reason):
+        """
+        Wait out the jittered backoff before the given retry of a request.
+        """
+        delay = self.retry.delay(retry)
+        self.metrics.retry(target)
+        self.logger.warning("%s %s failed (%s); retry %d of %d in %.2fs" % (method, target, reason, retry,
+                                                                           self.retry.attempts, delay))
+        sleep(delay)
+
+    def _circuitchanged(self, old, new):
+        self.metrics.circuit(new)
+        if new == OPEN:
+            self.logger.error("Circuit to %s:%s opened; failing fast for %ds" % (self.host, self.port,
+                                                                                 self.breaker.cooldown))
+        else:
+            self.logger.warning("Circuit to %s:%s %s (was %s)" % (self.host, self.port, new, old))
+
+    def _exchange(self, method, target, params, headers, output, compressed, offset, success, progress):
+        """
+        Send one request and read its response, for _request(). Returns (response, body, bytes written), the
+        body being None when it was streamed into output. The response status and the bytes received into output
+        are kept in the progress dict as they arrive, for when the exchange fails part way. A streamed body that
+        ends before its Content-Length (or the span of its Content-Range) raises HTTPException.
         """
 
         def _log_headers(headers):
@@ -150,85 +868,133 @@ class Scanner(object):
                 for tup in headers:
                     self.logger.debug("  %s: %s" % (tup[0], tup[1]))
 
+        if compressed:
+            headers["Accept-Encoding"] = "gzip"
+        if offset:
+            headers["Range"] = "bytes=%d-" % offset
+        if self.debug is True:
+            self.logger.debug("Sending request: %s %s" % (method, target))
+            self.logger.debug("Params: %s" % params)
+            self.logger.debug("Headers:")
+            _log_headers(headers)
+
+        exchange = None
+        if self.trace is not None:
+            exchange = self.trace.begin(method, target, params)
+
+        connection = self.pool.get()
+        started = default_timer()
+        received = 0
+        written = None
         try:
-            if self.connection is None:
-                self._connect()
-            if self.debug is True:
-                self.logger.debug("Sending request: %s %s" % (method, target))
-                self.logger.debug("Params: %s" % params)
-                self.logger.debug("Headers:")
-                _log_headers(self.headers)
-
-            self.connection.request(method, target, params, self.headers)
-        except (CannotSendRequest, ImproperConnectionState):
-            self._connect()
-            self.login()
-            self.connection.request(method, target, params, self.headers)
+            try:
+                connection.request(method, target, params, headers)
+            except (CannotSendRequest, ImproperConnectionState):
+                self.metrics.reconnect(target)
+                connection = self.pool.reconnect(connection)
+                connection.request(method, target, params, headers)
+
+            response = connection.getresponse()
+            progress['status'] = response.status
+            decompressor = None
+            if (response.getheader('content-encoding') or '').lower() == 'gzip':
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            if output is not None and int(response.status) in success:
+                if offset and int(response.status) == 200:
+                    # The server ignored the range and sent everything; start over
+                    output.seek(0)
+                    output.truncate()
+                response_page = None
+                written = 0
+                # httplib takes a connection closed early for the end of a body read in chunks; know what to expect
+                expected = response.getheader('content-length')
+                if expected is not None:
+                    expected = int(expected)
+                elif (response.getheader('content-range') or '').startswith('bytes '):
+                    first, last = response.getheader('content-range')[6:].split('/', 1)[0].split('-')
+                    expected = int(last) - int(first) + 1
+                while True:
+                    chunk = response.read(CHUNKSIZE)
+                    if not chunk:
+                        break
+                    received += len(chunk)
+                    progress['streamed'] += len(chunk)
+                    if decompressor is not None:
+                        chunk = decompressor.decompress(chunk)
+                    output.write(chunk)
+                    written += len(chunk)
+                if expected is not None and received < expected:
+                    raise HTTPException("Connection closed after %d of %d bytes of the reply to %s" % (
+                        received, expected, target))
+                if decompressor is not None:
+                    chunk = decompressor.flush()
+                    output.write(chunk)
+                    written += len(chunk)
+            else:
+                response_page = response.read()
+                received = len(response_page)
+                if decompressor is not None:
+                    response_page = decompressor.decompress(response_page) + decompressor.flush()
+        except Exception as e:
+            self.metrics.request(target, default_timer() - started, len(params or ''), received, failed=True)
+            self.pool.discard(connection)
+            if exchange is not None:
+                self.trace.failed(exchange, default_timer() - started, e)
+                self.trace.dump("%s %s failed: %r" % (method, target, e))
+            raise
+        self.pool.put(connection)
+        self.metrics.request(target, default_timer() - started, len(params or ''), received,
+                             failed=int(response.status) not in success)
+        if exchange is not None:
+            self.trace.response(exchange, default_timer() - started, response, response_page,
+                                received if response_page is None else len(response_page))
 
-        response = self.connection.getresponse()
-        response_page = response.read()
         if self.debug is True:
             self.logger.debug("Response: %s %s" % (response.status, response.reason))
             self.logger.debug("Response headers:")
             _log_headers(response.getheaders())
-            self.logger.debug(response_page)
-
-        if int(response.status) != 200:
-            if int(response.status) == 403:
-                # Session times out?
-                if self.login():
-                    return self._request(method, target, params)
-                else:
-                    raise LoginError("Login credentials needed to access: ", target)
-
-            raise RequestError("Error sending request:", response)
-
-        return response_page
-
-    def _rparse(self, parsed):
-        """
-        Recursively parse XML and generate an interable hybrid dictionary/list with all data.
-
-        @type   parsed:     xml.etree.ElementTree.Element
-        @param  parsed:     An ElementTree Element object of the parsed XML.
-        """
-        result = dict()
-        # Iterate over each element
-        for element in parsed.getchildren():
-            # If the element has children, use a dictionary
-            children = element.getchildren()
-            if len(children) > 0:
-                # We have children for this element
-                if type(result) is list:
-                    # Append the next parse, we're apparently in a list()
-                    result.append(self._rparse(element))
-                elif type(result) is dict and element.tag in result:
-                    # Change the dict() to a list() if we have multiple hits
-                    tmp = result
-                    result = list()
-                    # Iterate through the values in the dictionary, adding values only
-                    # - This reduces redundancy in parsed output (no outer tags)
-                    for val in tmp.itervalues():
-                        result.append(val)
-                else:
-                    result[element.tag] = dict()
-                    result[element.tag] = self._rparse(element)
+            if response_page is not None:
+                self.logger.debug(response_page)
             else:
-                result[element.tag] = element.text
-        return result
+                self.logger.debug("(%d bytes streamed to %r)" % (written, output))
 
-    def parse(self, response):
-        """
-        Parse the XML response from the server.
+        return response, response_page, written
 
-        @type   response:   string
-        @param  response:   Response XML from the server following a request.
+    def _parse(self, target, response):
         """
-        # Okay, for some reason there's a bug with how expat handles newlines
+        Parse a response with parse(), counting the time spent against its target path.
+        """
+        started = default_timer()
         try:
-            return self._rparse(xml.etree.ElementTree.fromstring(response.replace("\n", "")))
-        except Exception:
-            raise ParseError("Error parsing XML", response)
+            return self.parse(response)
+        except ParseError:
+            self.dumptrace("Unable to parse the response to %s" % target)
+            raise
+        finally:
+            self.metrics.parsed(target, default_timer() - started)
+
+    def _cached(self, target, key, fetch):
+        """
+        Return the cached reply for a read-only call, calling fetch() and caching its result on a miss.
+        """
+        if self.cache is None:
+            return fetch()
+        hit, value = self.cache.get(target, key)
+        if hit:
+            return value
+        value = fetch()
+        self.cache.put(target, key, value)
+        return value
+
+    def dumptrace(self, reason):
+        """
+        Log the exchanges kept by the trace ring, if tracing is on.
+
+        @type   reason: string
+        @param  reason: Why the trace is dumped.
+        """
+        if self.trace is not None:
+            self.trace.dump(reason)
 
     def login(self, seq=randint(SEQMIN, SEQMAX)):
         """
@@ -243,19 +1009,7 @@ class Scanner(object):
 
         params = urlencode({'login': self.username, 'password': self.password, 'seq': seq})
         response = self._request("POST", "/login", params)
-        parsed = self.parse(response)
-
-        contents = parsed['contents']
-        if parsed['status'] == "OK":
-            self.token = contents['token']  # Actual token value
-            user = contents['user']  # User dict (admin status, user name)
-            self.isadmin = user['admin']  # Is the logged in user an admin?
-
-            self.headers["Cookie"] = "token=%s" % self.token  # Persist token value for subsequent requests
-        else:
-            raise LoginError("Unable to login", contents)
-
-        return True
+        return self._handle_login(self._parse("/login", response))
 
     def logout(self, seq=randint(SEQMIN, SEQMAX)):
         """
@@ -265,13 +1019,10 @@ class Scanner(object):
         @param  seq:        A sequence number that will be echoed back for unique identification (optional).
         """
         params = urlencode({'seq': seq})
+        if self.cache is not None:
+            self.cache.invalidate()
         response = self._request("POST", "/logout", params)
-        parsed = self.parse(response)
-
-        if parsed['status'] == "OK" and parsed['contents'] == "OK":
-            return True
-        else:
-            return False
+        return self._handle_logout(self._parse("/logout", response))
 
     def policyList(self, seq=randint(SEQMIN, SEQMAX)):
         """
@@ -280,29 +1031,26 @@ class Scanner(object):
         @type   seq:        number
         @param  seq:        A sequence number that will be echoed back for unique identification (optional).
         """
-        params = urlencode({'seq': seq})
-        response = self._request("POST", "/policy/list", params)
-        parsed = self.parse(response)
-
-        contents = parsed['contents']
-        if parsed['status'] == "OK":
-            policies = contents['policies']  # Should be an iterable list of policies
-        else:
-            raise PolicyError("Unable to get policy list", contents)
-        return policies
+        def fetch():
+            params = urlencode({'seq': seq})
+            response = self._request("POST", "/policy/list", params)
+            return self._handle_policyList(self._parse("/policy/list", response))
+        return self._cached("/policy/list", None, fetch)
 
     def getErrors(self, scan, seq=randint(SEQMIN, SEQMAX)):
+        """
+        Fetch the errors reported for a scan.
 
-        params = urlencode({'report': scan['uuid'], 'seq': seq})
-        response = self._request("POST", "/report/errors", params)
-
-        parsed = self.parse(response)
-        contents = parsed['contents']
-
-        if parsed['status'] == "OK":
-            return contents['errors']  # Return the collected errors.
-        else:
-            raise ReportError("Unable to get error status for scan job: ", (scan['uuid'], contents['errors']))
+        @type   scan:       dict
+        @param  scan:       The scan, with its 'uuid'.
+        @type   seq:        number
+        @param  seq:        A sequence number that will be echoed back for unique identification (optional).
+        """
+        def fetch():
+            params = urlencode({'report': scan['uuid'], 'seq': seq})
+            response = self._request("POST", "/report/errors", params)
+            return self._handle_getErrors(self._parse("/report/errors", response), scan)
+        return self._cached("/report/errors", scan['uuid'], fetch)
 
     def scanNew(self, scan_name, target, policy_id, seq=randint(SEQMIN, SEQMAX)):
         """
@@ -319,18 +1067,18 @@ class Scanner(object):
         """
         params = urlencode({'target': target, 'policy_id': policy_id, 'scan_name': scan_name, 'seq': seq})
         response = self._request("POST", "/scan/new", params)
-        parsed = self.parse(response)
-
-        contents = parsed['contents']
-        if parsed['status'] == "OK":
-            return contents['scan']  # Return what you can about the scan
-        else:
-            raise ScanError("Unable to start scan", contents)
+        if self.cache is not None:
+            # The new scan shows up in the report list straight away
+            self.cache.invalidate("/report/list")
+        return self._handle_scanNew(self._parse("/scan/new", response))
 
     def quickScan(self, scan_name, target, policy_name, seq=randint(SEQMIN, SEQMAX)):
         """
         Configure a new scan using a canonical name for the policy. Perform a lookup for the policy ID and configure the
-        scan, starting it immediately.
+        scan, starting it immediately. Policy IDs come from the policy index, which is refreshed from policyList()
+        when it has expired or does not know the policy. When the server refuses a scan with an ID from the index,
+        the policy may have been recreated since: the index is refreshed and the scan tried once more with the new
+        ID.
 
         @type   scan_name:   string
         @param  scan_name:   The desired name of the scan.
@@ -341,23 +1089,27 @@ class Scanner(object):
         @type   seq:         number
         @param  seq:         A sequence number that will be echoed back for unique identification (optional).
         """
-        policies = self.policyList()
-        if type(policies) is dict:
-            # There appears to be only one configured policy
-            policy = policies['policy']
-            if policy['policyName'] == policy_name:
-                policy_id = policy['policyID']
-            else:
-                raise PolicyError("Unable to parse policies from policyList()", (scan_name, target, policy_name))
-        else:
-            # We have multiple policies configured
-            policy_id = None
-            for policy in policies:
-                if policy['policyName'] == policy_name:
-                    policy_id = policy['policyID']
-            if policy_id is None:
-                raise PolicyError("Unable to find policy", (scan_name, target, policy_name))
-        return self.scanNew(scan_name, target, policy_id, seq=seq)
+        policy_id = self.policies.get(policy_name)
+        if policy_id is None:
+            return self.scanNew(scan_name, target, self._lookup_policy(scan_name, target, policy_name), seq=seq)
+        try:
+            return self.scanNew(scan_name, target, policy_id, seq=seq)
+        except ScanError:
+            exc_info = sys.exc_info()
+        self.policies.invalidate()
+        fresh = self._lookup_policy(scan_name, target, policy_name)
+        if fresh == policy_id:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return self.scanNew(scan_name, target, fresh, seq=seq)
+
+    def _lookup_policy(self, scan_name, target, policy_name):
+        """
+        Look up a policy ID in a policy list fetched from the server rather than the response cache. The index
+        is only refreshed when its copy is stale or wrong, and a cached list is no fresher than the index.
+        """
+        if self.cache is not None:
+            self.cache.invalidate("/policy/list")
+        return self._policy_id(self.policyList(), scan_name, target, policy_name)
 
     def reportList(self, seq=randint(SEQMIN, SEQMAX)):
         """
@@ -366,36 +1118,138 @@ class Scanner(object):
         @type   seq:        number
         @param  seq:        A sequence number that will be echoed back for unique identification (optional).
         """
-        params = urlencode({'seq': seq})
-        response = self._request("POST", "/report/list", params)
-        parsed = self.parse(response)
-
-        contents = parsed['contents']
-        if parsed['status'] == "OK":
-            reports = contents['reports']
-            if type(reports) is dict:
-                # We've only got one report, put it into a list
-                temp = reports
-                reports = list()
-                reports.append(temp['report'])
-            return reports  # Return an iterable list of reports
-        else:
-            raise ReportError("Unable to get reports.", contents)
+        def fetch():
+            params = urlencode({'seq': seq})
+            response = self._request("POST", "/report/list", params)
+            return self._handle_reportList(self._parse("/report/list", response))
+        return self._cached("/report/list", None, fetch)
 
     def reportDownload(self, report, version="v2"):
         """
-        Download a report (XML) for a completed scan.
+        Download a report (XML) for a completed scan, gzip-compressed in transit when the server supports it.
 
         @type   report:     string
         @param  report:     The UUID of the report or completed scan.
         @type   version:    string
         @param  version:    The version of the .nessus XML file you wish to download.
         """
-        if version == "v1":
-            params = urlencode({'report': report, 'v1': version})
-        else:
-            params = urlencode({'report': report})
-        return self._request("POST", "/file/report/download", params)
+        return self._request("POST", "/file/report/download", self._download_params(report, version),
+                             compressed=True)
+
+    def reportDownloadTo(self, report, output, version="v2"):
+        """
+        Download a report (XML) for a completed scan, streaming it into a file in chunks so the report never
+        has to fit in memory. The transfer is gzip-compressed when the server supports it. Returns the number of
+        bytes written.
+
+        @type   report:     string
+        @param  report:     The UUID of the report or completed scan.
+        @type   output:     file
+        @param  output:     Any object with a write() method: an open file, an Archive.ZipMember, etc.
+        @type   version:    string
+        @param  version:    The version of the .nessus XML file you wish to download.
+        """
+        return self._request("POST", "/file/report/download", self._download_params(report, version), output,
+                             compressed=True)
+
+    def reportDownloadMany(self, reports, destination, concurrency=None, retries=3, version="v2"):
+        """
+        Download several reports at once, each streamed into its own file. A transfer that fails or is cut short
+        is retried on its own, resuming where it stopped when the server honours byte ranges, without holding up
+        the rest of the batch. Returns a dict keyed by report uuid with the 'bytes' saved, the 'seconds' taken,
+        the 'rate' in bytes per second, the number of 'attempts' and the last 'error' (None on success). Every
+        report gets its entry; errors other than transport failures are not retried.
+
+        @type   reports:        list
+        @param  reports:        The UUIDs of the reports or completed scans.
+        @type   destination:    function
+        @param  destination:    Called with each uuid, returns the path to save that report to.
+        @type   concurrency:    number
+        @param  concurrency:    The most downloads in flight at once; defaults to the size of the connection pool,
+                                which also caps it.
+        @type   retries:        number
+        @param  retries:        Further attempts at a transfer after the first one fails.
+        @type   version:        string
+        @param  version:        The version of the .nessus XML file you wish to download.
+        """
+        if concurrency is None:
+            concurrency = self.pool.size
+        queue = Queue()
+        for report in reports:
+            queue.put(report)
+        results = {}
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                try:
+                    report = queue.get_nowait()
+                except Empty:
+                    return
+                try:
+                    result = self._downloadresumable(report, destination(report), retries, version)
+                except Exception as e:
+                    # Whatever goes wrong is an error of this report alone, not the end of the worker
+                    self.logger.error("Download of report %s failed: %s" % (report, e))
+                    result = {'bytes': 0, 'seconds': 0.0, 'rate': 0.0, 'attempts': 1, 'error': e}
+                with lock:
+                    results[report] = result
+
+        threads = [threading.Thread(target=worker, name="download-%d" % i)
+                   for i in range(max(1, min(concurrency, len(reports))))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def _downloadresumable(self, report, path, retries, version):
+        """
+        Download one report for reportDownloadMany(), retrying as needed. Only this loop retries: each attempt
+        resumes from what the last one saved, which _request() retrying on its own could not do.
+        """
+        started = default_timer()
+        result = {'bytes': 0, 'seconds': 0.0, 'rate': 0.0, 'attempts': 0, 'error': None}
+        params = self._download_params(report, version)
+        output = open(path, "w+b")
+        try:
+            while result['attempts'] <= retries:
+                result['attempts'] += 1
+                # Resume after what an earlier attempt got, uncompressed since ranges count plain bytes
+                offset = output.tell()
+                try:
+                    self._request("POST", "/file/report/download", params, output, compressed=not offset,
+                                  offset=offset, retry=False)
+                except (IOError, HTTPException, RequestError) as e:
+                    result['error'] = e
+                    output.flush()
+                    if result['attempts'] > retries:
+                        self.logger.warning("Download of report %s failed (attempt %d of %d): %s" % (
+                            report, result['attempts'], retries + 1, e))
+                        break
+                    delay = self.retry.delay(result['attempts'])
+                    self.metrics.retry("/file/report/download")
+                    self.logger.warning("Download of report %s failed (attempt %d of %d): %s; retrying in %.2fs" % (
+                        report, result['attempts'], retries + 1, e, delay))
+                    sleep(delay)
+                    continue
+                except Exception as e:
+                    # A lost login, a corrupt gzip stream and the like are not cured by trying again
+                    result['error'] = e
+                    self.logger.warning("Download of report %s failed (attempt %d of %d): %s" % (
+                        report, result['attempts'], retries + 1, e))
+                    break
+                result['error'] = None
+                break
+            output.flush()
+            result['bytes'] = os.fstat(output.fileno()).st_size
+        finally:
+            output.close()
+        result['seconds'] = default_timer() - started
+        if result['seconds'] > 0:
+            result['rate'] = result['bytes'] / result['seconds']
+        return result
 
 
 # vim: expandtab sw=4 ts=4 ai
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Copyright (c) 2010 HomeAway, Inc.
+All rights reserved.  http://www.homeaway.com
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import threading
+from Queue import Queue
+from timeit import default_timer
+
+from Logger import get_logger
+
+# Marks the end of the input for a stage's workers
+_DONE = object()
+
+
+class Stage(object):
+    def __init__(self, name, func, workers=1, backlog=None):
+        """
+        One step of a Pipeline, run by its own pool of worker threads.
+
+        @type   name:       string
+        @param  name:       The name used in logs and timings.
+        @type   func:       function
+        @param  func:       Called with each item; its return value is handed to the next stage.
+        @type   workers:    number
+        @param  workers:    The number of threads running this stage.
+        @type   backlog:    number
+        @param  backlog:    The most items allowed to wait for this stage; upstream workers block once it is
+                            full (defaults to twice the number of workers).
+        """
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        if backlog is None:
+            backlog = self.workers * 2
+        self.queue = Queue(maxsize=backlog)
+        self.lock = threading.Lock()
+        self.remaining = self.workers  # Workers that have not seen the end of the input yet
+        self.count = 0  # Items processed
+        self.errors = 0  # Items that raised an exception
+        self.busy = 0.0  # Seconds spent inside func, summed over workers
+        self.slowest = 0.0  # Longest single call to func
+        self.started = None
+        self.finished = None
+
+    def timing(self):
+        """
+        Return a dict with the number of items and errors, the time spent working and the stage's wall clock time.
+        """
+        elapsed = 0.0
+        if self.started is not None and self.finished is not None:
+            elapsed = self.finished - self.started
+        return {'items': self.count,
+                'errors': self.errors,
+                'workers': self.workers,
+                'busy': self.busy,
+                'slowest': self.slowest,
+                'elapsed': elapsed}
+
+
+class Pipeline(object):
+    def __init__(self, stages, logger=None):
+        """
+        A chain of stages, each with its own bounded worker pool, so slow network-bound and CPU-bound steps
+        overlap instead of running one item at a time. An item that fails in a stage is logged and set aside in
+        self.failed, as a (stage name, item) pair, instead of going on to the next stage.
+
+        @type   stages:     list
+        @param  stages:     The Stage objects, in order.
+        """
+        self.stages = stages
+        self.logger = logger or get_logger('Pipeline')
+        self.results = []
+        self.failed = []
+
+    def run(self, items):
+        """
+        Push every item through all stages and return the output of the last stage, once everything is done.
+
+        @type   items:      iterable
+        @param  items:      The input for the first stage.
+        """
+        self.results = []
+        self.failed = []
+        threads = []
+        for position, stage in enumerate(self.stages):
+            for i in range(stage.workers):
+                thread = threading.Thread(target=self._work, args=(position, ), name="%s-%d" % (stage.name, i))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
+        first = self.stages[0]
+        for item in items:
+            first.queue.put(item)
+        for i in range(first.workers):
+            first.queue.put(_DONE)
+
+        for thread in threads:
+            thread.join()
+        return self.results
+
+    def _work(self, position):
+        stage = self.stages[position]
+        downstream = None
+        if position + 1 < len(self.stages):
+            downstream = self.stages[position + 1]
+
+        while True:
+            item = stage.queue.get()
+            if item is _DONE:
+                break
+
+            started = default_timer()
+            with stage.lock:
+                if stage.started is None:
+                    stage.started = started
+            try:
+                result = stage.func(item)
+            except Exception:
+                self.logger.exception("Stage '%s' failed" % stage.name)
+                failed = True
+            else:
+                failed = False
+            finished = default_timer()
+            with stage.lock:
+                stage.count += 1
+                stage.busy += finished - started
+                stage.slowest = max(stage.slowest, finished - started)
+                stage.finished = finished
+                if failed:
+                    stage.errors += 1
+                    self.failed.append((stage.name, item))
+            if failed:
+                continue
+
+            if downstream is not None:
+                downstream.queue.put(result)
+            else:
+                with stage.lock:
+                    self.results.append(result)
+
+        # The last worker out tells the next stage there is nothing more coming
+        with stage.lock:
+            stage.remaining -= 1
+            last = stage.remaining == 0
+        if last and downstream is not None:
+            for i in range(downstream.workers):
+                downstream.queue.put(_DONE)
+
+    def timings(self):
+        """
+        Return the timing of each stage as a list of (name, timing dict) pairs.
+        """
+        return [(stage.name, stage.timing()) for stage in self.stages]
+
+
+# vim: expandtab sw=4 ts=4 ai
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Copyright (c) 2010 HomeAway, Inc.
+All rights reserved.  http://www.homeaway.com
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import re
+import socket
+import struct
+import xml.etree.ElementTree
+from xml.sax.saxutils import quoteattr
+
+from Journal import scan_key
+
+# Nessus' compliance namespace, kept as the cm: prefix when report hosts are copied into a merged report
+CM_NAMESPACE = "http://www.nessus.org/cm"
+xml.etree.ElementTree.register_namespace('cm', CM_NAMESPACE)
+
+# Fields a planned scan carries through to its running and completed copies
+PLAN_FIELDS = ('group', 'part', 'parts', 'logical', 'members')
+
+# Scheduling fields of an input scan, kept by its parts
+SCHEDULE_FIELDS = ('priority', 'deadline')
+
+_address = re.compile(r'^\d{1,3}(\.\d{1,3}){3}$')
+
+
+def _aton(address):
+    return struct.unpack('!I', socket.inet_aton(address))[0]
+
+
+def _ntoa(number):
+    return socket.inet_ntoa(struct.pack('!I', number))
+
+
+def parse_target(target):
+    """
+    Break a Nessus target string into its parts: (first, last) address ranges as integers for CIDR blocks,
+    address ranges (10.0.0.1-10.0.0.20 or 10.0.0.1-20) and single addresses, and plain strings for anything
+    else, such as host names. Parts may be separated by commas, semicolons or white space.
+
+    @type   target: string
+    @param  target: A Nessus-compatible target string.
+    """
+    items = []
+    for token in re.split(r'[,;\s]+', target):
+        if not token:
+            continue
+        try:
+            if '/' in token:
+                address, bits = token.split('/', 1)
+                bits = int(bits)
+                if not _address.match(address) or not 0 <= bits <= 32:
+                    raise ValueError(token)
+                mask = (0xffffffff << (32 - bits)) & 0xffffffff
+                first = _aton(address) & mask
+                items.append((first, first | (~mask & 0xffffffff)))
+            elif '-' in token:
+                start, end = token.split('-', 1)
+                if not _address.match(start):
+                    raise ValueError(token)
+                first = _aton(start)
+                if _address.match(end):
+                    last = _aton(end)
+                else:
+                    last = (first & 0xffffff00) | int(end)
+                if last < first or int(end.split('.')[-1]) > 255:
+                    raise ValueError(token)
+                items.append((first, last))
+            elif _address.match(token):
+                items.append((_aton(token), _aton(token)))
+            else:
+                items.append(token)
+        except (ValueError, socket.error):
+            # Not something we can take apart; Nessus gets it as it is
+            items.append(token)
+    return items
+
+
+def count_hosts(items):
+    """
+    The number of hosts covered by the output of parse_target(); each name counts as one.
+    """
+    return sum(item[1] - item[0] + 1 if isinstance(item, tuple) else 1 for item in items)
+
+
+def format_target(items):
+    """
+    Turn parts from parse_target() back into a target string, using CIDR notation for aligned blocks.
+    """
+    tokens = []
+    for item in items:
+        if not isinstance(item, tuple):
+            tokens.append(item)
+            continue
+        first, last = item
+        size = last - first + 1
+        if first == last:
+            tokens.append(_ntoa(first))
+        elif size & (size - 1) == 0 and first % size == 0:
+            tokens.append("%s/%d" % (_ntoa(first), 32 - (size.bit_length() - 1)))
+        else:
+            tokens.append("%s-%s" % (_ntoa(first), _ntoa(last)))
+    return ",".join(tokens)
+
+
+def split_target(items, count):
+    """
+    Split the parts of a target into count chunks of as near the same number of hosts as possible.
+
+    @type   items:  list
+    @param  items:  The output of parse_target().
+    @type   count:  number
+    @param  count:  The number of chunks wanted.
+    """
+    total = count_hosts(items)
+    chunks = []
+    current = []
+    room = None
+    remaining = total
+    for item in items:
+        while True:
+            if room is None:
+                # Spread what is left evenly over the chunks still to be filled
+                room = -(-remaining // (count - len(chunks)))
+            if isinstance(item, tuple):
+                first, last = item
+                take = min(room, last - first + 1)
+                current.append((first, first + take - 1))
+                rest = (first + take, last) if first + take <= last else None
+            else:
+                take = 1
+                current.append(item)
+                rest = None
+            room -= take
+            remaining -= take
+            if room == 0:
+                chunks.append(current)
+                current = []
+                room = None
+            if rest is None:
+                break
+            item = rest
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class TargetPlanner(object):
+    def __init__(self, chunk=0, coalesce=0):
+        """
+        Reshape queued scans so each takes about the same time: targets larger than chunk hosts are split into
+        balanced parts whose reports are merged back together once all of them complete, and lines smaller than
+        coalesce hosts that share a policy are run together as one scan.
+
+        @type   chunk:      number
+        @param  chunk:      The most hosts in a single scan; 0 never splits.
+        @type   coalesce:   number
+        @param  coalesce:   Lines with fewer hosts than this are merged, up to this many hosts per scan; 0 never
+                            merges.
+        """
+        self.chunk = chunk
+        self.coalesce = coalesce
+
+    def plan(self, scans):
+        """
+        Yield the scans to queue for the given input scans, in roughly the same order.
+
+        @type   scans:  iterable
+        @param  scans:  The input scans, each a dict with 'name', 'target' and 'policy'.
+        """
+        pending = {}  # Policy -> (small scans waiting to be merged, their hosts)
+        for scan in scans:
+            items = parse_target(scan['target'])
+            hosts = count_hosts(items)
+            if self.chunk > 0 and hosts > self.chunk:
+                chunks = split_target(items, -(-hosts // self.chunk))
+                for number, chunk in enumerate(chunks):
+                    part = {'name': "%s (%d/%d)" % (scan['name'], number + 1, len(chunks)),
+                            'target': format_target(chunk),
+                            'policy': scan['policy'],
+                            'group': scan_key(scan),
+                            'part': number + 1,
+                            'parts': len(chunks),
+                            'logical': scan}
+                    part.update((k, scan[k]) for k in SCHEDULE_FIELDS + ('line',) if k in scan)
+                    yield part
+            elif self.coalesce > 0 and hosts < self.coalesce:
+                waiting, total = pending.get(scan['policy'], ([], 0))
+                if waiting and total + hosts > self.coalesce:
+                    yield self._merge(waiting)
+                    waiting, total = [], 0
+                waiting.append(scan)
+                pending[scan['policy']] = (waiting, total + hosts)
+            else:
+                yield scan
+        for waiting, total in pending.values():
+            yield self._merge(waiting)
+
+    def _merge(self, scans):
+        if len(scans) == 1:
+            return scans[0]
+        merged = {'name': "%s (+%d more)" % (scans[0]['name'], len(scans) - 1),
+                  'target': ",".join(scan['target'] for scan in scans),
+                  'policy': scans[0]['policy'],
+                  'members': [scan['name'] for scan in scans]}
+        if 'line' in scans[0]:
+            merged['line'] = scans[0]['line']
+        # The merged scan is as urgent as the most urgent of its lines
+        priorities = [scan['priority'] for scan in scans if 'priority' in scan]
+        if priorities:
+            merged['priority'] = max(priorities)
+        deadlines = [scan['deadline'] for scan in scans if 'deadline' in scan]
+        if deadlines:
+            merged['deadline'] = min(deadlines)
+        return merged
+
+
+def merge_reports(sources, output, name, target=None):
+    """
+    Stream several .nessus (v2) reports into one, as when a split scan's parts are put back together. The Policy
+    of the first report is kept, with its TARGET preference set to target when given; every ReportHost of every
+    report follows under a single Report. Hosts are copied one at a time, so memory use stays flat.
+
+    @type   sources:    list
+    @param  sources:    Paths of the reports to merge, in order.
+    @type   output:     string
+    @param  output:     Path of the merged report.
+    @type   name:       string
+    @param  name:       The name of the merged Report.
+    @type   target:     string
+    @param  target:     The target of the whole scan (optional).
+    """
+    tostring = xml.etree.ElementTree.tostring
+    opening = '<Report name=%s xmlns:cm="%s">\n' % (quoteattr(name), CM_NAMESPACE)
+    opened = False
+    out = open(output, "w")
+    try:
+        out.write('<?xml version="1.0" ?>\n<NessusClientData_v2>\n')
+        for number, source in enumerate(sources):
+            parent = None
+            for event, elem in xml.etree.ElementTree.iterparse(source, events=('start', 'end')):
+                if event == 'start':
+                    if elem.tag == 'Report':
+                        parent = elem
+                    continue
+                if elem.tag == 'Policy':
+                    if number == 0:
+                        for preference in elem.iter('preference'):
+                            if target is not None and preference.findtext('name') == 'TARGET':
+                                preference.find('value').text = target
+                        out.write(tostring(elem))
+                    elem.clear()
+                elif elem.tag == 'ReportHost':
+                    if not opened:
+                        out.write(opening)
+                        opened = True
+                    out.write(tostring(elem))
+                    elem.clear()
+                    if parent is not None:
+                        parent.remove(elem)
+        if not opened:
+            out.write(opening)
+        out.write('</Report>\n</NessusClientData_v2>\n')
+    finally:
+        out.close()
+
+
+# vim: expandtab sw=4 ts=4 ai
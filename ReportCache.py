@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Copyright (c) 2010 HomeAway, Inc.
+All rights reserved.  http://www.homeaway.com
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import os
+import gzip
+import json
+import hashlib
+import tempfile
+import threading
+from time import time
+
+from Logger import get_logger
+
+# Size of the reads used when copying a report out of the cache
+CHUNKSIZE = 64 * 1024
+
+
+class CacheWriter(object):
+    def __init__(self, cache, uuid, level):
+        """
+        A file-like object that gzip-compresses whatever is written to it into a new cache entry, hashing the
+        plain content as it goes. The entry only appears in the cache once close() is called.
+        """
+        self.cache = cache
+        self.uuid = uuid
+        handle, self.temporary = tempfile.mkstemp(suffix='.tmp', dir=cache.directory)
+        self.raw = os.fdopen(handle, 'wb')
+        self.compressed = gzip.GzipFile(fileobj=self.raw, mode='wb', compresslevel=level)
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.digest.update(data)
+        self.compressed.write(data)
+        self.size += len(data)
+
+    def close(self):
+        self.compressed.close()
+        self.raw.close()
+        self.cache._commit(self.uuid, self.temporary, self.digest.hexdigest())
+
+    def abort(self):
+        """
+        Throw away a partly written entry.
+        """
+        self.compressed.close()
+        self.raw.close()
+        os.remove(self.temporary)
+
+
+class Tee(object):
+    def __init__(self, *outputs):
+        """
+        A file-like object writing everything to each of outputs.
+        """
+        self.outputs = outputs
+
+    def write(self, data):
+        for output in self.outputs:
+            output.write(data)
+
+
+class ReportCache(object):
+    def __init__(self, directory, maxsize=2 * 1024 * 1024 * 1024, level=6):
+        """
+        Downloaded reports on disk, gzip-compressed and stored under the SHA-256 of their content, with an index
+        from report uuid to content. Reports with the same content are stored once. Once the compressed entries
+        outgrow maxsize, the least recently used ones are removed.
+
+        @type   directory:  string
+        @param  directory:  Where entries and the index (index.json) are kept; created when missing.
+        @type   maxsize:    number
+        @param  maxsize:    The most bytes of compressed entries kept.
+        @type   level:      number
+        @param  level:      The gzip compression level of new entries.
+        """
+        self.directory = directory
+        self.maxsize = maxsize
+        self.level = level
+        self.logger = get_logger('ReportCache')
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.indexfile = os.path.join(directory, 'index.json')
+        self.reports = {}  # Report uuid -> content digest
+        self.entries = {}  # Content digest -> [compressed size, last used]
+        if os.path.exists(self.indexfile):
+            try:
+                f = open(self.indexfile, 'r')
+                try:
+                    index = json.load(f)
+                finally:
+                    f.close()
+                self.reports = index['reports']
+                self.entries = index['entries']
+            except (ValueError, KeyError) as e:
+                self.logger.warning("Ignoring unreadable cache index '%s': %s" % (self.indexfile, e))
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest + '.xml.gz')
+
+    def _save(self):
+        # Callers hold the lock
+        temporary = self.indexfile + '.tmp'
+        f = open(temporary, 'w')
+        try:
+            json.dump({'reports': self.reports, 'entries': self.entries}, f)
+        finally:
+            f.close()
+        os.rename(temporary, self.indexfile)
+
+    def has(self, uuid):
+        """
+        Whether the report with this uuid is cached.
+        """
+        with self.lock:
+            digest = self.reports.get(uuid)
+            return digest is not None and os.path.exists(self._path(digest))
+
+    def writer(self, uuid):
+        """
+        Return a CacheWriter for the report with this uuid; the report is cached once it is closed.
+        """
+        return CacheWriter(self, uuid, self.level)
+
+    def open(self, uuid):
+        """
+        Return the cached report with this uuid as a readable file object, or None when it is not cached.
+        """
+        with self.lock:
+            digest = self.reports.get(uuid)
+            if digest is None or not os.path.exists(self._path(digest)):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries[digest][1] = time()
+            return gzip.open(self._path(digest), 'rb')
+
+    def extract(self, uuid, output):
+        """
+        Copy the cached report with this uuid into a file object, returning the number of bytes written, or None
+        when it is not cached.
+
+        @type   uuid:   string
+        @param  uuid:   The uuid of the report.
+        @type   output: file
+        @param  output: Any object with a write() method.
+        """
+        source = self.open(uuid)
+        if source is None:
+            return None
+        written = 0
+        try:
+            while True:
+                chunk = source.read(CHUNKSIZE)
+                if not chunk:
+                    break
+                output.write(chunk)
+                written += len(chunk)
+        finally:
+            source.close()
+        return written
+
+    def store(self, uuid, path):
+        """
+        Cache the report saved at path under this uuid, returning its size in bytes.
+        """
+        writer = self.writer(uuid)
+        written = 0
+        try:
+            source = open(path, 'rb')
+            try:
+                while True:
+                    chunk = source.read(CHUNKSIZE)
+                    if not chunk:
+                        break
+                    writer.write(chunk)
+                    written += len(chunk)
+            finally:
+                source.close()
+        except Exception:
+            writer.abort()
+            raise
+        writer.close()
+        return written
+
+    def _commit(self, uuid, temporary, digest):
+        path = self._path(digest)
+        with self.lock:
+            if os.path.exists(path):
+                # Same content as a report already cached
+                os.remove(temporary)
+            else:
+                os.rename(temporary, path)
+            self.reports[uuid] = digest
+            self.entries[digest] = [os.path.getsize(path), time()]
+            self._evict(digest)
+            self._save()
+
+    def _evict(self, keep):
+        # Callers hold the lock
+        total = sum(entry[0] for entry in self.entries.values())
+        for digest, entry in sorted(self.entries.items(), key=lambda item: item[1][1]):
+            if total <= self.maxsize:
+                break
+            if digest == keep:
+                continue
+            if os.path.exists(self._path(digest)):
+                os.remove(self._path(digest))
+            del self.entries[digest]
+            total -= entry[0]
+            for uuid in [uuid for uuid, value in self.reports.items() if value == digest]:
+                del self.reports[uuid]
+
+    def stats(self):
+        with self.lock:
+            return {'reports': len(self.reports),
+                    'entries': len(self.entries),
+                    'bytes': sum(entry[0] for entry in self.entries.values()),
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+    def close(self):
+        """
+        Write the index, saving when each entry was last used.
+        """
+        with self.lock:
+            self._save()
+
+
+# vim: expandtab sw=4 ts=4 ai
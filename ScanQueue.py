@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Copyright (c) 2010 HomeAway, Inc.
+All rights reserved.  http://www.homeaway.com
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import heapq
+import itertools
+from datetime import datetime
+from time import mktime
+
+# Formats accepted for a scan's deadline, besides seconds since the epoch
+DEADLINE_FORMATS = ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M', '%Y-%m-%d')
+
+
+def parse_deadline(value):
+    """
+    Seconds since the epoch for a deadline given as such, or as a local date and time (2026-10-20T06:00).
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for format in DEADLINE_FORMATS:
+        try:
+            return mktime(datetime.strptime(value, format).timetuple())
+        except ValueError:
+            continue
+    raise ValueError("Unrecognized deadline: %s" % value)
+
+
+def parse_scan(line):
+    """
+    Parse one line of an input file: name,target,policy, optionally followed by priority=N and deadline=WHEN
+    fields. The target may itself be a comma separated list. Returns None for blank lines and comments.
+
+    @type   line:   string
+    @param  line:   A line of the input file.
+    """
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    fields = line.split(',')
+    scan = {}
+    while len(fields) > 3 and fields[-1].strip().split('=', 1)[0] in ('priority', 'deadline'):
+        name, value = fields.pop().strip().split('=', 1)
+        if name == 'priority':
+            scan['priority'] = int(value)
+        else:
+            scan['deadline'] = parse_deadline(value)
+    scan.update({'name': fields[0], 'target': ','.join(fields[1:-1]), 'policy': fields[-1]})
+    return scan
+
+
+def read_scans(path):
+    """
+    Yield the scans of an input file one line at a time, so the file never has to fit in memory. Each scan has
+    its line number as 'line', which tells apart lines repeated in the input.
+
+    @type   path:   string
+    @param  path:   The input file.
+    """
+    f = open(path, "r")
+    try:
+        for number, line in enumerate(f, 1):
+            scan = parse_scan(line)
+            if scan is not None:
+                scan['line'] = number
+                yield scan
+    finally:
+        f.close()
+
+
+class ScanQueue(object):
+    def __init__(self, source=(), window=10000, accept=None):
+        """
+        Scans waiting to start, highest 'priority' first, then earliest 'deadline', then input order. Scans are
+        pulled from the source only as needed to keep window of them buffered, so memory stays bounded however
+        long the input is and each start costs O(log window). Priorities therefore order scans within the window
+        rather than across the whole input.
+
+        @type   source: iterable
+        @param  source: The scans, each a dict with 'name', 'target', 'policy' and optionally 'priority' (a
+                        number, default 0) and 'deadline' (seconds since the epoch).
+        @type   window: number
+        @param  window: The most scans buffered at once.
+        @type   accept: function
+        @param  accept: Called with each scan pulled from the source; scans it returns False for are dropped
+                        (optional).
+        """
+        self.source = iter(source)
+        self.window = max(1, window)
+        self.accept = accept
+        self.heap = []
+        self.order = itertools.count()
+        self.exhausted = False
+        self.pulled = 0  # Scans read from the source so far
+        self.dropped = 0  # Scans turned away by accept
+
+    def _fill(self):
+        while len(self.heap) < self.window and not self.exhausted:
+            try:
+                scan = next(self.source)
+            except StopIteration:
+                self.exhausted = True
+                break
+            self.pulled += 1
+            if self.accept is not None and not self.accept(scan):
+                self.dropped += 1
+                continue
+            self.push(scan)
+
+    def push(self, scan):
+        """
+        Queue a scan, whatever the window.
+        """
+        heapq.heappush(self.heap, (-scan.get('priority', 0), scan.get('deadline', float('inf')), next(self.order),
+                                   scan))
+
+    def peek(self):
+        """
+        Return the next scan to start without taking it off the queue, or None when the queue is empty.
+        """
+        self._fill()
+        if not self.heap:
+            return None
+        return self.heap[0][-1]
+
+    def pop(self):
+        """
+        Take the next scan to start off the queue.
+        """
+        self._fill()
+        return heapq.heappop(self.heap)[-1]
+
+    def pending(self):
+        """
+        The number of scans buffered; more may still be waiting in the source.
+        """
+        return len(self.heap)
+
+    def __nonzero__(self):
+        self._fill()
+        return len(self.heap) > 0
+
+    def __iter__(self):
+        """
+        Iterate over the buffered scans, in no particular order.
+        """
+        return iter([entry[-1] for entry in self.heap])
+
+
+# vim: expandtab sw=4 ts=4 ai
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Copyright (c) 2010 HomeAway, Inc.
+All rights reserved.  http://www.homeaway.com
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import re
+import threading
+from collections import deque
+from time import time
+
+from Logger import get_logger
+
+# Request parameters never written out by a dump
+SECRETS = ('password', )
+# Reply elements, and the headers, holding a session token; a body cut short may end inside the element
+SECRET_ELEMENTS = re.compile(r'(<token>)[^<]*(</token>|$)')
+SECRET_HEADERS = ('set-cookie', )
+
+
+class Exchange(object):
+    __slots__ = ('time', 'method', 'target', 'params', 'elapsed', 'status', 'reason', 'headers', 'body', 'size',
+                 'error')
+
+    def __init__(self, method, target, params):
+        """
+        One request and whatever came back for it. Nothing is formatted until the exchange is dumped.
+        """
+        self.time = time()
+        self.method = method
+        self.target = target
+        self.params = params
+        self.elapsed = None
+        self.status = None
+        self.reason = None
+        self.headers = None
+        self.body = None  # The first bytes of the response body
+        self.size = None  # The full size of the response body
+        self.error = None
+
+    def format(self):
+        params = self.params or ''
+        if any(secret + '=' in params for secret in SECRETS):
+            params = '&'.join(field.split('=', 1)[0] + '=***' if field.split('=', 1)[0] in SECRETS else field
+                              for field in params.split('&'))
+        lines = ["%.3f %s %s %s" % (self.time, self.method, self.target, params)]
+        if self.error is not None:
+            lines.append("  failed after %.3fs: %r" % (self.elapsed or 0.0, self.error))
+        if self.status is not None:
+            lines.append("  %s %s in %.3fs, %s bytes" % (self.status, self.reason, self.elapsed or 0.0, self.size))
+            for name, value in self.headers or ():
+                if name.lower() in SECRET_HEADERS:
+                    value = '***'
+                lines.append("  %s: %s" % (name, value))
+        if self.body is not None:
+            body = SECRET_ELEMENTS.sub(r'\1***\2', self.body)
+            if self.size is not None and self.size > len(self.body):
+                body += "... (%d more bytes)" % (self.size - len(self.body))
+            lines.append("  " + body.replace("\n", "\n  "))
+        return "\n".join(lines)
+
+
+class TraceRing(object):
+    def __init__(self, size=50, bodylimit=2048, logger=None):
+        """
+        The last few request/response exchanges of a Scanner, kept in a bounded ring. Only the first bodylimit
+        bytes of each body are kept and nothing is formatted until dump() is called, so tracing costs next to
+        nothing until something goes wrong.
+
+        @type   size:       number
+        @param  size:       The number of exchanges kept; older ones are dropped.
+        @type   bodylimit:  number
+        @param  bodylimit:  Bytes of each response body kept.
+        """
+        self.size = size
+        self.bodylimit = bodylimit
+        self.logger = logger or get_logger('Trace')
+        self.lock = threading.Lock()
+        self.ring = deque(maxlen=size)
+
+    def begin(self, method, target, params):
+        """
+        Record a request about to be sent; returns the Exchange to complete once the response is in.
+        """
+        exchange = Exchange(method, target, params)
+        with self.lock:
+            self.ring.append(exchange)
+        return exchange
+
+    def response(self, exchange, elapsed, response, body, size):
+        """
+        @type   exchange:   Exchange
+        @param  exchange:   The exchange returned by begin().
+        @type   response:   HTTPResponse
+        @param  response:   The response, for its status, reason and headers.
+        @type   body:       string
+        @param  body:       The response body, or None when it was streamed elsewhere.
+        @type   size:       number
+        @param  size:       The size of the whole body.
+        """
+        exchange.elapsed = elapsed
+        exchange.status = response.status
+        exchange.reason = response.reason
+        exchange.headers = response.getheaders()
+        exchange.size = size
+        if body is not None:
+            exchange.body = body[:self.bodylimit]
+
+    def failed(self, exchange, elapsed, error):
+        exchange.elapsed = elapsed
+        exchange.error = error
+
+    def dump(self, reason):
+        """
+        Log every exchange in the ring, oldest first, and empty it.
+
+        @type   reason: string
+        @param  reason: Why the ring is dumped; logged before the exchanges.
+        """
+        with self.lock:
+            exchanges = list(self.ring)
+            self.ring.clear()
+        if not exchanges:
+            return
+        self.logger.error("Dumping the last %d request(s): %s" % (len(exchanges), reason))
+        for exchange in exchanges:
+            self.logger.error(exchange.format())
+
+
+# vim: expandtab sw=4 ts=4 ai
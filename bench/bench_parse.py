@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Micro-benchmark for Scanner.parse() against recorded /report/list and /policy/list replies.
+
+The recorded payloads in bench/payloads/ are inflated to the requested number of entries so the parser can be
+timed against servers that keep thousands of reports around. The previous recursive parser (_rparse) is kept
+here as the baseline.
+
+    python bench/bench_parse.py -n 5000 -r 20
+"""
+import os
+import sys
+import xml.etree.ElementTree
+from optparse import OptionParser
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from NessusXMLRPC import Scanner
+
+PAYLOADS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'payloads')
+
+
+def legacy_rparse(parsed):
+    """
+    The recursive parser Scanner used before the single-pass parser, kept verbatim as the baseline.
+    """
+    result = dict()
+    for element in parsed.getchildren():
+        children = element.getchildren()
+        if len(children) > 0:
+            if type(result) is list:
+                result.append(legacy_rparse(element))
+            elif type(result) is dict and element.tag in result:
+                tmp = result
+                result = list()
+                for val in tmp.itervalues():
+                    result.append(val)
+            else:
+                result[element.tag] = dict()
+                result[element.tag] = legacy_rparse(element)
+        else:
+            result[element.tag] = element.text
+    return result
+
+
+def legacy_parse(response):
+    return legacy_rparse(xml.etree.ElementTree.fromstring(response.replace("\n", "")))
+
+
+def inflate(payload, container, tag, count):
+    """
+    Repeat the entries of a recorded payload until the container holds count of them.
+
+    @type   payload:    string
+    @param  payload:    The recorded reply.
+    @type   container:  string
+    @param  container:  The tag holding the repeated entries (reports, policies).
+    @type   tag:        string
+    @param  tag:        The tag of a single entry (report, policy).
+    @type   count:      number
+    @param  count:      The number of entries wanted in the inflated reply.
+    """
+    opening = "<%s>" % container
+    closing = "</%s>" % container
+    head, rest = payload.split(opening, 1)
+    body, tail = rest.split(closing, 1)
+    entry = "<%s>" % tag
+    entries = [entry + e for e in body.split(entry)[1:]]
+    inflated = [entries[i % len(entries)] for i in range(count)]
+    return "%s%s%s%s%s" % (head, opening, "".join(inflated), closing, tail)
+
+
+def timed(func, data, repeat):
+    best = None
+    for i in range(repeat):
+        started = default_timer()
+        func(data)
+        elapsed = default_timer() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-n", dest='count', type='int', default=2000, help="entries per inflated payload")
+    parser.add_option("-r", dest='repeat', type='int', default=10, help="runs per measurement (best is kept)")
+    (options, args) = parser.parse_args()
+
+    scanner = Scanner.__new__(Scanner)
+    for name, container, tag in (('report_list', 'reports', 'report'), ('policy_list', 'policies', 'policy')):
+        payload = inflate(open(os.path.join(PAYLOADS, name + '.xml')).read(), container, tag, options.count)
+        old = timed(legacy_parse, payload, options.repeat)
+        new = timed(scanner.parse, payload, options.repeat)
+        print "%-12s %6d entries %9d bytes  _rparse %8.2f ms  parse %8.2f ms  speedup %5.1fx" % (
+            name, options.count, len(payload), old * 1000, new * 1000, old / new)
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: expandtab sw=4 ts=4 ai
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Benchmark suite run against the local fake Nessus server (bench/fakenessus.py), so no real daemon is needed.
+
+It measures:
+    latency     Scanner request latency (sequential) and throughput (concurrent, over the connection pool)
+    parse       Scanner.parse() throughput on a /report/list reply
+    iscomplete  the cost of one Nessus.iscomplete() poll against a server holding many reports
+    report      end-to-end Nessus.report() time: download, transform, compress and email
+
+Results are printed as a single JSON document (or written with -o) so runs can be compared over time.
+
+    python bench/bench_suite.py -o results.json
+    python bench/bench_suite.py --only latency,parse --latency 0.005
+"""
+import os
+import sys
+import ssl
+import json
+import smtpd
+import shutil
+import asyncore
+import platform
+import tempfile
+import threading
+from optparse import OptionParser
+from time import sleep, time
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from NessusXMLRPC import Scanner
+from ScanQueue import ScanQueue
+from fakenessus import FakeNessus, report_list
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+BENCHMARKS = ('latency', 'parse', 'iscomplete', 'report')
+
+# Just enough of a stylesheet for the transform stage to do real work on every ReportItem
+STYLESHEET = """<?xml version="1.0"?>
+<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+<xsl:template match="/">
+<html><body><table>
+<xsl:for-each select="//ReportHost/ReportItem">
+<tr><td><xsl:value-of select="../@name"/></td><td><xsl:value-of select="@port"/></td>
+<td><xsl:value-of select="@pluginName"/></td><td><xsl:value-of select="@severity"/></td></tr>
+</xsl:for-each>
+</table></body></html>
+</xsl:template>
+</xsl:stylesheet>
+"""
+
+CONFIG = """[core]
+server = bench
+port = %(port)d
+user = nessus
+password = nessus
+logfile = %(tempdir)s/nessus.log
+loglevel = error
+limit = %(limit)d
+sleepmax = 60
+sleepmin = 1
+noderetry = 1
+poolsize = %(poolsize)d
+
+[server bench]
+host = 127.0.0.1
+
+# Every iscomplete() poll has to reach the server
+[cache]
+/report/list = 0
+
+[smtp]
+to = bench@localhost
+from = bench@localhost
+server = 127.0.0.1
+port = %(smtpport)d
+
+[report]
+outputdir = %(tempdir)s
+xsltproc = xsltproc
+xsltlog = %(tempdir)s/xsltproc.log
+xsl = %(tempdir)s/bench.xsl
+"""
+
+
+class SMTPSink(smtpd.SMTPServer):
+    """
+    Accepts and discards every message, so report delivery can be timed.
+    """
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.messages = 0
+        self.thread = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.1}, name='smtpsink')
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def port(self):
+        return self.socket.getsockname()[1]
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages += 1
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def summarize(samples):
+    """
+    Latency statistics, in milliseconds, of a list of durations in seconds.
+    """
+    return {'count': len(samples),
+            'mean_ms': 1000.0 * sum(samples) / len(samples),
+            'p50_ms': 1000.0 * percentile(samples, 0.50),
+            'p95_ms': 1000.0 * percentile(samples, 0.95),
+            'p99_ms': 1000.0 * percentile(samples, 0.99),
+            'max_ms': 1000.0 * max(samples)}
+
+
+def nessus(server, tempdir, limit=4, poolsize=4, smtpport=25):
+    """
+    A Nessus orchestrator configured against the fake server.
+    """
+    import nessus
+    configfile = os.path.join(tempdir, 'nessus.conf')
+    f = open(configfile, 'w')
+    f.write(CONFIG % {'port': server.port, 'tempdir': tempdir, 'limit': limit, 'poolsize': poolsize,
+                      'smtpport': smtpport})
+    f.close()
+    return nessus.Nessus(configfile, [])
+
+
+def bench_latency(options, tempdir):
+    server = FakeNessus(latency=options.latency, reports=options.reports).start()
+    try:
+        scanner = Scanner('127.0.0.1', server.port, 'nessus', 'nessus', poolsize=options.poolsize)
+        scanner.policyList()  # Warm up the connection
+
+        samples = []
+        for i in range(options.requests):
+            started = default_timer()
+            scanner.policyList()
+            samples.append(default_timer() - started)
+        sequential = summarize(samples)
+
+        # The same number of requests again, from one thread per pooled connection
+        per_thread = max(1, options.requests // options.poolsize)
+
+        def worker():
+            for i in range(per_thread):
+                scanner.policyList()
+
+        threads = [threading.Thread(target=worker) for i in range(options.poolsize)]
+        started = default_timer()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = default_timer() - started
+        scanner.logout()
+        return {'server_latency_ms': options.latency * 1000,
+                'sequential': sequential,
+                'concurrent': {'threads': options.poolsize,
+                               'requests': per_thread * options.poolsize,
+                               'elapsed_s': elapsed,
+                               'requests_per_s': per_thread * options.poolsize / elapsed}}
+    finally:
+        server.stop()
+
+
+def bench_parse(options, tempdir):
+    payload = ('<?xml version="1.0"?>\n<reply>\n<seq>1</seq>\n<status>OK</status>\n'
+               '<contents><reports>%s</reports></contents>\n</reply>\n' % report_list(options.reports))
+    scanner = Scanner.__new__(Scanner)
+    best = None
+    for i in range(options.repeat):
+        started = default_timer()
+        scanner.parse(payload)
+        elapsed = default_timer() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return {'reports': options.reports,
+            'bytes': len(payload),
+            'best_ms': best * 1000,
+            'reports_per_s': options.reports / best,
+            'mb_per_s': len(payload) / best / (1024 * 1024)}
+
+
+def bench_iscomplete(options, tempdir):
+    # Scans never finish, so every poll walks the full list without anything changing
+    server = FakeNessus(latency=options.latency, reports=options.reports, duration=86400).start()
+    try:
+        x = nessus(server, tempdir, limit=options.poolsize, poolsize=options.poolsize)
+        x.scans = ScanQueue({'name': 'bench %d' % i, 'target': '10.0.%d.0/24' % i, 'policy': 'Quick Scan'}
+                            for i in range(options.poolsize))
+        x.start()
+
+        started = default_timer()
+        x.iscomplete()
+        first = default_timer() - started
+        samples = []
+        for i in range(options.repeat):
+            started = default_timer()
+            x.iscomplete()
+            samples.append(default_timer() - started)
+        x.close()
+        result = summarize(samples)
+        result.update({'reports': options.reports, 'first_poll_ms': first * 1000})
+        return result
+    finally:
+        server.stop()
+
+
+def bench_report(options, tempdir):
+    if lxml_etree is None and not any(os.access(os.path.join(path, 'xsltproc'), os.X_OK)
+                                      for path in os.environ.get('PATH', '').split(os.pathsep)):
+        return {'skipped': 'neither lxml nor xsltproc is available'}
+    f = open(os.path.join(tempdir, 'bench.xsl'), 'w')
+    f.write(STYLESHEET)
+    f.close()
+
+    server = FakeNessus(latency=options.latency, duration=0, hosts=options.hosts, items=options.items,
+                        gzip=options.gzip).start()
+    sink = SMTPSink()
+    try:
+        x = nessus(server, tempdir, limit=options.scans, poolsize=options.poolsize, smtpport=sink.port)
+        x.scans = ScanQueue({'name': 'bench %d' % i, 'target': '10.0.%d.0/24' % i, 'policy': 'Quick Scan'}
+                            for i in range(options.scans))
+        x.start()
+        deadline = time() + 60
+        while not x.iscomplete() and time() < deadline:
+            sleep(0.05)
+        scans = len(x.scans_complete)
+
+        started = default_timer()
+        timings = x.report()
+        elapsed = default_timer() - started
+        x.close()
+        return {'scans': scans,
+                'report_bytes': len(server.report),
+                'inprocess': x.inprocess,
+                'elapsed_s': elapsed,
+                'reports_per_s': scans / elapsed,
+                'emails': sink.messages,
+                'stages': dict(timings)}
+    finally:
+        sink.close()
+        server.stop()
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--only", help="comma separated benchmarks to run (%s)" % ', '.join(BENCHMARKS))
+    parser.add_option("-o", dest='output', help="write the JSON results to this file instead of stdout")
+    parser.add_option("--latency", type='float', default=0.0, help="seconds the fake server adds to each reply")
+    parser.add_option("--requests", type='int', default=500, help="requests for the latency benchmark")
+    parser.add_option("--poolsize", type='int', default=4, help="connections (and threads) per scanner")
+    parser.add_option("--reports", type='int', default=10000, help="reports held by the server")
+    parser.add_option("--scans", type='int', default=8, help="scans reported on by the report benchmark")
+    parser.add_option("--hosts", type='int', default=50, help="hosts in each downloaded report")
+    parser.add_option("--items", type='int', default=20, help="report items per host")
+    parser.add_option("--gzip", action='store_true', default=False, help="serve reports gzip-encoded")
+    parser.add_option("-r", dest='repeat', type='int', default=10, help="runs per measurement")
+    (options, args) = parser.parse_args()
+
+    selected = BENCHMARKS
+    if options.only:
+        selected = [name.strip() for name in options.only.split(',') if name.strip()]
+        unknown = set(selected) - set(BENCHMARKS)
+        if unknown:
+            parser.error("unknown benchmark(s): %s" % ', '.join(sorted(unknown)))
+
+    # The fake server uses a self-signed certificate
+    if hasattr(ssl, '_create_unverified_context'):
+        ssl._create_default_https_context = ssl._create_unverified_context
+
+    tempdir = tempfile.mkdtemp(prefix='nessusbench')
+    results = {}
+    try:
+        for name in selected:
+            started = default_timer()
+            results[name] = globals()['bench_' + name](options, tempdir)
+            sys.stderr.write("%-10s done in %.2fs\n" % (name, default_timer() - started))
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+    document = {'timestamp': time(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'options': dict((key, value) for key, value in vars(options).items() if key != 'output'),
+                'results': results}
+    output = sys.stdout
+    if options.output:
+        output = open(options.output, 'w')
+    json.dump(document, output, indent=2, sort_keys=True)
+    output.write("\n")
+    if output is not sys.stdout:
+        output.close()
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: expandtab sw=4 ts=4 ai
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+A local stand-in for the Nessus XMLRPC server, for benchmarks and for trying nessus.py without a real daemon.
+
+It implements /login, /logout, /policy/list, /scan/new, /report/list, /report/errors and /file/report/download
+over HTTPS with keep-alive. Every reply can be delayed by a fixed latency, the report list can be padded with any
+number of finished reports, and the size of the downloaded .nessus report is set by its hosts and items per host.
+Report downloads honour byte ranges, and a share of them can be cut off halfway to exercise client retries.
+Scans finish a fixed number of seconds after they are started.
+
+    python bench/fakenessus.py -P 8834 --reports 10000 --latency 0.02
+
+Without --cert/--key a throwaway self-signed certificate is made with the openssl binary.
+"""
+import os
+import ssl
+import sys
+import zlib
+import uuid
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import subprocess
+import BaseHTTPServer
+import SocketServer
+from optparse import OptionParser
+from time import sleep, time
+from urlparse import parse_qsl
+from xml.sax.saxutils import escape
+
+
+def nessus_report(hosts, items, seed=1):
+    """
+    Build a .nessus (v2) report with the given number of hosts and report items per host.
+
+    @type   hosts:  number
+    @param  hosts:  The number of ReportHost elements.
+    @type   items:  number
+    @param  items:  The number of ReportItem elements per host.
+    """
+    rand = random.Random(seed)
+    out = ['<?xml version="1.0" ?>\n<NessusClientData_v2>\n'
+           '<Policy><policyName>Full Scan</policyName>\n<Preferences><ServerPreferences>\n'
+           '<preference><name>TARGET</name><value>10.0.0.0/16</value></preference>\n'
+           '</ServerPreferences></Preferences></Policy>\n'
+           '<Report name="fake scan" xmlns:cm="http://www.nessus.org/cm">\n']
+    for h in range(hosts):
+        address = "10.0.%d.%d" % (h // 256, h % 256)
+        out.append('<ReportHost name="%s"><HostProperties><tag name="host-ip">%s</tag></HostProperties>\n' % (
+            address, address))
+        for i in range(items):
+            plugin = rand.randint(10000, 10500)
+            out.append('<ReportItem port="%d" svc_name="www" protocol="tcp" severity="%d" pluginID="%d" '
+                       'pluginName="Plugin %d" pluginFamily="General"><description>Fake finding</description>'
+                       '<plugin_output>%s</plugin_output></ReportItem>\n' % (
+                           rand.choice([0, 22, 80, 443]), rand.randint(0, 4), plugin, plugin, 'x' * 200))
+        out.append('</ReportHost>\n')
+    out.append('</Report>\n</NessusClientData_v2>\n')
+    return ''.join(out)
+
+
+def report_list(reports):
+    """
+    The <report> entries of a /report/list reply for the given number of finished reports.
+
+    @type   reports:    number
+    @param  reports:    The number of completed reports to list.
+    """
+    return ''.join('<report><name>%s</name><readableName>Old scan %d</readableName>'
+                   '<status>completed</status><timestamp>%d</timestamp></report>' % (
+                       uuid.UUID(int=i), i, 1288110712 + i) for i in range(reports))
+
+
+class FakeNessusHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Buffer each reply and send it in one go; unbuffered header writes stall on Nagle and delayed ACKs
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, body, status=200, encoding=None, headers=(), truncate=False):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml')
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if truncate:
+            # Hang up halfway through, as a dropped WAN link would
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = 1
+            # Close the TLS session cleanly, so only the length of the body gives the cut away
+            try:
+                self.connection.unwrap()
+            except (ssl.SSLError, socket.error):
+                pass
+            return
+        self.wfile.write(body)
+
+    def reply(self, contents, status='OK'):
+        self.send_body('<?xml version="1.0"?>\n<reply>\n<seq>%s</seq>\n<status>%s</status>\n'
+                       '<contents>%s</contents>\n</reply>\n' % (self.params.get('seq', 1), status, contents))
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length', 0))
+        self.params = dict(parse_qsl(self.rfile.read(length)))
+        if server.latency:
+            sleep(server.latency)
+        with server.lock:
+            server.calls[self.path] = server.calls.get(self.path, 0) + 1
+        if server.outage > time():
+            self.send_body('', 503)
+            return
+
+        if self.path == '/login':
+            if self.params.get('login') != server.login or self.params.get('password') != server.password:
+                self.reply('', 'ERROR')
+                return
+            token = uuid.uuid4().hex
+            with server.lock:
+                server.tokens.add(token)
+            self.reply('<token>%s</token><user><name>%s</name><admin>TRUE</admin></user>' % (token, server.login))
+            return
+
+        # Everything else needs the session cookie handed out by /login
+        cookie = self.headers.get('Cookie', '')
+        token = cookie.split('token=', 1)[-1].split(';', 1)[0] if 'token=' in cookie else None
+        if token not in server.tokens:
+            self.send_body('', 403)
+            return
+
+        if self.path == '/logout':
+            with server.lock:
+                server.tokens.discard(token)
+            self.reply('OK')
+        elif self.path == '/policy/list':
+            self.reply('<policies>%s</policies>' % ''.join(
+                '<policy><policyID>%d</policyID><policyName>%s</policyName><policyOwner>%s</policyOwner>'
+                '<visibility>shared</visibility></policy>' % (i + 1, escape(name), server.login)
+                for i, name in enumerate(server.policies)))
+        elif self.path == '/scan/new':
+            if self.params.get('policy_id') not in [str(i + 1) for i in range(len(server.policies))]:
+                self.reply('<error>Invalid policy</error>', 'ERROR')
+                return
+            report = str(uuid.uuid4())
+            with server.lock:
+                server.scans.append((report, self.params.get('scan_name', ''), time() + server.duration))
+            self.reply('<scan><uuid>%s</uuid><owner>%s</owner><start_time>%d</start_time><scan_name>%s</scan_name>'
+                       '</scan>' % (report, server.login, time(), escape(self.params.get('scan_name', ''))))
+        elif self.path == '/report/list':
+            self.reply('<reports>%s%s</reports>' % (server.padding, server.report_list()))
+        elif self.path == '/report/errors':
+            self.reply('<errors></errors>')
+        elif self.path == '/file/report/download':
+            truncate = server.drop and random.random() < server.drop
+            ranged = self.headers.get('Range', '')
+            if ranged.startswith('bytes=') and ranged.endswith('-') and ranged[6:-1].isdigit():
+                start = min(int(ranged[6:-1]), len(server.report))
+                self.send_body(server.report[start:], 206, truncate=truncate, headers=[
+                    ('Content-Range', 'bytes %d-%d/%d' % (start, len(server.report) - 1, len(server.report)))])
+            elif server.gzip and 'gzip' in self.headers.get('Accept-Encoding', ''):
+                self.send_body(server.compressed(), encoding='gzip', truncate=truncate)
+            else:
+                self.send_body(server.report, truncate=truncate)
+        else:
+            self.reply('', 'ERROR')
+
+
+class FakeNessus(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, duration=1.0, reports=0, hosts=20, items=10,
+                 login='nessus', password='nessus', policies=('Full Scan', 'Quick Scan'), certfile=None, keyfile=None,
+                 gzip=False, drop=0.0):
+        """
+        @type   latency:    number
+        @param  latency:    Seconds every request is delayed by before it is answered.
+        @type   duration:   number
+        @param  duration:   Seconds a scan runs before its report is listed as completed.
+        @type   reports:    number
+        @param  reports:    Finished reports already on the server, padding every /report/list reply.
+        @type   hosts:      number
+        @param  hosts:      Hosts in the report returned by /file/report/download.
+        @type   items:      number
+        @param  items:      Report items per host in that report.
+        @type   certfile:   string
+        @param  certfile:   PEM certificate for TLS; a self-signed one is made when neither file is given.
+        @type   gzip:       bool
+        @param  gzip:       Send reports gzip-encoded to clients that accept it.
+        @type   drop:       number
+        @param  drop:       Share (0 to 1) of report downloads cut off halfway through.
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), FakeNessusHandler)
+        self.latency = latency
+        self.duration = duration
+        self.login = login
+        self.password = password
+        self.policies = list(policies)
+        self.lock = threading.Lock()
+        self.tokens = set()
+        self.scans = []  # (uuid, name, finish time) of every scan started through /scan/new
+        self.calls = {}  # Requests answered, per path
+        self.padding = report_list(reports)
+        self.report = nessus_report(hosts, items)
+        self.gzip = gzip
+        self.gzipped = None
+        self.drop = drop
+        self.outage = 0  # Every request is answered with a 503 until this time, as an overloaded daemon would
+
+        self.tempdir = None
+        if certfile is None and keyfile is None:
+            self.tempdir = tempfile.mkdtemp(prefix='fakenessus')
+            certfile = os.path.join(self.tempdir, 'cert.pem')
+            keyfile = os.path.join(self.tempdir, 'key.pem')
+            subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                                   '-subj', '/CN=localhost', '-keyout', keyfile, '-out', certfile],
+                                  stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+        self.socket = ssl.wrap_socket(self.socket, keyfile=keyfile, certfile=certfile, server_side=True)
+        self.thread = None
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up mid-reply are routine in benchmarks; keep them off stderr
+        pass
+
+    def report_list(self):
+        now = time()
+        with self.lock:
+            scans = list(self.scans)
+        return ''.join('<report><name>%s</name><readableName>%s</readableName><status>%s</status>'
+                       '<timestamp>%d</timestamp></report>' % (
+                           report, escape(name), 'completed' if finish <= now else 'running', finish)
+                       for report, name, finish in scans)
+
+    def compressed(self):
+        """
+        The report, gzip-encoded; compressed once and kept unless the report changes.
+        """
+        with self.lock:
+            if self.gzipped is None or self.gzipped[0] is not self.report:
+                compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                self.gzipped = (self.report, compressor.compress(self.report) + compressor.flush())
+            return self.gzipped[1]
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        """
+        Serve from a background thread; returns the server.
+        """
+        self.thread = threading.Thread(target=self.serve_forever, name='fakenessus')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.tempdir is not None:
+            shutil.rmtree(self.tempdir, ignore_errors=True)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-H", dest='host', default='127.0.0.1', help="address to listen on")
+    parser.add_option("-P", dest='port', type='int', default=8834, help="port to listen on")
+    parser.add_option("--latency", type='float', default=0.0, help="seconds added to every reply")
+    parser.add_option("--duration", type='float', default=60.0, help="seconds each scan runs")
+    parser.add_option("--reports", type='int', default=0, help="finished reports padding /report/list")
+    parser.add_option("--hosts", type='int', default=20, help="hosts in the downloaded report")
+    parser.add_option("--items", type='int', default=10, help="report items per host")
+    parser.add_option("--gzip", action='store_true', default=False, help="gzip reports for clients accepting it")
+    parser.add_option("--drop", type='float', default=0.0, help="share of report downloads cut off halfway")
+    parser.add_option("--login", default='nessus', help="user name accepted by /login")
+    parser.add_option("--password", default='nessus', help="password accepted by /login")
+    parser.add_option("--cert", dest='certfile', help="PEM certificate (default: self-signed)")
+    parser.add_option("--key", dest='keyfile', help="PEM private key")
+    (options, args) = parser.parse_args()
+
+    server = FakeNessus(options.host, options.port, options.latency, options.duration, options.reports,
+                        options.hosts, options.items, options.login, options.password,
+                        certfile=options.certfile, keyfile=options.keyfile, gzip=options.gzip,
+                        drop=options.drop)
+    print "Fake Nessus server listening on https://%s:%d/" % (options.host, server.port)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: expandtab sw=4 ts=4 ai
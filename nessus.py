@@ -19,42 +19,238 @@ limitations under the License.
 import sys
 import subprocess
 import os
-import smtplib
+import signal
 import logging
 import socket
 import zipfile
+import threading
 import xml.etree.ElementTree
 import ConfigParser
-import chardet
+from cStringIO import StringIO
 from optparse import OptionParser
-from random import randint
-from time import sleep
+from random import uniform
+from time import sleep, time
+from httplib import HTTPException
 from datetime import date
-from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
-from email.mime.text import MIMEText
-from email.header import Header
-from email import Encoders
 from exceptions import KeyError
 
-from NessusXMLRPC import Scanner, ParseError
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+from NessusXMLRPC import Scanner, ResponseCache, RetryPolicy, CircuitBreaker, ParseError, RequestError, LoginError, \
+    ReportError
 from Logger import setup_logger, get_logger
+from Pipeline import Pipeline, Stage
+from Archive import zipfile_write
+from Delivery import Mailer
+from Journal import Journal, scan_key, LAUNCHED, COMPLETED, DELIVERED
+from Metrics import write_metrics
+from Planner import TargetPlanner, merge_reports, PLAN_FIELDS
+from ScanQueue import ScanQueue, read_scans
+from Findings import FindingsIndex
+from Delta import diff
+from ReportCache import ReportCache
 
 
 default_timeout = 180
 
+# Errors that mean a scanner node is unreachable or unhealthy, rather than a problem with the scan itself
+node_errors = (socket.error, HTTPException, RequestError, LoginError)
+
+# Report windows in which a completed scan is tried before giving up on its report for this run
+REPORT_ATTEMPTS = 3
+
+# Compiled XSL stylesheets, keyed by path, shared by every in-process transform
+stylesheets = {}
+stylesheets_lock = threading.Lock()
+
+
+def stylesheet(path):
+    """
+    Return the compiled XSLT for the stylesheet at path, compiling it the first time it is asked for.
+
+    @type   path:   string
+    @param  path:   The XSL stylesheet on disk.
+    """
+    with stylesheets_lock:
+        xslt = stylesheets.get(path)
+        if xslt is None:
+            xslt = lxml_etree.XSLT(lxml_etree.parse(path))
+            stylesheets[path] = xslt
+        return xslt
+
+
+class ScannerNode(object):
+    def __init__(self, name, host, port, user, password, limit, timeout=None, debug=False, poolsize=1, retry=300,
+                 trace=0, tracebody=2048, cache=None, retrypolicy=None, breaker=None):
+        """
+        A single Nessus server taking part in a scan run, with its own concurrency limit.
+
+        @type   name:       string
+        @param  name:       The name of the node as listed in [core] server.
+        @type   host:       string
+        @param  host:       The hostname of the Nessus server.
+        @type   port:       number
+        @param  port:       The port number for the XMLRPC interface on the Nessus server.
+        @type   limit:      number
+        @param  limit:      The most scans allowed to run on this node at once.
+        @type   retry:      number
+        @param  retry:      Seconds to leave a node alone after it stops responding.
+        @type   trace:      number
+        @param  trace:      Recent exchanges kept in the scanner's trace ring; 0 disables tracing.
+        @type   cache:      ResponseCache
+        @param  cache:      Cache for the node's read-only calls (optional).
+        @type   retrypolicy: RetryPolicy
+        @param  retrypolicy: How the node's failed requests are retried (optional).
+        @type   breaker:    CircuitBreaker
+        @param  breaker:    The node's circuit breaker, kept across reconnects (optional).
+        """
+        self.name = name
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.limit = limit
+        self.timeout = timeout
+        self.debug = debug
+        self.poolsize = poolsize
+        self.retry = retry
+        self.trace = trace
+        self.tracebody = tracebody
+        self.cache = cache
+        self.retrypolicy = retrypolicy
+        self.breaker = breaker
+
+        self.scanner = None
+        self.running = 0  # Scans currently running on this node.
+        self.down_until = 0  # While in the future, the node is considered down.
+        self.reports = {}  # Last seen status of every report on the node, keyed by uuid.
+
+    def connect(self):
+        """
+        Log in to the node unless we already have a scanner for it. Raises one of node_errors on failure.
+        """
+        if self.scanner is None:
+            self.scanner = Scanner(self.host, self.port, self.user, self.password, timeout=self.timeout,
+                                   debug=self.debug, poolsize=self.poolsize, trace=self.trace,
+                                   tracebody=self.tracebody, cache=self.cache, retry=self.retrypolicy,
+                                   breaker=self.breaker)
+        return self.scanner
+
+    def available(self):
+        return self.down_until <= time()
+
+    def has_capacity(self):
+        return self.available() and self.running < self.limit
+
+    def load(self):
+        return float(self.running) / self.limit
+
+    def failed(self):
+        """
+        Mark the node down for a while and drop its connections.
+        """
+        self.down_until = time() + self.retry
+        if self.scanner is not None:
+            self.scanner.pool.close()
+
+    def recovered(self):
+        self.down_until = 0
+
+    def changes(self, reports):
+        """
+        Fold the output of reportList() into the report index and return the (uuid, status) pairs that changed
+        since the previous poll. The index is only updated once every report has been read, so a malformed reply
+        leaves it as it was and its changes are seen again on the next poll.
+
+        @type   reports:    list
+        @param  reports:    The reports as returned by reportList().
+        """
+        changed = []
+        index = self.reports
+        for report in reports:
+            uuid = report['name']
+            status = report['status']
+            if index.get(uuid) != status:
+                changed.append((uuid, status))
+        index.update(changed)
+        return changed
+
+
+class PollScheduler(object):
+    def __init__(self, pollmin, pollmax, estimate):
+        """
+        Decide how long to wait before the next completion poll. Each running scan is expected to take about as
+        long as earlier scans with the same policy did; the wait halves as that expected completion nears, stays
+        at pollmin once a scan is due and backs off again for scans that keep running well past their estimate.
+
+        @type   pollmin:    number
+        @param  pollmin:    The shortest wait between polls, which caps the request rate to the servers.
+        @type   pollmax:    number
+        @param  pollmax:    The longest wait between polls.
+        @type   estimate:   number
+        @param  estimate:   Expected scan duration in seconds for policies without any history yet.
+        """
+        self.pollmin = pollmin
+        self.pollmax = max(pollmin, pollmax)
+        self.estimate = estimate
+        self.durations = {}  # Smoothed observed scan duration per policy name
+
+    def expected(self, policy):
+        return self.durations.get(policy, self.estimate)
+
+    def observe(self, policy, duration):
+        """
+        Fold the duration of a completed scan into the estimate for its policy.
+
+        @type   policy:     string
+        @param  policy:     The name of the policy the scan ran with.
+        @type   duration:   number
+        @param  duration:   Seconds between starting the scan and seeing it complete.
+        """
+        if policy in self.durations:
+            self.durations[policy] = 0.7 * self.durations[policy] + 0.3 * duration
+        else:
+            self.durations[policy] = duration
+
+    def next_poll(self, running, now=None):
+        """
+        Return the number of seconds to sleep before polling again.
+
+        @type   running:    list
+        @param  running:    The running scans, each with 'started' and 'policy' keys.
+        """
+        if not running:
+            return self.pollmin
+        if now is None:
+            now = time()
+        remaining = min(scan['started'] + self.expected(scan['policy']) - now for scan in running)
+        if remaining > 0:
+            wait = remaining / 2.0
+        else:
+            # Overdue; keep polling often at first, backing off the longer the scan overruns
+            wait = -remaining / 4.0
+        wait = max(self.pollmin, min(self.pollmax, wait))
+        # A little jitter keeps several orchestrators from polling in lockstep
+        return wait * uniform(0.9, 1.1)
+
 
 class Nessus(object):
     def __init__(self, configfile, scans, debug=False, timeout=None):
         """
         @type   configfile:     string
         @param  configfile:     Full path to a configuration file for loading defaults
-        @type   scans:          list
-        @param  scans:          A list() of scans assembled with all necessary context
+        @type   scans:          iterable
+        @param  scans:          The scans to run, assembled with all necessary context; a list or a generator such
+                                as ScanQueue.read_scans(), which is only read as far as the queue needs.
         """
-        self.scans_running = []  # Scans currently running.
+        self.scans_running = {}  # Scans currently running, keyed by uuid.
         self.scans_complete = []  # Scans that have completed.
-        self.scans = scans  # Scans that remain to be started.
+        self.digested = []  # Reports waiting to go out in the digest.
+        self.partial = {}  # Completed parts of split scans still waiting for their siblings, keyed by group.
+        self.scans = None  # Scans that remain to be started, a ScanQueue.
 
         self.started = False  # Flag for telling when scanning has started.
 
@@ -85,8 +281,8 @@ class Nessus(object):
         self.debug("CONF configfile = %s" % configfile)
         self.debug("Logger initiated; Logfile: %s, Loglevel: %s" % (self.logfile, self.loglevel))
 
-        self.server = self.config.get('core', 'server')
-        self.debug("CONF core.server = %s" % self.server)
+        self.servers = [server.strip() for server in self.config.get('core', 'server').split(',') if server.strip()]
+        self.debug("CONF core.server = %s" % ', '.join(self.servers))
         self.port = self.config.getint('core', 'port')
         self.debug("CONF core.port = %s" % self.port)
         self.user = self.config.get('core', 'user')
@@ -99,6 +295,93 @@ class Nessus(object):
         self.debug("CONF core.sleepmax = %d" % self.sleepmax)
         self.sleepmin = self.config.getint('core', 'sleepmin')
         self.debug("CONF core.sleepmin = %d" % self.sleepmin)
+        # How long a node that stopped responding is left alone, apart from how often scans are polled
+        self.noderetry = 300
+        if self.config.has_option('core', 'noderetry'):
+            self.noderetry = self.config.getint('core', 'noderetry')
+        self.debug("CONF core.noderetry = %d" % self.noderetry)
+        self.pollmin = 30
+        if self.config.has_option('core', 'pollmin'):
+            self.pollmin = self.config.getint('core', 'pollmin')
+        self.debug("CONF core.pollmin = %d" % self.pollmin)
+        self.estimate = 3600
+        if self.config.has_option('core', 'estimate'):
+            self.estimate = self.config.getint('core', 'estimate')
+        self.debug("CONF core.estimate = %d" % self.estimate)
+        self.scheduler = PollScheduler(self.pollmin, self.sleepmax, self.estimate)
+        # Launches, completions and deliveries are journaled here so an interrupted run can be resumed
+        self.journal = None
+        if self.config.has_option('core', 'journal'):
+            self.journal = Journal(self.config.get('core', 'journal'))
+            self.debug("CONF core.journal = %s" % self.journal.path)
+        self.poolsize = 1
+        if self.config.has_option('core', 'poolsize'):
+            self.poolsize = self.config.getint('core', 'poolsize')
+        self.debug("CONF core.poolsize = %d" % self.poolsize)
+        # Per-endpoint request metrics of every node are written here after each polling window
+        self.metrics = None
+        if self.config.has_option('core', 'metrics'):
+            self.metrics = self.config.get('core', 'metrics')
+        self.debug("CONF core.metrics = %s" % self.metrics)
+        # Recent exchanges kept per node and logged only when something fails, or on SIGUSR1
+        self.trace = 0
+        if self.config.has_option('core', 'trace'):
+            self.trace = self.config.getint('core', 'trace')
+        self.debug("CONF core.trace = %d" % self.trace)
+        self.tracebody = 2048
+        if self.config.has_option('core', 'tracebody'):
+            self.tracebody = self.config.getint('core', 'tracebody')
+        self.debug("CONF core.tracebody = %d" % self.tracebody)
+        # Set by the SIGUSR1 handler; the traces are dumped from the main loop, never from the handler itself
+        self.tracerequested = False
+        # Seconds to cache each read-only call for, by target path, and the most replies cached per node
+        self.cachettls = {}
+        self.cachesize = 256
+        if self.config.has_section('cache'):
+            for option in self.config.options('cache'):
+                if option == 'size':
+                    self.cachesize = self.config.getint('cache', 'size')
+                else:
+                    self.cachettls[option] = self.config.getint('cache', option)
+        self.debug("CONF cache = %s, size = %d" % (self.cachettls, self.cachesize))
+        # Retries of failed requests, and the circuit breaker failing fast while a node is unhealthy
+        self.retrypolicy = RetryPolicy()
+        self.failures = 5
+        self.cooldown = 60
+        if self.config.has_section('retry'):
+            if self.config.has_option('retry', 'attempts'):
+                self.retrypolicy.attempts = self.config.getint('retry', 'attempts')
+            if self.config.has_option('retry', 'backoff'):
+                self.retrypolicy.backoff = self.config.getfloat('retry', 'backoff')
+            if self.config.has_option('retry', 'backoffmax'):
+                self.retrypolicy.backoffmax = self.config.getfloat('retry', 'backoffmax')
+            if self.config.has_option('retry', 'logins'):
+                self.retrypolicy.logins = self.config.getint('retry', 'logins')
+            if self.config.has_option('retry', 'failures'):
+                self.failures = self.config.getint('retry', 'failures')
+            if self.config.has_option('retry', 'cooldown'):
+                self.cooldown = self.config.getint('retry', 'cooldown')
+        self.debug("CONF retry.attempts = %d, retry.backoff = %s, retry.backoffmax = %s, retry.logins = %d" % (
+            self.retrypolicy.attempts, self.retrypolicy.backoff, self.retrypolicy.backoffmax,
+            self.retrypolicy.logins))
+        self.debug("CONF retry.failures = %d, retry.cooldown = %d" % (self.failures, self.cooldown))
+        # Split targets larger than plan.chunk hosts, run lines smaller than plan.coalesce hosts together
+        self.chunk = 0
+        self.coalesce = 0
+        if self.config.has_option('plan', 'chunk'):
+            self.chunk = self.config.getint('plan', 'chunk')
+        if self.config.has_option('plan', 'coalesce'):
+            self.coalesce = self.config.getint('plan', 'coalesce')
+        self.debug("CONF plan.chunk = %d, plan.coalesce = %d" % (self.chunk, self.coalesce))
+        self.planner = TargetPlanner(self.chunk, self.coalesce)
+        if self.chunk > 0 or self.coalesce > 0:
+            scans = self.planner.plan(scans)
+        # The most queued scans held in memory; the rest of the input is read as scans start
+        self.window = 10000
+        if self.config.has_option('plan', 'window'):
+            self.window = self.config.getint('plan', 'window')
+        self.debug("CONF plan.window = %d" % self.window)
+        self.scans = ScanQueue(scans, self.window)
 
         if self.config.has_option('core', 'timeput'):
             if self.timeout is not None and self.timeout == default_timeout:
@@ -118,6 +401,12 @@ class Nessus(object):
         self.debug("CONF smtp.smtpserver = %s" % self.smtpserver)
         self.smtpport = self.config.getint('smtp', 'port')
         self.debug("CONF smtp.smtpport = %d" % self.smtpport)
+        # Send every report completed in a polling window as one message, rather than one message per report
+        self.digest = False
+        if self.config.has_option('smtp', 'digest'):
+            self.digest = self.config.getboolean('smtp', 'digest')
+        self.debug("CONF smtp.digest = %s" % self.digest)
+        self.mailer = Mailer(self.smtpserver, self.smtpport, self.emailfrom, self.emailto)
 
         # Reporting settings
         self.reports = self.config.get('report', 'outputdir')
@@ -128,20 +417,123 @@ class Nessus(object):
         self.debug("CONF report.xsltlog = %s" % self.xsltlog)
         self.xsl = self.config.get('report', 'xsl')
         self.debug("CONF report.xsl = %s" % self.xsl)
+        self.xsltlock = threading.Lock()
+        # Transform in-process with lxml when it is available, falling back to the xsltproc binary
+        self.inprocess = lxml_etree is not None
+        if self.inprocess and self.config.has_option('report', 'inprocess'):
+            self.inprocess = self.config.getboolean('report', 'inprocess')
+        self.debug("CONF report.inprocess = %s" % self.inprocess)
+
+        # Every downloaded report is also streamed into this SQLite index of hosts and findings
+        self.findings = None
+        if self.config.has_option('report', 'findings'):
+            self.findings = FindingsIndex(self.config.get('report', 'findings'))
+            self.debug("CONF report.findings = %s" % self.findings.path)
+
+        # Downloaded reports are kept here, compressed, and served from disk when asked for again
+        self.reportcache = None
+        if self.config.has_option('report', 'cache'):
+            cachesize = 2048
+            if self.config.has_option('report', 'cachesize'):
+                cachesize = self.config.getint('report', 'cachesize')
+            self.reportcache = ReportCache(self.config.get('report', 'cache'), cachesize * 1024 * 1024)
+            self.debug("CONF report.cache = %s, report.cachesize = %d MB" % (self.reportcache.directory, cachesize))
+
+        # Compare each report with the previous one for the same scan name; deltaonly mails just the changes
+        self.delta = False
+        if self.config.has_option('report', 'delta'):
+            self.delta = self.config.getboolean('report', 'delta')
+        self.deltaonly = False
+        if self.delta and self.config.has_option('report', 'deltaonly'):
+            self.deltaonly = self.config.getboolean('report', 'deltaonly')
+        self.debug("CONF report.delta = %s, report.deltaonly = %s" % (self.delta, self.deltaonly))
+
+        self.ziplevel = 6
+        if self.config.has_option('report', 'ziplevel'):
+            self.ziplevel = self.config.getint('report', 'ziplevel')
+        self.debug("CONF report.ziplevel = %d" % self.ziplevel)
+
+        # Workers for each stage of the report pipeline (downloads default to one per pooled connection)
+        self.downloaders = self.poolsize
+        if self.config.has_option('report', 'downloaders'):
+            self.downloaders = self.config.getint('report', 'downloaders')
+        self.debug("CONF report.downloaders = %d" % self.downloaders)
+        self.transformers = 2
+        if self.config.has_option('report', 'transformers'):
+            self.transformers = self.config.getint('report', 'transformers')
+        self.debug("CONF report.transformers = %d" % self.transformers)
+        self.compressors = 2
+        if self.config.has_option('report', 'compressors'):
+            self.compressors = self.config.getint('report', 'compressors')
+        self.debug("CONF report.compressors = %d" % self.compressors)
+        # Further attempts at a report download cut short before it is given up on
+        self.retries = 3
+        if self.config.has_option('report', 'retries'):
+            self.retries = self.config.getint('report', 'retries')
+        self.debug("CONF report.retries = %d" % self.retries)
+
+        # Scanner nodes; each may override port, user, password, limit and poolsize in a [server <name>] section
+        self.info("Nessus scanner started.")
+        self.nodes = []
+        for server in self.servers:
+            section = "server %s" % server
+            node = ScannerNode(server,
+                               self._nodeoption(section, 'host', self.config.get, server),
+                               self._nodeoption(section, 'port', self.config.getint, self.port),
+                               self._nodeoption(section, 'user', self.config.get, self.user),
+                               self._nodeoption(section, 'password', self.config.get, self.password),
+                               self._nodeoption(section, 'limit', self.config.getint, self.limit),
+                               timeout=self.timeout, debug=self.debugging,
+                               poolsize=self._nodeoption(section, 'poolsize', self.config.getint, self.poolsize),
+                               retry=self.noderetry, trace=self.trace, tracebody=self.tracebody,
+                               cache=ResponseCache(self.cachettls, self.cachesize), retrypolicy=self.retrypolicy,
+                               breaker=CircuitBreaker(self.failures, self.cooldown))
+            self.debug("CONF %s: host = %s, port = %s, limit = %d" % (server, node.host, node.port, node.limit))
+            self.nodes.append(node)
+            self._connectnode(node)
+        self.nodemap = dict((node.name, node) for node in self.nodes)
+
+        if not [node for node in self.nodes if node.scanner is not None]:
+            self.error("Unable to connect to any Nessus server: %s" % ', '.join(self.servers))
+            sys.exit(1)
 
-        self.debug("PARSED scans: %s" % self.scans)
+    def _nodeoption(self, section, option, getter, default):
+        """
+        Read a per-node setting, falling back to the [core] value.
+        """
+        if self.config.has_section(section) and self.config.has_option(section, option):
+            return getter(section, option)
+        return default
 
+    def _connectnode(self, node):
+        """
+        Make sure we are logged in to a node, marking it down if it cannot be reached.
+        """
         try:
-            self.info("Nessus scanner started.")
-            self.scanner = Scanner(self.server, self.port, self.user, self.password, timeout=self.timeout,
-                                   debug=self.debugging)
-            self.info(
-                "Connected to Nessus server; authenticated to server '%s' as user '%s'" % (self.server, self.user))
-        except socket.error as (errno, strerror):
+            node.connect()
+        except node_errors as e:
             self.error(
-                "Socket error encountered while connecting to Nessus server: %s. User: '%s', Server: '%s', Port: %s" % (
-                    strerror, self.user, self.server, self.port))
-            sys.exit(1)
+                "Error encountered while connecting to Nessus server: %s. User: '%s', Server: '%s', Port: %s" % (
+                    e, node.user, node.host, node.port))
+            node.failed()
+            return False
+        self.info("Connected to Nessus server; authenticated to server '%s' as user '%s'" % (node.host, node.user))
+        return True
+
+    def _picknode(self):
+        """
+        Return the least loaded node that is up and below its own limit, or None if all are busy.
+        """
+        candidates = [node for node in self.nodes if node.has_capacity()]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda node: node.load())
+
+    def capacity(self):
+        """
+        The total number of scans all available nodes may run at once.
+        """
+        return sum(node.limit for node in self.nodes if node.available())
 
     def start(self):
         """
@@ -149,16 +541,81 @@ class Nessus(object):
         """
         self.started = True
 
-        if len(self.scans) > 1:
+        if self.scans_running is None:
+            self.scans_running = {}
+
+        if self.journal is not None:
+            self.recover()
+
+        if self.scans and self.scans.pending() > 1:
             self.info("Starting with multiple scans")
         else:
             self.info("Starting with a single scan")
 
-        if self.scans_running is None:
-            self.scans_running = []
-
         return self.resume()
 
+    def recover(self):
+        """
+        Replay the journal of an interrupted run. Scans the server still knows about are adopted instead of being
+        launched again and completed scans that were never reported are queued for reporting; both, and scans
+        whose report was delivered, are dropped from the input as the queue reads it. Scans the server no longer
+        has are started again.
+        """
+        state = self.journal.replay()
+        if not state:
+            return
+
+        handled = set()  # Keys of the scans the journal accounts for
+        launched = {}  # Node name -> [(key, journal entry)]
+        for key, entry in state.items():
+            if entry['event'] == DELIVERED:
+                handled.add(key)
+            elif entry['node'] not in self.nodemap:
+                self.warning("Scan '%s' was started on '%s', which is no longer configured; starting it again" % (
+                    entry['name'], entry['node']))
+            else:
+                launched.setdefault(entry['node'], []).append((key, entry))
+        if handled:
+            self.info("Skipping %d scan(s) whose report was already delivered" % len(handled))
+
+        for name, entries in launched.items():
+            node = self.nodemap[name]
+            statuses = None
+            if node.available():
+                try:
+                    node.changes(node.connect().reportList())
+                    statuses = node.reports
+                except node_errors as e:
+                    self.error("Error polling '%s' while recovering: %s" % (node.name, e))
+                    node.failed()
+                except ParseError as e:
+                    self.error("%s; %s" % (e.info, e.contents))
+
+            for key, entry in entries:
+                status = None
+                if statuses is not None:
+                    status = statuses.get(entry['uuid'])
+                    if status is None:
+                        self.warning("Scan '%s' (%s) is gone from '%s'; starting it again" % (
+                            entry['name'], entry['uuid'], node.name))
+                        continue
+                handled.add(key)
+                recovered = dict((k, entry[k]) for k in ('uuid', 'scan_name', 'owner', 'node', 'policy', 'started'))
+                recovered.update((k, entry[k]) for k in PLAN_FIELDS if k in entry)
+                if entry['event'] == COMPLETED or status == 'completed':
+                    if entry['event'] != COMPLETED:
+                        self.journal.record(COMPLETED, uuid=entry['uuid'])
+                    self.info("Scan '%s' (%s) completed but was never reported; reporting it" % (
+                        entry['name'], entry['uuid']))
+                    self.scans_complete.append(recovered)
+                else:
+                    self.info("Adopting scan '%s' (%s), still running on '%s'" % (entry['name'], entry['uuid'],
+                                                                                   node.name))
+                    node.running += 1
+                    self.scans_running[entry['uuid']] = recovered
+
+        self.scans.accept = lambda scan: scan_key(scan) not in handled
+
     def stop(self):
         """
         We have a start() so we most certainly should have a stop(). This should prevent scans from being continued.
@@ -167,145 +624,472 @@ class Nessus(object):
 
     def resume(self):
         """
-        Basically gets scans going, observing the limit.
-        """
-        if self.started and len(self.scans) > 0 and len(self.scans_running) < self.limit:
-            count = len(self.scans_running)
-            for scan in self.scans:
-                if self._startscan(scan):
-                    count += 1
-                if count == self.limit:
-                    self.warning("Concurrent scan limit reached (currently set at %d)" % self.limit)
-                    self.warning("Will monitor scans and continue as possible")
-                    break
+        Basically gets scans going, placing each one on the least loaded node and observing every node's limit.
+        Scans leave the queue in priority order.
+        """
+        while self.started and self.scans:
+            node = self._picknode()
+            if node is None:
+                self.warning("Concurrent scan limit reached on all nodes (currently set at %d)" % self.capacity())
+                self.warning("Will monitor scans and continue as possible")
+                break
+            if not self._startscan(self.scans.peek(), node) and node.available():
+                # The node is fine but would not take the scan; leave it queued until the next poll
+                break
         return self.scans_running
 
-    def _startscan(self, scan):
+    def _startscan(self, scan, node):
         """
-        Start a specific scan in the scans list.
+        Start the scan at the head of the queue on the given node. If the node does not respond, it is marked
+        down and the scan stays queued for another node.
         """
-        currentscan = self.scanner.quickScan(scan['name'], scan['target'], scan['policy'])
+        if node.scanner is None and not self._connectnode(node):
+            return False
+        try:
+            currentscan = node.scanner.quickScan(scan['name'], scan['target'], scan['policy'])
+        except node_errors as e:
+            self.error("Scanner node '%s' failed while starting scan '%s': %s" % (node.name, scan['name'], e))
+            self.error("Moving queued scans off '%s' for %d seconds" % (node.name, node.retry))
+            node.failed()
+            return False
         if currentscan is not None:
-            self.info(
-                "Scan successfully started; Owner: '%s', Name: '%s'" % (currentscan['owner'], currentscan['scan_name']))
+            self.info("Scan successfully started on '%s'; Owner: '%s', Name: '%s'" % (
+                node.name, currentscan['owner'], currentscan['scan_name']))
         else:
             self.error("Unable to start scan. Name: '%s', Target: '%s', Policy: '%s'" % (
                 scan['name'], scan['target'], scan['policy']))
             return False
 
         # Add the newly started scan to the running least, remove it from the remaining
-        self.scans_running.append(currentscan)
-        self.scans.remove(scan)
+        self.scans.pop()
+        if scan.get('deadline') is not None and scan['deadline'] < time():
+            self.warning("Scan '%s' started after its deadline" % scan['name'])
+        currentscan['node'] = node.name
+        currentscan['policy'] = scan['policy']
+        currentscan['started'] = time()
+        currentscan.update((k, scan[k]) for k in PLAN_FIELDS if k in scan)
+        node.running += 1
+        self.scans_running[currentscan['uuid']] = currentscan
+        if self.journal is not None:
+            plan = dict((k, scan[k]) for k in PLAN_FIELDS if k in scan)
+            self.journal.record(LAUNCHED, key=scan_key(scan), name=scan['name'], target=scan['target'],
+                                policy=scan['policy'], uuid=currentscan['uuid'], scan_name=currentscan['scan_name'],
+                                owner=currentscan['owner'], node=node.name, started=currentscan['started'], **plan)
         return True
 
     def iscomplete(self):
         """
         Check for the completion of of running scans. Also, if there are scans left to be run, resume and run them.
         """
-        try:
-            reports = self.scanner.reportList()
-        except socket.error as (errno, strerror):
-            self.error("Socket error; %s" % strerror)
-            self.error("Invalidating connection and sleeping before we continue")
-            self.scanner.connection.close()
-            self.scanner.connection = None
-            sleep(randint(self.sleepmin, self.sleepmax))
-            return False
-        except ParseError as e:
-            self.error("%s; %s" % (e.info, e.contents))
-            self.error("Continuing...")
-            return False
-        for scan in self.scans_running:
+        for node in self.nodes:
+            if node.running == 0 or not node.available():
+                continue
+            try:
+                reports = node.connect().reportList()
+            except node_errors as e:
+                self.error("Error polling '%s'; %s" % (node.name, e))
+                self.error("Invalidating connections to '%s' and retrying in %d seconds" % (node.name, node.retry))
+                node.failed()
+                continue
+            except ParseError as e:
+                self.error("%s; %s" % (e.info, e.contents))
+                self.error("Continuing...")
+                continue
+            node.recovered()
             try:
-                for report in reports:
-                    if report['status'] == 'completed' and scan['uuid'] == report['name']:
-                        self.scans_complete.append(scan)
-                        self.scans_running.remove(scan)
-            except KeyError:
-                self.error("KeyError when parsing XML from reportList(); continuing")
-                return False
+                changed = node.changes(reports)
+            except (KeyError, TypeError) as e:
+                self.error("Malformed reportList() from '%s' (%r); continuing" % (node.name, e))
+                continue
+            # Only reports whose status changed since the last poll need looking at
+            for uuid, status in changed:
+                scan = self.scans_running.get(uuid)
+                if status == 'completed' and scan is not None and scan['node'] == node.name:
+                    self.scheduler.observe(scan['policy'], time() - scan['started'])
+                    self.scans_complete.append(scan)
+                    del self.scans_running[uuid]
+                    if self.journal is not None:
+                        self.journal.record(COMPLETED, uuid=uuid)
+                    node.running -= 1
 
         # Check to see if we're running under the limit and we have scans remaining.
         # If so, run more scans up to the limit and continue.
 
-        if len(self.scans_running) < self.limit and len(self.scans) > 0 and self.started:
+        if self._picknode() is not None and self.scans and self.started:
             self.info("We can run more scans, resuming")
             self.resume()
 
-        elif len(self.scans_running) > 0:
+        elif len(self.scans_running) > 0 or self.scans:
             return False
         else:
             return True
 
+    def nextpoll(self):
+        """
+        Seconds to sleep before the next call to iscomplete().
+        """
+        return self.scheduler.next_poll(self.scans_running.values())
+
     def report(self):
         """
-        Report on currently completed scans.
+        Report on currently completed scans. Reports flow through a pipeline of download, transform, compress and
+        deliver stages, each with its own workers, so one report can be downloading while another is rendered.
+        All the emails of one call go out over a single SMTP session, or as a single digest message when
+        smtp.digest is set. A scan whose report fails on the way is queued again for the next call, up to
+        REPORT_ATTEMPTS times in all. Returns the timing of each stage.
         """
-        for scan in self.scans_complete:
-            pname = scan['scan_name'].replace(' ', '')
+        completed, self.scans_complete = self.scans_complete, []
+        batch = []
+        for scan in completed:
+            if 'group' in scan:
+                # A part of a split scan; report the whole scan once its last part is in
+                parts = self.partial.setdefault(scan['group'], [])
+                parts.append(scan)
+                if len(parts) < scan['parts']:
+                    continue
+                del self.partial[scan['group']]
+                scan = self._mergedscan(parts)
+            batch.append(scan)
+        self.digested = []
+        stages = [Stage('download', self._download, self.downloaders)]
+        if self.findings is not None:
+            stages.append(Stage('index', self._index, 1))
+        stages.extend([Stage('transform', self._transform, self.transformers),
+                       Stage('compress', self._compress, self.compressors),
+                       Stage('deliver', self._deliver, 1)])
+        pipeline = Pipeline(stages, self.logger)
+        failed = []
+        try:
+            pipeline.run(batch)
+            # The download stage is handed the scan itself, the later ones its job
+            failed.extend(item if name == 'download' else item['scan'] for name, item in pipeline.failed)
+            if self.digested:
+                try:
+                    self.send_digest(self.digested)
+                except Exception as e:
+                    # Nothing was delivered: keep the baselines and the journal as they were
+                    self.error("Unable to send the digest of %d report(s): %s" % (len(self.digested), e))
+                    failed.extend(job['scan'] for job in self.digested)
+                else:
+                    for job in self.digested:
+                        self._publish(job)
+        finally:
+            self.mailer.close()
+
+        for scan in failed:
+            scan['failures'] = scan.get('failures', 0) + 1
+            if scan['failures'] < REPORT_ATTEMPTS:
+                self.warning("Reporting on scan '%s' failed; trying again in the next window" % scan['scan_name'])
+                self.scans_complete.append(scan)
+            else:
+                self.error("Reporting on scan '%s' failed %d times; giving up on it until the next run" % (
+                    scan['scan_name'], scan['failures']))
 
-            errors = self.scanner.getErrors(scan)
-            data = self.scanner.reportDownload(scan['uuid'])
-            xmlf = os.path.join(self.reports, pname + '.xml')
-            htmlf = os.path.join(self.reports, pname + '.html')
+        timings = pipeline.timings()
+        for name, timing in timings:
+            self.info("Stage %-9s %3d report(s), %d error(s), %d worker(s); %.2fs busy, %.2fs slowest, %.2fs elapsed"
+                      % (name, timing['items'], timing['errors'], timing['workers'], timing['busy'],
+                         timing['slowest'], timing['elapsed']))
+        return timings
 
-            pname = "%s_%s" % (pname, str(date.today()))
-            zipf = os.path.join(self.reports, pname + '.zip')
+    def _mergedscan(self, parts):
+        """
+        The completed scan standing for all the parts of a split scan.
+        """
+        parts = sorted(parts, key=lambda part: part['part'])
+        logical = parts[0]['logical']
+        return {'scan_name': logical['name'],
+                'target': logical['target'],
+                'policy': logical['policy'],
+                'uuid': parts[0]['uuid'],
+                'node': parts[0]['node'],
+                'chunks': parts}
+
+    def _uuids(self, scan):
+        """
+        The uuids of the scans on the server behind a completed scan: one, or one per part of a split scan.
+        """
+        return [part['uuid'] for part in scan.get('chunks', [scan])]
 
-            open(htmlf, "w")
-            self.genreport(data, xmlf, htmlf, zipf)
-            self.info("XML report saved as '%s'" % xmlf)
-            self.info("HTML report saved as '%s'" % htmlf)
+    def _download(self, scan):
+        """
+        Pipeline stage: fetch the errors and the report of a completed scan, saving the XML to disk.
+        """
+        pname = scan['scan_name'].replace(' ', '')
+        # Scans sharing a name can be in the pipeline at once; the uuid keeps their files apart until delivery
+        # publishes the report under the scan name alone
+        tag = "%s_%s" % (pname, scan['uuid'])
+        job = {'scan': scan,
+               'xmlf': os.path.join(self.reports, tag + '.xml'),
+               'htmlf': os.path.join(self.reports, tag + '.html'),
+               'zipf': os.path.join(self.reports, "%s_%s.zip" % (tag, str(date.today()))),
+               'prevf': None,
+               'published': (os.path.join(self.reports, pname + '.xml'), os.path.join(self.reports, pname + '.html'))}
+
+        try:
+            if 'chunks' in scan:
+                self._downloadparts(scan, job)
+            else:
+                scanner = self.nodemap[scan['node']].connect()
+                job['errors'] = scanner.getErrors(scan)
+                size = self._fetchreport(scanner, scan['uuid'], job['xmlf'])
+                self.info("XML report saved as '%s' (%d bytes)" % (job['xmlf'], size))
+        except Exception:
+            # Leave nothing half downloaded behind; the published report of this name is untouched
+            if os.path.exists(job['xmlf']):
+                os.remove(job['xmlf'])
+            raise
+
+        if self.delta and os.path.exists(job['published'][0]):
+            # Compare with the last report published under this name, which stays in place until this one is
+            # delivered and published over it
+            job['prevf'] = job['published'][0]
+        return job
+
+    def _fetchreport(self, scanner, uuid, path):
+        """
+        Save a report to path, from the report cache when it is there and from the server otherwise, filling the
+        cache on the way. The report is streamed straight to disk; it is never held in memory as a whole.
+        """
+        self._fetchreports(scanner, {uuid: path})
+        return os.path.getsize(path)
 
-            # Put together the text of the email with the report attached
-            self.send_report("Report: %s" % scan['scan_name'], self.gensummary(data, errors), zipf)
-            self.info("Email report sent to '%s' from '%s' including '%s'" % (self.emailto, self.emailfrom, zipf))
+    def _fetchreports(self, scanner, paths):
+        """
+        Save several reports of one scanner node, given as a dict of uuid to path, downloading those not in the
+        report cache side by side over the node's connection pool. A transfer cut short is resumed on its own;
+        a report that still fails after the configured retries raises its last error once the others are in.
+        """
+        missing = {}
+        for uuid, path in paths.items():
+            if self.reportcache is not None:
+                output = open(path, "wb")
+                try:
+                    size = self.reportcache.extract(uuid, output)
+                finally:
+                    output.close()
+                if size is not None:
+                    self.debug("Report %s served from the report cache" % uuid)
+                    continue
+            missing[uuid] = path
+        if not missing:
+            return
+
+        results = scanner.reportDownloadMany(sorted(missing), missing.get, retries=self.retries)
+        failed = None
+        for uuid in sorted(missing):
+            result = results.get(uuid)
+            if result is None:
+                # Never trust what is on disk for a report without an outcome
+                self.error("No outcome for the download of report %s" % uuid)
+                failed = RequestError("Download of report did not finish:", uuid)
+                continue
+            if result['error'] is not None:
+                self.error("Unable to download report %s after %d attempt(s): %s" % (uuid, result['attempts'],
+                                                                                      result['error']))
+                failed = result['error']
+                continue
+            self.info("Report %s downloaded: %d bytes in %.2fs (%.1f KB/s, %d attempt(s))" % (
+                uuid, result['bytes'], result['seconds'], result['rate'] / 1024, result['attempts']))
+            if self.reportcache is not None:
+                self.reportcache.store(uuid, missing[uuid])
+        if failed is not None:
+            raise failed
+
+    def _downloadparts(self, scan, job):
+        """
+        Download every part of a split scan and merge them into a single report, collecting the errors of all.
+        """
+        errors = []
+        partfiles = []
+        bynode = {}
+        try:
+            for part in scan['chunks']:
+                scanner = self.nodemap[part['node']].connect()
+                error = scanner.getErrors(part)
+                if isinstance(error, dict):
+                    error = error.get('error')
+                if isinstance(error, dict):
+                    errors.append(error)
+                elif isinstance(error, list):
+                    errors.extend(error)
+                partfile = "%s.part%d" % (job['xmlf'], part['part'])
+                partfiles.append(partfile)
+                bynode.setdefault(part['node'], {})[part['uuid']] = partfile
+            # Fetch the parts held by each node together, rather than one round trip after another
+            for node, paths in bynode.items():
+                self._fetchreports(self.nodemap[node].connect(), paths)
+            merge_reports(partfiles, job['xmlf'], scan['scan_name'], scan['target'])
+        finally:
+            for partfile in partfiles:
+                if os.path.exists(partfile):
+                    os.remove(partfile)
+        job['errors'] = errors
+        self.info("XML report of %d part(s) merged as '%s' (%d bytes)" % (len(partfiles), job['xmlf'],
+                                                                          os.path.getsize(job['xmlf'])))
+        return job
+
+    def _index(self, job):
+        """
+        Pipeline stage: add the findings of the report to the findings index. Failing to index a report, for
+        whatever reason, is logged but does not hold up its delivery.
+        """
+        scan = job['scan']
+        try:
+            count = self.findings.ingest(job['xmlf'], scan['uuid'], scan['scan_name'])
+        except Exception as e:
+            # Anything from the database to a ReportItem missing its pluginID or with a non-numeric port
+            self.error("Unable to index the findings of '%s': %s" % (job['xmlf'], e))
+        else:
+            self.info("Indexed %d finding(s) from '%s'" % (count, job['xmlf']))
+        return job
 
-    def genreport(self, data, xmlf, htmlf, zipf):
+    def _transform(self, job):
+        """
+        Pipeline stage: render the HTML report.
         """
-        Simple method for transforming the XML spit out by the server into report-style HTML using
-        what's available.
+        self.transform(job['xmlf'], job['htmlf'])
+        self.info("HTML report saved as '%s'" % job['htmlf'])
+        return job
+
+    def _compress(self, job):
+        """
+        Pipeline stage: zip the HTML report.
+        """
+        self.compress(job['htmlf'], job['zipf'])
+        return job
+
+    def _deliver(self, job):
+        """
+        Pipeline stage: put together the text of the email with the report attached and send it.
+        """
+        scan = job['scan']
+        job['summary'] = self.gensummary(job['xmlf'], job['errors'])
+        if job['prevf'] is not None:
+            try:
+                changes = diff(job['prevf'], job['xmlf']).format()
+            except Exception as e:
+                # Without a delta the report goes out in full, as if there were nothing to compare with
+                self.error("Unable to compare '%s' with '%s', sending the full report: %s" % (
+                    job['xmlf'], job['prevf'], e))
+                job['prevf'] = None
+            else:
+                job['summary'] = "%s\n\n%s" % (changes, job['summary'])
+        if 'members' in scan:
+            job['summary'] = "Includes: %s\n\n%s" % (", ".join(scan['members']), job['summary'])
+        if self.digest:
+            # Published once the digest is sent, by report()
+            self.digested.append(job)
+            return job
+        if self.deltaonly and job['prevf'] is not None:
+            # The changes are the whole message; the full report stays in outputdir
+            self.mailer.send("Changes: %s" % scan['scan_name'], job['summary'])
+        else:
+            self.send_report("Report: %s" % scan['scan_name'], job['summary'], job['zipf'])
+        self._publish(job)
+        if self.journal is not None:
+            for uuid in self._uuids(scan):
+                self.journal.record(DELIVERED, uuid=uuid)
+        self.info("Email report sent to '%s' from '%s' including '%s'" % (self.emailto, self.emailfrom, job['zipf']))
+        return job
+
+    def _publish(self, job):
+        """
+        Move the XML and HTML reports of a delivered job to their names without the uuid, replacing those of the
+        last scan with the same name. Until then the last report stays published, so a job that fails on the way
+        leaves the baseline of the next delta alone.
+        """
+        for path, published in zip((job['xmlf'], job['htmlf']), job['published']):
+            if os.path.exists(path):
+                os.rename(path, published)
+
+    def transform(self, xmlf, htmlf, data=None):
+        """
+        Transform the XML using the XSL provided by Nessus for HTML reports (quietly). The stylesheet is compiled
+        once per process and applied in-process when lxml is available; otherwise xsltproc is run. Raises
+        ReportError when the transform fails.
 
-        @type   data:       string
-        @param  data:       XML output from the report of a scan.
         @type   xmlf:       string
-        @param  xmlf:       The file where the XML is to be output.
-        @type   htmlf:          string
-        @param  htmlf:          The file where the HTML is to be output.
-        @type   zipf:       string
-        @param  zipf:       The output ZipFile containing the compressed report.
+        @param  xmlf:       The XML report on disk.
+        @type   htmlf:      string
+        @param  htmlf:      The file where the HTML is to be output.
+        @type   data:       string
+        @param  data:       The XML report itself when already in memory, saving a read of xmlf for in-process
+                            transforms (optional).
         """
-        output = open(xmlf, "w")
-        output.write(data)
-        output.close()
+        if self.inprocess:
+            return self._transform_inprocess(xmlf, htmlf, data)
 
-        xsltlog = open(self.xsltlog, 'w')
-        # Transform the XML using the XSL provided by Nessus for HTML reports (quietly)
         cmd = (self.xsltproc, "-o", htmlf, self.xsl, xmlf)
         self.debug("Converting report: '%s'" % "' '".join(cmd))
-        ret = subprocess.call(cmd, stdout=xsltlog, stderr=xsltlog)
-        xsltlog.close()
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        ret = process.returncode
+        self._xsltlog(output)
         if ret != 0:
             self.error("Error running xsltproc: %s" % self.xsltproc)
             self.error("xsltproc exit code: %s" % ret)
             self.error("xsltproc output: %s" % self.xsltlog)
-            print "ERROR: report generating failed.\n"
-            print "ERROR: Please check the logfile %s and xsltproc output file %s for more information" % \
-                  (self.logfile, self.xsltlog)
-            sys.exit(ret)
+            self.error("Please check the logfile %s and xsltproc output file %s for more information" % (
+                self.logfile, self.xsltlog))
+            raise ReportError("Report generating failed for", xmlf)
+
+    def _transform_inprocess(self, xmlf, htmlf, data):
+        self.debug("Converting report in-process: '%s' with '%s'" % (xmlf, self.xsl))
+        parser = lxml_etree.XMLParser(huge_tree=True)
         try:
-            zip = zipfile.ZipFile(zipf, 'w', zipfile.ZIP_DEFLATED)
+            xslt = stylesheet(self.xsl)
+            if data is not None:
+                document = lxml_etree.fromstring(data, parser).getroottree()
+            else:
+                document = lxml_etree.parse(xmlf, parser)
+            result = xslt(document)
+        except (lxml_etree.XMLSyntaxError, lxml_etree.XSLTError) as e:
+            self._xsltlog("%s: %s\n" % (xmlf, e))
+            self.error("Error transforming '%s' with '%s': %s" % (xmlf, self.xsl, e))
+            raise ReportError("Report generating failed for", xmlf)
+        if len(xslt.error_log):
+            self._xsltlog("%s\n" % xslt.error_log)
+        # str() serializes the result the way the stylesheet's xsl:output asks for
+        output = open(htmlf, "w")
+        output.write(str(result))
+        output.close()
+
+    def _xsltlog(self, output):
+        """
+        Append transform output to the xsltlog; several transforms may run at once, so one at a time.
+        """
+        if not output:
+            return
+        with self.xsltlock:
+            xsltlog = open(self.xsltlog, 'a')
+            xsltlog.write(output)
+            xsltlog.close()
+
+    def compress(self, htmlf, zipf):
+        """
+        Zip the HTML report, streaming it into the archive in chunks at the configured ziplevel.
+
+        @type   htmlf:      string
+        @param  htmlf:      The HTML report on disk.
+        @type   zipf:       string
+        @param  zipf:       The output ZipFile containing the compressed report.
+        """
+        try:
+            zip = zipfile.ZipFile(zipf, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
         except RuntimeError:
-            zip = zipfile.ZipFile(zipf, 'w')
-        zip.write(htmlf, arcname=os.path.basename(htmlf))
+            zip = zipfile.ZipFile(zipf, 'w', allowZip64=True)
+        zipfile_write(zip, htmlf, arcname=os.path.basename(htmlf), level=self.ziplevel)
         zip.close()
 
-    def gensummary(self, data, errors):
+    def _summarize(self, source):
         """
-        Generate a simple summary as the contents of the email report to be sent.
+        Stream a .nessus (v2) report and collect the report name, policy name, preferences and severity totals.
+        Each ReportHost is dropped from the tree once it has been counted, so memory use stays flat no matter
+        how large the report grows.
 
-        @type   data:   string
-        @param  data:   XML data from the current report.
+        @type   source: file
+        @param  source: A filename or file object containing the report XML.
         """
         severity = {'0': 0,
                     '1': 0,
@@ -313,36 +1097,69 @@ class Nessus(object):
                     '3': 0,
                     '4': 0}
         prefs = {}
-        pref = None
-
-        parsed = xml.etree.ElementTree.fromstring(data)
-
-        # Pull out the report name
-        report = parsed.find("Report").attrib['name']
+        report = None
+        policy = None
+        parent = None  # The element currently holding ReportHost children
+        depth = 0  # Nesting depth inside Policy/Preferences
+
+        for event, elem in xml.etree.ElementTree.iterparse(source, events=('start', 'end')):
+            tag = elem.tag
+            if event == 'start':
+                if tag == 'Report':
+                    # Pull out the report name
+                    report = elem.attrib['name']
+                    parent = elem
+                elif tag == 'Preferences' or depth > 0:
+                    depth += 1
+                continue
+
+            if tag == 'ReportItem':
+                # Parse severity for totals, dropping plugin output as we go
+                severity[elem.attrib['severity']] += 1
+                elem.clear()
+            elif tag == 'ReportHost':
+                elem.clear()
+                if parent is not None:
+                    parent.remove(elem)
+            elif depth > 0:
+                depth -= 1
+                if tag == 'preference':
+                    # Parse preferences and construct a dict from all settings
+                    name = elem.find('name')
+                    if name is not None:
+                        value = elem.find('value')
+                        prefs[name.text] = value.text if value is not None else None
+            elif tag == 'policyName' and policy is None:
+                # Pull out the name of the policy used
+                policy = elem.text
+            elif tag == 'Policy':
+                elem.clear()
+
+        return report, policy, prefs, severity
 
-        # Pull out the name of the policy used
-        policy = parsed.find("Policy/policyName").text
+    def gensummary(self, data, errors):
+        """
+        Generate a simple summary as the contents of the email report to be sent.
 
-        # Parse preferences and construct a dict from all settings
-        for preference in parsed.find("Policy/Preferences").getiterator("preference"):
-            for child in preference.getchildren():
-                if child.tag == 'name':
-                    prefs[child.text] = None
-                    pref = child.text
-                elif child.tag == 'value':
-                    prefs[pref] = child.text
-        # Parse severity for totals
-        for host in parsed.find("Report").getiterator("ReportHost"):
-            for item in host.getiterator("ReportItem"):
-                severity[item.attrib['severity']] += 1
+        @type   data:   string
+        @param  data:   XML data from the current report, or an open file object / path to the report on disk.
+        """
+        if isinstance(data, basestring) and data[:256].lstrip().startswith('<'):
+            data = StringIO(data)
+        report, policy, prefs, severity = self._summarize(data)
 
         summary = "Scan Name: %25s\nTarget(s): %25s\nPolicy: %28s\n\nRisk Summary\n%s\n%15s %3s\n%15s %3s\n%15s %3s\n\n%15s %3s" % (
             report, prefs['TARGET'], policy, '-' * 36, 'High', severity['3'], 'Medium', severity['2'], 'Low', severity['1'],
             'Open Ports', severity['0'])
 
-        if errors is not None and 'error' in errors:
+        # A single error comes back as {'error': {...}}, several of them as a list of error dicts
+        error = None
+        if isinstance(errors, dict):
+            error = errors.get('error')
+        elif isinstance(errors, list):
+            error = errors
+        if error:
             summary += "\n\nError(s) during scan:\n%s\n" % ('-' * 21, )
-            error = errors['error']
             if isinstance(error, dict):
                 error = [error, ]
 
@@ -365,37 +1182,104 @@ class Nessus(object):
         @type   apptype:    string
         @param  apptype:    Application MIME type for attachment.
         """
-        message = MIMEMultipart()
-        message['From'] = self.emailfrom
-        message['To'] = self.emailto
-        message['Subject'] = subject
+        self.mailer.send(subject, body, [(attachment, apptype)])
 
-        if isinstance(body, unicode):
-            message.attach(MIMEText(body, _charset='utf-8'))
-        else:
-            try:
-                enc = chardet.detect(body)
-            except UnicodeDecodeError:
-                body = body.decode('utf-8')
-                enc = chardet.detect(body)
-            message.attach(MIMEText(body, _charset=enc['encoding']))
-
-        part = MIMEBase('application', apptype)
-        part.set_payload(open(attachment, 'r').read())
-        Encoders.encode_base64(part)
-        part.add_header('Content-Disposition', 'attachment',
-                        filename=(Header(os.path.basename(attachment), charset='utf-8').encode()))
-        message.attach(part)
-
-        conn = smtplib.SMTP(self.smtpserver, self.smtpport)
-        conn.sendmail(message['From'], self.emailto, message.as_string())
-        conn.close()
+    def send_digest(self, jobs):
+        """
+        Send the summaries of several reports as one email, with every report attached.
+
+        @type   jobs:   list
+        @param  jobs:   The delivered pipeline jobs, each with its 'scan', 'summary' and 'zipf'.
+        """
+        names = [job['scan']['scan_name'] for job in jobs]
+        body = []
+        for job in jobs:
+            summary = job['summary']
+            if isinstance(summary, str):
+                summary = summary.decode('utf-8', 'replace')
+            body.append(u"%s\n%s\n\n%s" % (job['scan']['scan_name'], u"=" * len(job['scan']['scan_name']), summary))
+        self.mailer.send("Reports: %s" % ", ".join(names), u"\n\n".join(body),
+                         [(job['zipf'], 'zip') for job in jobs if not (self.deltaonly and job['prevf'] is not None)])
+        if self.journal is not None:
+            for job in jobs:
+                for uuid in self._uuids(job['scan']):
+                    self.journal.record(DELIVERED, uuid=uuid)
+        self.info("Digest of %d report(s) sent to '%s' from '%s'" % (len(jobs), self.emailto, self.emailfrom))
+
+    def requesttrace(self, *args):
+        """
+        The SIGUSR1 handler installed by main(). Only asks for the traces: the handler can interrupt a thread that
+        holds a trace ring's lock, so the dump itself is left to wait().
+        """
+        self.tracerequested = True
+
+    def dumptrace(self):
+        """
+        Log the recent exchanges of every node.
+        """
+        for node in self.nodes:
+            if node.scanner is not None:
+                node.scanner.dumptrace("requested for '%s'" % node.name)
+
+    def wait(self, seconds):
+        """
+        Sleep for the given number of seconds, dumping the traces whenever SIGUSR1 asks for them meanwhile.
+
+        @type   seconds:    number
+        @param  seconds:    How long to sleep.
+        """
+        wake = time() + seconds
+        while True:
+            if self.tracerequested:
+                self.tracerequested = False
+                self.dumptrace()
+            remaining = wake - time()
+            if remaining <= 0:
+                break
+            # A signal cuts the sleep short
+            sleep(remaining)
+
+    def dumpmetrics(self):
+        """
+        Write the request metrics of every connected node to core.metrics, if set; a .prom file gets the Prometheus
+        text format, anything else JSON.
+        """
+        if self.metrics is None:
+            return
+        sources = [({'node': node.name}, node.scanner.metrics) for node in self.nodes if node.scanner is not None]
+        try:
+            write_metrics(self.metrics, sources)
+        except (IOError, OSError) as e:
+            self.error("Unable to write metrics to '%s': %s" % (self.metrics, e))
 
     def close(self):
         """
         End it.
         """
-        return self.scanner.logout()
+        for node in self.nodes:
+            if node.scanner is not None:
+                try:
+                    node.scanner.logout()
+                except node_errors as e:
+                    self.error("Error logging out of '%s': %s" % (node.name, e))
+            for target, stats in sorted(node.cache.stats().items()):
+                self.info("Cache for '%s' %s: %d hit(s), %d miss(es)" % (node.name, target, stats['hits'],
+                                                                         stats['misses']))
+        self.dumpmetrics()
+        self.mailer.close()
+        if self.findings is not None:
+            self.findings.close()
+        if self.reportcache is not None:
+            self.reportcache.close()
+            self.info("Report cache: %(reports)d report(s), %(bytes)d bytes, %(hits)d hit(s), %(misses)d miss(es)"
+                      % self.reportcache.stats())
+        if self.journal is not None:
+            # Keep the journal around while anything in it is still unfinished, so a rerun picks that up
+            finished = not (self.scans or self.scans_running or self.scans_complete or self.partial)
+            if finished and all(entry['event'] == DELIVERED for entry in self.journal.replay().values()):
+                self.journal.clear()
+            else:
+                self.journal.close()
 
     def debug(self, msg):
         """
@@ -452,7 +1336,9 @@ def main():
     parser.add_option("-t", dest='target', help="target string for Nessus scan")
     parser.add_option("-n", dest='name', default="No-name Auto Scan", help="name for the scan")
     parser.add_option("-p", dest='policy', help="policy (on server-side) to use in the scan")
-    parser.add_option("-f", dest='infile', help="input file with multiple scans to run")
+    parser.add_option("-f", dest='infile',
+                      help="input file with multiple scans to run, one name,target,policy[,priority=N][,deadline=WHEN]"
+                           " per line")
     parser.add_option("-c", dest='configfile', default='nessus.conf', help="configuration file to use")
     parser.add_option("-d", dest='debug', action='store_true', default=False, help="Turn on debugging.")
     parser.add_option("-T", dest='timeout', type='int', default=default_timeout,
@@ -465,18 +1351,17 @@ def main():
 
         scans = []
         if options.infile is not None and options.target is None:
-            # Start with multiple scans.
-            f = open(options.infile, "r")
-            for line in f:
-                scan = line.strip().split(',')
-                scans.append({'name': scan[0], 'target': scan[1], 'policy': scan[2]})
+            # Start with multiple scans, read from the input file as they are needed
+            scans = read_scans(options.infile)
             x = Nessus(options.configfile, scans, debug=options.debug, timeout=options.timeout)
+            signal.signal(signal.SIGUSR1, x.requesttrace)
             scans = x.start()
         elif options.target is not None and options.infile is None:
             # Start with a single scan.
             if options.name is not None and options.target is not None and options.policy is not None:
                 scan = [{'name': options.name, 'target': options.target, 'policy': options.policy}]
                 x = Nessus(options.configfile, scan, debug=options.debug, timeout=options.timeout)
+                signal.signal(signal.SIGUSR1, x.requesttrace)
                 scans = x.start()
             else:
                 print "HARD ERROR: Incorrect usage.\n"
@@ -485,11 +1370,16 @@ def main():
         while True:
             if scans is None:
                 break
-            sleeptime = randint(x.sleepmin, x.sleepmax)
+            sleeptime = x.nextpoll()
             x.info("Sleeping for %d seconds, polling for scan completion" % sleeptime)
-            sleep(sleeptime)
-            if x.iscomplete():
+            x.wait(sleeptime)
+            done = x.iscomplete()
+            # Deliver whatever finished in this polling window, instead of holding everything until the end
+            if len(x.scans_complete) > 0:
                 x.report()
+            x.dumpmetrics()
+            # Reports that failed are tried again in the next window, even once every scan has finished
+            if done and not x.scans_complete:
                 break
         x.info("All done; closing")
         x.close()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Aggregating findings held in ReportColumns, with and without NumPy.
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+from StringIO import StringIO
+
+sys.path[:0] = [os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir),
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'bench')]
+
+import Aggregate
+from Aggregate import ReportColumns, KEYS, severity_by, top
+from fakenessus import nessus_report
+
+
+class ReportColumnsTest(unittest.TestCase):
+    def columns(self):
+        columns = ReportColumns()
+        columns.add('10.0.0.1', 80, 100, 2)
+        columns.add('10.0.0.1', 443, 101, 4)
+        columns.add('10.0.0.2', 80, 100, 2)
+        columns.add('10.0.1.5', 22, 102, 0)
+        columns.add('db.example', 5432, 100, 3, address='10.0.1.9')
+        columns.add('web.example', 80, 103, 1)
+        return columns
+
+    def pure(self, func, *args, **kwargs):
+        # The same aggregation without NumPy
+        saved, Aggregate.numpy = Aggregate.numpy, None
+        try:
+            return func(*args, **kwargs)
+        finally:
+            Aggregate.numpy = saved
+
+    def test_severity_by(self):
+        columns = self.columns()
+        self.assertEqual(self.pure(severity_by, columns, 'host'),
+                         {'10.0.0.1': [0, 0, 1, 0, 1], '10.0.0.2': [0, 0, 1, 0, 0], '10.0.1.5': [1, 0, 0, 0, 0],
+                          'db.example': [0, 0, 0, 1, 0], 'web.example': [0, 1, 0, 0, 0]})
+        self.assertEqual(self.pure(severity_by, columns, 'subnet'),
+                         {'10.0.0.0/24': [0, 0, 2, 0, 1], '10.0.1.0/24': [1, 0, 0, 1, 0],
+                          '(named hosts)': [0, 1, 0, 0, 0]})
+        self.assertEqual(self.pure(severity_by, columns, 'subnet', prefix=16),
+                         {'10.0.0.0/16': [1, 0, 2, 1, 1], '(named hosts)': [0, 1, 0, 0, 0]})
+        self.assertEqual(self.pure(severity_by, columns, 'plugin')[100], [0, 0, 2, 1, 0])
+
+    def test_top(self):
+        columns = self.columns()
+        self.assertEqual(self.pure(top, columns, 'plugin', n=2), [(100, 3), (101, 1)])
+        self.assertEqual(self.pure(top, columns, 'port', severity=0), [(80, 3), (22, 1), (443, 1), (5432, 1)])
+
+    @unittest.skipIf(Aggregate.numpy is None, "NumPy is not installed")
+    def test_numpy_matches_pure_python(self):
+        columns = ReportColumns().load(StringIO(nessus_report(300, 20)))
+        columns.add('named.example', 80, 100, 4)
+        for key in KEYS:
+            self.assertEqual(severity_by(columns, key), self.pure(severity_by, columns, key))
+            self.assertEqual(top(columns, key, n=15), self.pure(top, columns, key, n=15))
+        self.assertEqual(severity_by(columns, 'subnet', prefix=20), self.pure(severity_by, columns, 'subnet', 20))
+
+    def test_load(self):
+        columns = ReportColumns.from_reports([StringIO(nessus_report(3, 4)), StringIO(nessus_report(2, 4))])
+        self.assertEqual(len(columns), 20)
+        # Both reports cover 10.0.0.0 and 10.0.0.1; each host is stored once
+        self.assertEqual(columns.names, ['10.0.0.0', '10.0.0.1', '10.0.0.2'])
+        self.assertEqual(sum(sum(row) for row in severity_by(columns, 'host').values()), 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vim: expandtab sw=4 ts=4 ai
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Streaming files into zip archives with Archive.ZipMember.
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from Archive import ZipMember, zipfile_write
+
+
+class ZipMemberTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'report.zip')
+        self.chunks = ["<ReportHost name='10.0.0.%d'>%s</ReportHost>\n" % (i, 'x' * i) for i in range(200)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, compression):
+        archive = zipfile.ZipFile(self.path, "w", compression)
+        member = ZipMember(archive, 'report.xml', 9)
+        for chunk in self.chunks:
+            member.write(chunk)
+        member.close()
+        archive.writestr('README', 'after the streamed member')
+        archive.close()
+
+    def check(self):
+        archive = zipfile.ZipFile(self.path)
+        try:
+            self.assertEqual(archive.testzip(), None)
+            self.assertEqual(archive.namelist(), ['report.xml', 'README'])
+            self.assertEqual(archive.read('report.xml'), ''.join(self.chunks))
+            self.assertEqual(archive.read('README'), 'after the streamed member')
+        finally:
+            archive.close()
+
+    def test_deflated(self):
+        self.write(zipfile.ZIP_DEFLATED)
+        self.check()
+
+    def test_stored(self):
+        self.write(zipfile.ZIP_STORED)
+        self.check()
+
+    def test_zipfile_write(self):
+        source = os.path.join(self.directory, 'report.html')
+        with open(source, 'wb') as f:
+            f.write(''.join(self.chunks) * 50)
+        archive = zipfile.ZipFile(self.path, "w", zipfile.ZIP_DEFLATED)
+        zipfile_write(archive, source, level=1)
+        archive.close()
+        archive = zipfile.ZipFile(self.path)
+        self.assertEqual(archive.read('report.html'), ''.join(self.chunks) * 50)
+        archive.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vim: expandtab sw=4 ts=4 ai
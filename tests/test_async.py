@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+AsyncScanner against the local fake Nessus server in bench/fakenessus.py.
+
+    python -m unittest discover tests
+"""
+import os
+import ssl
+import sys
+import socket
+import unittest
+from time import time
+
+sys.path[:0] = [os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir),
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'bench')]
+
+from fakenessus import FakeNessus
+from AsyncNessusXMLRPC import AsyncScanner, loop
+from NessusXMLRPC import LoginError, PolicyError, RequestError
+
+
+class AsyncScannerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakeNessus(duration=0.0, hosts=50, items=10).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        server = self.server
+        server.latency = 0.0
+        server.drop = 0.0
+        server.outage = 0
+        server.password = 'nessus'
+        server.policies = ['Full Scan', 'Quick Scan']
+        self.map = {}
+
+    def scanner(self, password='nessus', **kwargs):
+        return AsyncScanner('127.0.0.1', self.server.port, 'nessus', password, timeout=kwargs.pop('timeout', 10),
+                            map=self.map, context=ssl._create_unverified_context(), **kwargs)
+
+    def connected(self, **kwargs):
+        scanner = self.scanner(**kwargs)
+        self.assertTrue(scanner.login().wait(10))
+        return scanner
+
+    def test_login(self):
+        scanner = self.connected()
+        self.assertTrue(scanner.token in self.server.tokens)
+        self.assertEqual(scanner.headers['Cookie'], 'token=%s' % scanner.token)
+        self.assertTrue(scanner.isadmin)
+
+    def test_login_without_credentials(self):
+        scanner = AsyncScanner('127.0.0.1', self.server.port, map=self.map)
+        self.assertFalse(scanner.login().wait(10))
+
+    def test_policy_list(self):
+        policies = self.connected().policyList().wait(10)
+        self.assertEqual(sorted(policy['policyName'] for policy in policies), ['Full Scan', 'Quick Scan'])
+
+    def test_quick_scan(self):
+        scanner = self.connected()
+        scan = scanner.quickScan('weekly', '10.0.0.0/24', 'Quick Scan').wait(10)
+        self.assertEqual(scan['scan_name'], 'weekly')
+        # The policy ID is now indexed, so the next scan skips /policy/list
+        listed = self.server.calls['/policy/list']
+        scanner.quickScan('daily', '10.0.1.0/24', 'Quick Scan').wait(10)
+        self.assertEqual(self.server.calls['/policy/list'], listed)
+
+    def test_recreated_policy(self):
+        scanner = self.connected()
+        scanner.quickScan('weekly', '10.0.0.1', 'Quick Scan').wait(10)
+        self.server.policies = ['Quick Scan']
+        self.assertEqual(scanner.quickScan('daily', '10.0.0.1', 'Quick Scan').wait(10)['scan_name'], 'daily')
+        self.assertEqual(scanner.policies.get('Quick Scan'), '1')
+
+    def test_report_list(self):
+        scanner = self.connected()
+        scan = scanner.quickScan('listed', '10.0.0.1', 'Full Scan').wait(10)
+        reports = scanner.reportList().wait(10)
+        self.assertTrue(scan['uuid'] in [report['name'] for report in reports])
+
+    def test_report_download(self):
+        scanner = self.connected()
+        self.assertEqual(scanner.reportDownload('any').wait(10), self.server.report)
+
+    def test_many_in_flight(self):
+        scanner = self.connected(limit=4)
+        results = [scanner.policyList() for i in range(20)]
+        loop(self.map)
+        self.assertTrue(all(len(result.result()) == 2 for result in results))
+        self.assertEqual(scanner.active, 0)
+
+    def test_bad_login(self):
+        scanner = self.scanner(password='wrong')
+        self.assertRaises(LoginError, scanner.login().wait, 10)
+
+    def test_relogin_after_expiry(self):
+        scanner = self.connected()
+        self.server.tokens.clear()
+        logins = self.server.calls['/login']
+        results = [scanner.policyList() for i in range(3)]
+        loop(self.map)
+        self.assertTrue(all(len(result.result()) == 2 for result in results))
+        # One login shared by every request that hit the 403
+        self.assertEqual(self.server.calls['/login'], logins + 1)
+
+    def test_relogin_failure(self):
+        scanner = self.connected()
+        self.server.tokens.clear()
+        self.server.password = 'changed'
+        self.assertRaises(LoginError, scanner.policyList().wait, 10)
+
+    def test_unknown_policy(self):
+        scanner = self.connected()
+        self.assertRaises(PolicyError, scanner.quickScan('weekly', '10.0.0.1', 'No Such Policy').wait, 10)
+
+    def test_server_error(self):
+        scanner = self.connected()
+        self.server.outage = time() + 60
+        self.assertRaises(RequestError, scanner.reportList().wait, 10)
+
+    def test_truncated_reply(self):
+        scanner = self.connected()
+        self.server.drop = 1.0
+        self.assertRaises(RequestError, scanner.reportDownload('any').wait, 10)
+
+    def test_timeout(self):
+        scanner = self.connected(timeout=0.2)
+        self.server.latency = 2.0
+        self.assertRaises(socket.timeout, scanner.reportList().wait, 10)
+
+    def test_connection_refused(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+        listener.close()
+        scanner = AsyncScanner('127.0.0.1', port, 'nessus', 'nessus', map=self.map,
+                               context=ssl._create_unverified_context())
+        self.assertRaises(socket.error, scanner.login().wait, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vim: expandtab sw=4 ts=4 ai
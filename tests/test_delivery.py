@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Mailer against a local SMTP server.
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import smtpd
+import asyncore
+import smtplib
+import tempfile
+import threading
+import unittest
+from time import sleep, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from Delivery import Mailer
+
+
+class Sink(smtpd.SMTPServer):
+    """
+    Keeps every message it accepts; recipients in refuse are turned away.
+    """
+    def __init__(self, refuse=()):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.create_socket(smtpd.socket.AF_INET, smtpd.socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(('127.0.0.1', 0))
+        self.listen(5)
+        self.refuse = refuse
+        self.messages = []
+        self.thread = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.05, 'map': self.map})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            channel = smtpd.SMTPChannel(self, *pair)
+            # Channels join the sink's own map rather than the global one
+            del asyncore.socket_map[channel._fileno]
+            channel._map = self.map
+            channel.add_channel()
+            refuse = self.refuse
+
+            def smtp_RCPT(arg, rcpt=channel.smtp_RCPT):
+                if arg and any(address in arg for address in refuse):
+                    channel.push('550 No such user')
+                    return
+                rcpt(arg)
+            channel.smtp_RCPT = smtp_RCPT
+
+    @property
+    def port(self):
+        return self.socket.getsockname()[1]
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((rcpttos, data))
+
+    def wait(self, count):
+        deadline = time() + 5
+        while len(self.messages) < count and time() < deadline:
+            sleep(0.01)
+        return self.messages
+
+    def stop(self):
+        asyncore.close_all(self.map)
+
+
+class MailerTest(unittest.TestCase):
+    def setUp(self):
+        self.attachment = tempfile.NamedTemporaryFile(suffix='.zip')
+        self.attachment.write('PK' * 1000)
+        self.attachment.flush()
+
+    def tearDown(self):
+        self.attachment.close()
+
+    def test_one_session_per_batch(self):
+        sink = Sink()
+        mailer = Mailer('127.0.0.1', sink.port, 'from@example.com', 'a@example.com, b@example.com')
+        for i in range(3):
+            mailer.send('Report %d' % i, 'body', [(self.attachment.name, 'zip')])
+        mailer.close()
+        messages = sink.wait(3)
+        sink.stop()
+        self.assertEqual(len(messages), 3)
+        self.assertEqual(messages[0][0], ['a@example.com', 'b@example.com'])
+        self.assertEqual(mailer.sessions, 1)
+
+    def test_failed_attachment_ends_the_session(self):
+        sink = Sink()
+        mailer = Mailer('127.0.0.1', sink.port, 'from@example.com', 'a@example.com')
+        mailer.send('First', 'body')
+        self.assertRaises(IOError, mailer.send, 'Broken', 'body', [('/nonexistent/report.zip', 'zip')])
+        mailer.send('Second', 'body')
+        mailer.close()
+        messages = sink.wait(2)
+        sink.stop()
+        self.assertEqual(len(messages), 2)
+        self.assertTrue('Second' in messages[1][1])
+        self.assertFalse('Broken' in messages[1][1])
+        self.assertEqual(mailer.sessions, 2)
+
+    def test_refused_recipients(self):
+        sink = Sink(refuse=('nobody@example.com', ))
+        mailer = Mailer('127.0.0.1', sink.port, 'from@example.com', 'nobody@example.com')
+        self.assertRaises(smtplib.SMTPRecipientsRefused, mailer.send, 'Refused', 'body')
+        self.assertEqual(mailer.connection, None)
+        mailer.recipients = ['nobody@example.com', 'a@example.com']
+        mailer.send('Partly refused', 'body')
+        mailer.close()
+        messages = sink.wait(1)
+        sink.stop()
+        self.assertEqual([rcpttos for rcpttos, data in messages], [['a@example.com']])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vim: expandtab sw=4 ts=4 ai
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+The comparison of two reports of the same scan sent with the digest.
+
+    python -m unittest discover tests
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import Delta
+
+
+def report(findings):
+    """
+    A .nessus (v2) report holding the given (host, port, plugin, severity) findings.
+    """
+    hosts = {}
+    for host, port, plugin, severity in findings:
+        hosts.setdefault(host, []).append((port, plugin, severity))
+    out = ['<?xml version="1.0" ?>\n<NessusClientData_v2>\n<Report name="weekly">\n']
+    for host in sorted(hosts):
+        out.append('<ReportHost name="%s">\n' % host)
+        for port, plugin, severity in hosts[host]:
+            out.append('<ReportItem port="%d" severity="%d" pluginID="%d" pluginName="Plugin %d"/>\n' % (
+                port, severity, plugin, plugin))
+        out.append('</ReportHost>\n')
+    out.append('</Report>\n</NessusClientData_v2>\n')
+    return ''.join(out)
+
+
+class DiffTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, findings):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            f.write(report(findings))
+        return path
+
+    def test_counts(self):
+        old = self.write('old.nessus', [('10.0.0.1', 80, 100, 2), ('10.0.0.1', 443, 101, 4),
+                                        ('10.0.0.2', 22, 102, 1), ('10.0.0.3', 22, 102, 1)])
+        new = self.write('new.nessus', [('10.0.0.1', 80, 100, 2), ('10.0.0.2', 22, 102, 1),
+                                        ('10.0.0.2', 3389, 103, 3), ('10.0.0.4', 80, 100, 2),
+                                        ('10.0.0.4', 80, 100, 2)])
+        delta = Delta.diff(old, new)
+        self.assertEqual(delta.unchanged, 2)
+        self.assertEqual(delta.newcount, {4: 0, 3: 1, 2: 1, 1: 0, 0: 0})
+        self.assertEqual(delta.fixedcount, {4: 1, 3: 0, 2: 0, 1: 1, 0: 0})
+        self.assertEqual(sorted(delta.new), [('10.0.0.2', 3389, 103, 3, 'Plugin 103'),
+                                             ('10.0.0.4', 80, 100, 2, 'Plugin 100')])
+        self.assertEqual(sorted(delta.fixed), [('10.0.0.1', 443, 101, 4, 'Plugin 101'),
+                                               ('10.0.0.3', 22, 102, 1, 'Plugin 102')])
+
+    def test_same_report(self):
+        findings = [('10.0.0.1', 80, 100, 2), ('10.0.0.2', 22, 102, 1)]
+        delta = Delta.diff(self.write('old.nessus', findings), self.write('new.nessus', findings))
+        self.assertEqual(delta.unchanged, 2)
+        self.assertEqual(sum(delta.newcount.values()), 0)
+        self.assertEqual(sum(delta.fixedcount.values()), 0)
+        self.assertEqual((delta.new, delta.fixed), ([], []))
+
+    def test_limit(self):
+        old = self.write('old.nessus', [])
+        new = self.write('new.nessus', [('10.0.0.%d' % host, 80, 100, 3) for host in range(1, 11)])
+        delta = Delta.diff(old, new, limit=4)
+        self.assertEqual(len(delta.new), 4)
+        self.assertEqual(delta.newcount[3], 10)
+        text = delta.format()
+        self.assertTrue("New:          10 (High 10)" in text)
+        self.assertTrue("  ... and 6 more" in text)
+
+    def test_format(self):
+        old = self.write('old.nessus', [('10.0.0.1', 443, 101, 4), ('10.0.0.1', 0, 104, 0)])
+        new = self.write('new.nessus', [('10.0.0.2', 3389, 103, 3), ('10.0.0.2', 0, 104, 0)])
+        lines = Delta.diff(old, new).format(severity=1).split("\n")
+        self.assertEqual(lines[2:5], ["New:           2 (High 1)", "Fixed:         2 (Critical 1)",
+                                      "Unchanged:     0"])
+        self.assertEqual(lines[5:], ["", "New findings:", "  10.0.0.2:3389         [High] Plugin 103 (103)",
+                                     "", "Fixed findings:", "  10.0.0.1:443          [Critical] Plugin 101 (101)"])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: expandtab sw=4 ts=4 ai
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+The SQLite findings index fed with downloaded reports.
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from Findings import FindingsIndex
+
+
+def report(hosts, name='weekly'):
+    """
+    A .nessus (v2) report; hosts maps each host name to its (port, plugin, severity) findings.
+    """
+    out = ['<?xml version="1.0" ?>\n<NessusClientData_v2>\n<Policy><policyName>Full Scan</policyName>'
+           '<Preferences><ServerPreferences><preference><name>TARGET</name><value>10.0.0.0/24</value></preference>'
+           '</ServerPreferences></Preferences></Policy>\n<Report name="%s">\n' % name]
+    for host in sorted(hosts):
+        out.append('<ReportHost name="%s"><HostProperties><tag name="host-ip">%s</tag></HostProperties>\n' % (
+            host, host))
+        for port, plugin, severity in hosts[host]:
+            out.append('<ReportItem port="%d" svc_name="www" protocol="tcp" severity="%d" pluginID="%d" '
+                       'pluginName="Plugin %d" pluginFamily="General"/>\n' % (port, severity, plugin, plugin))
+        out.append('</ReportHost>\n')
+    out.append('</Report>\n</NessusClientData_v2>\n')
+    return StringIO(''.join(out))
+
+
+class FindingsIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = FindingsIndex(':memory:')
+
+    def tearDown(self):
+        self.index.close()
+
+    def test_ingest(self):
+        count = self.index.ingest(report({'10.0.0.1': [(80, 100, 2), (443, 101, 4)],
+                                          '10.0.0.2': [(22, 100, 2)]}), 'uuid-1')
+        self.assertEqual(count, 3)
+        self.assertTrue(self.index.ingested('uuid-1'))
+        self.assertEqual(self.index.query("SELECT name, policy, target FROM reports"),
+                         [('weekly', 'Full Scan', '10.0.0.0/24')])
+        self.assertEqual(self.index.query("SELECT name, ip FROM hosts ORDER BY name"),
+                         [('10.0.0.1', '10.0.0.1'), ('10.0.0.2', '10.0.0.2')])
+        self.assertEqual(self.index.query("SELECT id, name FROM plugins ORDER BY id"),
+                         [(100, 'Plugin 100'), (101, 'Plugin 101')])
+
+    def test_ingest_skips_known_uuid(self):
+        self.assertEqual(self.index.ingest(report({'10.0.0.1': [(80, 100, 2)]}), 'uuid-1'), 1)
+        self.assertEqual(self.index.ingest(report({'10.0.0.1': [(80, 100, 2), (22, 102, 1)]}), 'uuid-1'), 0)
+        self.assertEqual(self.index.query("SELECT COUNT(*) FROM items"), [(1, )])
+        self.assertEqual(self.index.query("SELECT COUNT(*) FROM reports"), [(1, )])
+
+    def test_bad_report_is_rolled_back(self):
+        bad = StringIO('<NessusClientData_v2><Report name="r"><ReportHost name="h">'
+                       '<ReportItem port="x" pluginID="1" severity="1"/></ReportHost></Report></NessusClientData_v2>')
+        self.assertRaises(ValueError, self.index.ingest, bad, 'uuid-1')
+        self.assertFalse(self.index.ingested('uuid-1'))
+        self.assertEqual(self.index.query("SELECT COUNT(*) FROM hosts"), [(0, )])
+        # The uuid can be ingested once the report is fixed
+        self.assertEqual(self.index.ingest(report({'h': [(80, 1, 1)]}), 'uuid-1'), 1)
+
+    def test_hosts_with_plugin(self):
+        self.index.ingest(report({'10.0.0.1': [(80, 100, 2)], '10.0.0.2': [(22, 100, 3)]}), 'uuid-1')
+        self.index.ingest(report({'10.0.0.2': [(22, 100, 3)]}), 'uuid-2')
+        self.assertEqual(self.index.hosts_with_plugin(100), [('10.0.0.2', 22, 3, 'weekly')])
+        self.assertEqual(self.index.hosts_with_plugin(100, latest=False),
+                         [('10.0.0.1', 80, 2, 'weekly'), ('10.0.0.2', 22, 3, 'weekly')])
+
+    def test_severity_history(self):
+        self.index.ingest(report({'10.0.0.1': [(80, 100, 2), (443, 101, 4)]}), 'uuid-1')
+        self.index.ingest(report({'10.0.0.1': [(80, 100, 2)]}), 'uuid-2')
+        self.index.ingest(report({'10.0.0.1': []}), 'uuid-3')
+        self.index.ingest(report({'10.0.0.9': [(80, 100, 1)]}, name='daily'), 'uuid-4')
+        self.assertEqual([counts for ingested, counts in self.index.severity_history('weekly')],
+                         [{2: 1, 4: 1}, {2: 1}, {}])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vim: expandtab sw=4 ts=4 ai
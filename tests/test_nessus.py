@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Pieces of the nessus.py scan runner that do not need a server.
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from nessus import ScannerNode
+
+
+class ScannerNodeTest(unittest.TestCase):
+    def node(self):
+        return ScannerNode('nessus01', 'localhost', 8834, 'nessus', 'nessus', 3)
+
+    def test_changes(self):
+        node = self.node()
+        self.assertEqual(node.changes([{'name': 'a', 'status': 'running'}]), [('a', 'running')])
+        self.assertEqual(node.changes([{'name': 'a', 'status': 'running'}, {'name': 'b', 'status': 'running'}]),
+                         [('b', 'running')])
+        self.assertEqual(node.changes([{'name': 'a', 'status': 'completed'}]), [('a', 'completed')])
+
+    def test_malformed_reply_leaves_the_index_alone(self):
+        node = self.node()
+        node.changes([{'name': 'a', 'status': 'running'}])
+        self.assertRaises(KeyError, node.changes, [{'name': 'a', 'status': 'completed'}, {'name': 'b'}])
+        # The completion is still news on the next poll
+        self.assertEqual(node.changes([{'name': 'a', 'status': 'completed'}]), [('a', 'completed')])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vim: expandtab sw=4 ts=4 ai
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+The staged Pipeline used to report on completed scans.
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from Pipeline import Pipeline, Stage
+
+
+class PipelineTest(unittest.TestCase):
+    def test_results(self):
+        pipeline = Pipeline([Stage('double', lambda n: n * 2, 3), Stage('add', lambda n: n + 1, 2)])
+        self.assertEqual(sorted(pipeline.run(range(10))), [n * 2 + 1 for n in range(10)])
+        self.assertEqual(pipeline.failed, [])
+
+    def test_failed_items_are_set_aside(self):
+        def odd(n):
+            if n % 2:
+                raise ValueError(n)
+            return n
+
+        def big(n):
+            if n > 5:
+                raise ValueError(n)
+            return n
+        pipeline = Pipeline([Stage('odd', odd, 2), Stage('big', big, 2)])
+        self.assertEqual(sorted(pipeline.run(range(10))), [0, 2, 4])
+        self.assertEqual(sorted(pipeline.failed), [('big', 6), ('big', 8), ('odd', 1), ('odd', 3), ('odd', 5),
+                                                   ('odd', 7), ('odd', 9)])
+        self.assertEqual([timing['errors'] for name, timing in pipeline.timings()], [5, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vim: expandtab sw=4 ts=4 ai
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Planning scans: taking targets apart, splitting and coalescing them, and merging the reports of the parts.
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import xml.etree.ElementTree
+
+sys.path[:0] = [os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir),
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'bench')]
+
+from fakenessus import nessus_report
+from Planner import TargetPlanner, parse_target, count_hosts, format_target, split_target, merge_reports
+
+
+class TargetTest(unittest.TestCase):
+    def test_parse_target(self):
+        items = parse_target("10.0.0.0/24, 10.0.1.1-10.0.1.10;10.0.2.1-5 host.example 10.0.3.7 10.0.0.0/33")
+        self.assertEqual(count_hosts(items), 256 + 10 + 5 + 1 + 1 + 1)
+        self.assertEqual(format_target(items),
+                         "10.0.0.0/24,10.0.1.1-10.0.1.10,10.0.2.1-10.0.2.5,host.example,10.0.3.7,10.0.0.0/33")
+
+    def test_unaligned_block(self):
+        self.assertEqual(format_target(parse_target("10.0.0.77/24")), "10.0.0.0/24")
+
+    def test_split_aligned(self):
+        chunks = split_target(parse_target("10.0.0.0/22"), 4)
+        self.assertEqual([count_hosts(chunk) for chunk in chunks], [256] * 4)
+        self.assertEqual([format_target(chunk) for chunk in chunks],
+                         ["10.0.0.0/24", "10.0.1.0/24", "10.0.2.0/24", "10.0.3.0/24"])
+
+    def test_split_balanced(self):
+        items = parse_target("10.0.0.0/22,host1,host2")
+        chunks = split_target(items, 3)
+        self.assertEqual([count_hosts(chunk) for chunk in chunks], [342, 342, 342])
+        # Nothing is lost or covered twice
+        self.assertEqual(sum(count_hosts(chunk) for chunk in chunks), count_hosts(items))
+        self.assertEqual(format_target(chunks[-1]), "10.0.2.172-10.0.3.255,host1,host2")
+
+    def test_split_uneven(self):
+        chunks = split_target(parse_target("10.0.0.1-10.0.0.10"), 3)
+        self.assertEqual([count_hosts(chunk) for chunk in chunks], [4, 3, 3])
+        self.assertEqual([format_target(chunk) for chunk in chunks],
+                         ["10.0.0.1-10.0.0.4", "10.0.0.5-10.0.0.7", "10.0.0.8-10.0.0.10"])
+
+
+class TargetPlannerTest(unittest.TestCase):
+    def test_chunk(self):
+        scan = {'name': 'big', 'target': '10.0.0.0/23', 'policy': 'Full Scan', 'priority': 5}
+        parts = list(TargetPlanner(chunk=200).plan([scan]))
+        self.assertEqual([part['name'] for part in parts], ['big (1/3)', 'big (2/3)', 'big (3/3)'])
+        self.assertEqual(sum(count_hosts(parse_target(part['target'])) for part in parts), 512)
+        self.assertTrue(all(part['logical'] is scan and part['parts'] == 3 and part['priority'] == 5
+                            for part in parts))
+        self.assertEqual(len(set(part['group'] for part in parts)), 1)
+
+    def test_coalesce(self):
+        scans = [{'name': 'a', 'target': '10.0.0.1', 'policy': 'Full Scan', 'priority': 1},
+                 {'name': 'b', 'target': '10.0.0.2,10.0.0.3', 'policy': 'Full Scan', 'deadline': 100},
+                 {'name': 'c', 'target': '10.0.0.4', 'policy': 'Quick Scan'},
+                 {'name': 'd', 'target': '10.0.0.5', 'policy': 'Full Scan', 'priority': 3, 'deadline': 50},
+                 {'name': 'e', 'target': '10.0.1.0/24', 'policy': 'Full Scan'}]
+        planned = dict((scan['name'], scan) for scan in TargetPlanner(coalesce=4).plan(scans))
+        self.assertEqual(sorted(planned), ['a (+2 more)', 'c', 'e'])
+        merged = planned['a (+2 more)']
+        self.assertEqual(merged['members'], ['a', 'b', 'd'])
+        self.assertEqual(merged['target'], '10.0.0.1,10.0.0.2,10.0.0.3,10.0.0.5')
+        self.assertEqual((merged['priority'], merged['deadline']), (3, 50))
+
+    def test_unplanned(self):
+        scans = [{'name': 'a', 'target': '10.0.0.0/24', 'policy': 'Full Scan'}]
+        self.assertEqual(list(TargetPlanner().plan(scans)), scans)
+
+
+class MergeReportsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_merge(self):
+        sources = []
+        for number, hosts in enumerate((3, 2, 4)):
+            path = os.path.join(self.directory, 'part%d.xml' % number)
+            with open(path, 'w') as f:
+                f.write(nessus_report(hosts, 5, seed=number))
+            sources.append(path)
+        output = os.path.join(self.directory, 'merged.xml')
+        merge_reports(sources, output, 'weekly', '10.0.0.0/24')
+
+        root = xml.etree.ElementTree.parse(output).getroot()
+        self.assertEqual(len(root.findall('Policy')), 1)
+        self.assertEqual(root.find('Policy').find('.//preference/value').text, '10.0.0.0/24')
+        reports = root.findall('Report')
+        self.assertEqual(len(reports), 1)
+        self.assertEqual(reports[0].get('name'), 'weekly')
+        self.assertEqual(len(reports[0].findall('ReportHost')), 9)
+        self.assertEqual(len(reports[0].findall('ReportHost/ReportItem')), 45)
+
+    def test_merge_without_hosts(self):
+        output = os.path.join(self.directory, 'merged.xml')
+        merge_reports([], output, 'empty')
+        root = xml.etree.ElementTree.parse(output).getroot()
+        self.assertEqual(root.find('Report').findall('ReportHost'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vim: expandtab sw=4 ts=4 ai
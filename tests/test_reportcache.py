@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+The on-disk cache of downloaded reports.
+
+    python -m unittest discover tests
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import ReportCache
+
+
+class ReportCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        # A clock that moves on by one second on every reading, so entries are never used at the same time
+        self.clock = [1000.0]
+        self.time = ReportCache.time
+        ReportCache.time = self.tick
+        self.cache = ReportCache.ReportCache(os.path.join(self.dir, 'cache'))
+
+    def tearDown(self):
+        ReportCache.time = self.time
+        shutil.rmtree(self.dir)
+
+    def tick(self):
+        self.clock[0] += 1
+        return self.clock[0]
+
+    def write(self, uuid, content):
+        writer = self.cache.writer(uuid)
+        writer.write(content)
+        writer.close()
+
+    def read(self, uuid):
+        output = StringIO()
+        if self.cache.extract(uuid, output) is None:
+            return None
+        return output.getvalue()
+
+    def test_store_and_extract(self):
+        path = os.path.join(self.dir, 'report.nessus')
+        with open(path, 'wb') as f:
+            f.write('<NessusClientData_v2/>' * 1000)
+        self.assertEqual(self.cache.store('uuid-1', path), 22000)
+        self.assertTrue(self.cache.has('uuid-1'))
+        self.assertFalse(self.cache.has('uuid-2'))
+        self.assertEqual(self.read('uuid-1'), '<NessusClientData_v2/>' * 1000)
+        self.assertEqual(self.read('uuid-2'), None)
+        stats = self.cache.stats()
+        self.assertEqual((stats['reports'], stats['entries'], stats['hits'], stats['misses']), (1, 1, 1, 1))
+        self.assertTrue(0 < stats['bytes'] < 22000)
+
+    def test_same_content_stored_once(self):
+        self.write('uuid-1', 'report')
+        self.write('uuid-2', 'report')
+        self.assertEqual(self.read('uuid-2'), 'report')
+        stats = self.cache.stats()
+        self.assertEqual((stats['reports'], stats['entries']), (2, 1))
+        self.assertEqual(len([name for name in os.listdir(self.cache.directory) if name.endswith('.xml.gz')]), 1)
+
+    def test_abort(self):
+        writer = self.cache.writer('uuid-1')
+        writer.write('half a rep')
+        writer.abort()
+        self.assertFalse(self.cache.has('uuid-1'))
+        self.assertEqual(os.listdir(self.cache.directory), [])
+
+    def test_eviction_order(self):
+        for uuid in ('a', 'b', 'c'):
+            self.write(uuid, os.urandom(4096))
+        # Room for three entries; using 'a' leaves 'b' the least recently used
+        self.cache.maxsize = self.cache.stats()['bytes']
+        self.assertEqual(len(self.read('a')), 4096)
+        self.write('d', os.urandom(4096))
+        self.assertEqual([self.cache.has(uuid) for uuid in ('a', 'b', 'c', 'd')], [True, False, True, True])
+        self.write('e', os.urandom(4096))
+        self.assertEqual([self.cache.has(uuid) for uuid in ('a', 'b', 'c', 'd', 'e')],
+                         [True, False, False, True, True])
+        self.assertEqual(self.cache.stats()['entries'], 3)
+
+    def test_newest_entry_is_kept(self):
+        self.cache.maxsize = 1
+        self.write('a', os.urandom(4096))
+        self.write('b', os.urandom(4096))
+        self.assertEqual([self.cache.has(uuid) for uuid in ('a', 'b')], [False, True])
+
+    def test_index_is_reloaded(self):
+        self.write('a', 'first')
+        self.write('b', 'second')
+        self.read('a')
+        self.cache.close()
+        cache = ReportCache.ReportCache(self.cache.directory)
+        self.assertEqual(cache.entries, self.cache.entries)
+        self.assertEqual(cache.reports, self.cache.reports)
+        self.assertTrue(cache.has('b'))
+
+    def test_unreadable_index(self):
+        with open(self.cache.indexfile, 'w') as f:
+            f.write('{not json')
+        cache = ReportCache.ReportCache(self.cache.directory)
+        self.assertEqual((cache.reports, cache.entries), ({}, {}))
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: expandtab sw=4 ts=4 ai
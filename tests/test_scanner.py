@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+The blocking Scanner against the local fake Nessus server in bench/fakenessus.py.
+
+    python -m unittest discover tests
+"""
+import os
+import ssl
+import sys
+import shutil
+import tempfile
+import unittest
+import zipfile
+import zlib
+
+sys.path[:0] = [os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir),
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'bench')]
+
+from fakenessus import FakeNessus
+from Archive import ZipMember
+from NessusXMLRPC import Scanner, PolicyIndex, PolicyError, ResponseCache, RetryPolicy, CircuitBreaker, \
+    LoginError, CLOSED
+
+
+class ScannerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.context = ssl._create_default_https_context
+        ssl._create_default_https_context = ssl._create_unverified_context
+        cls.server = FakeNessus(duration=0.0, hosts=50, items=10).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        ssl._create_default_https_context = cls.context
+
+    def setUp(self):
+        server = self.server
+        server.latency = 0.0
+        server.drop = 0.0
+        server.outage = 0
+        server.policies = ['Full Scan', 'Quick Scan']
+        server.gzip = False
+        server.password = 'nessus'
+
+    def scanner(self, **kwargs):
+        return Scanner('127.0.0.1', self.server.port, 'nessus', 'nessus', **kwargs)
+
+    def test_policy_index_without_ttl(self):
+        index = PolicyIndex(0)
+        ids = index.update([{'policyName': 'A', 'policyID': '1'}])
+        self.assertEqual(ids, {'A': '1'})
+        self.assertEqual(index.get('A'), None)
+
+    def test_quick_scan_without_policy_ttl(self):
+        scanner = self.scanner(policy_ttl=0)
+        listed = self.server.calls.get('/policy/list', 0)
+        self.assertEqual(scanner.quickScan('weekly', '10.0.0.1', 'Quick Scan')['scan_name'], 'weekly')
+        scanner.quickScan('daily', '10.0.0.1', 'Quick Scan')
+        self.assertEqual(self.server.calls['/policy/list'], listed + 2)
+
+    def test_quick_scan_indexes_policies(self):
+        scanner = self.scanner()
+        scanner.quickScan('weekly', '10.0.0.1', 'Quick Scan')
+        listed = self.server.calls['/policy/list']
+        scanner.quickScan('daily', '10.0.0.1', 'Quick Scan')
+        self.assertEqual(self.server.calls['/policy/list'], listed)
+
+    def test_unknown_policy(self):
+        self.assertRaises(PolicyError, self.scanner().quickScan, 'weekly', '10.0.0.1', 'No Such Policy')
+
+    def test_recreated_policy(self):
+        scanner = self.scanner()
+        scanner.quickScan('weekly', '10.0.0.1', 'Quick Scan')
+        # Quick Scan is recreated under another ID; the indexed one is now refused
+        self.server.policies = ['Quick Scan']
+        self.assertEqual(scanner.quickScan('daily', '10.0.0.1', 'Quick Scan')['scan_name'], 'daily')
+        self.assertEqual(scanner.policies.get('Quick Scan'), '1')
+
+    def test_recreated_policy_with_cached_list(self):
+        scanner = self.scanner(cache=ResponseCache())
+        scanner.quickScan('weekly', '10.0.0.1', 'Quick Scan')
+        self.server.policies = ['Quick Scan']
+        listed = self.server.calls['/policy/list']
+        self.assertEqual(scanner.quickScan('daily', '10.0.0.1', 'Quick Scan')['scan_name'], 'daily')
+        self.assertEqual(self.server.calls['/policy/list'], listed + 1)
+        self.assertEqual(scanner.policies.get('Quick Scan'), '1')
+
+    def test_deleted_policy(self):
+        scanner = self.scanner()
+        scanner.quickScan('weekly', '10.0.0.1', 'Quick Scan')
+        self.server.policies = ['Full Scan']
+        scans = self.server.calls['/scan/new']
+        self.assertRaises(PolicyError, scanner.quickScan, 'daily', '10.0.0.1', 'Quick Scan')
+        self.assertEqual(self.server.calls['/scan/new'], scans + 1)
+
+    def test_download_into_zip_member(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'report.zip')
+        self.server.gzip = True
+        archive = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+        member = ZipMember(archive, 'report.xml')
+        written = self.scanner().reportDownloadTo('report', member)
+        member.close()
+        archive.close()
+        self.assertEqual(written, len(self.server.report))
+        self.assertEqual(zipfile.ZipFile(path).read('report.xml'), self.server.report)
+
+    def download(self, retries):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'report.xml')
+        scanner = self.scanner(retry=RetryPolicy(backoff=0))
+        result = scanner.reportDownloadMany(['report'], lambda uuid: path, retries=retries)['report']
+        return result, open(path, 'rb').read()
+
+    def test_download_is_retried_once_per_attempt(self):
+        self.server.drop = 1.0
+        self.server.gzip = True
+        downloads = self.server.calls.get('/file/report/download', 0)
+        result, body = self.download(2)
+        self.assertTrue(result['error'] is not None)
+        self.assertEqual(result['attempts'], 3)
+        self.assertEqual(self.server.calls['/file/report/download'], downloads + 3)
+
+    def test_short_download_is_resumed(self):
+        self.server.drop = 0.5
+        self.server.gzip = True
+        result, body = self.download(50)
+        self.assertEqual(result['error'], None)
+        self.assertEqual(body, self.server.report)
+
+    def test_download_error_is_reported_per_report(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        scanner = self.scanner(retry=RetryPolicy(backoff=0))
+        # The session expires and logging in again fails: not a transport error, so not retried
+        self.server.tokens.clear()
+        self.server.password = 'changed'
+        results = scanner.reportDownloadMany(['a', 'b'], lambda uuid: os.path.join(directory, uuid), retries=2)
+        self.assertEqual(sorted(results), ['a', 'b'])
+        for result in results.values():
+            self.assertTrue(isinstance(result['error'], LoginError))
+            self.assertEqual(result['attempts'], 1)
+
+    def test_failed_logins_leave_no_listeners(self):
+        breaker = CircuitBreaker()
+        self.server.password = 'changed'
+        for i in range(3):
+            self.assertRaises(LoginError, self.scanner, breaker=breaker)
+        self.assertEqual(breaker.listeners, [])
+        self.server.password = 'nessus'
+        scanner = self.scanner(breaker=breaker)
+        self.assertEqual(breaker.listeners, [scanner._circuitchanged])
+
+    def test_unexpected_error_settles_the_probe(self):
+        breaker = CircuitBreaker(failures=1, cooldown=0)
+        scanner = self.scanner(breaker=breaker)
+        breaker.failure()
+
+        def corrupt(*args):
+            raise zlib.error("Error -3 while decompressing data: invalid stored block lengths")
+        scanner._exchange = corrupt
+        self.assertRaises(zlib.error, scanner.policyList)
+        self.assertFalse(breaker.probing)
+        del scanner._exchange
+        self.assertEqual(len(scanner.policyList()), 2)
+        self.assertEqual(breaker.state, CLOSED)
+
+    def test_interrupt_settles_the_probe(self):
+        breaker = CircuitBreaker(failures=1, cooldown=0)
+        scanner = self.scanner(breaker=breaker)
+        breaker.failure()
+
+        def interrupted(*args):
+            raise KeyboardInterrupt()
+        scanner._exchange = interrupted
+        self.assertRaises(KeyboardInterrupt, scanner.policyList)
+        self.assertFalse(breaker.probing)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vim: expandtab sw=4 ts=4 ai
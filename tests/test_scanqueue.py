@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Reading the input file and the identity each scan gets in the journal.
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from Journal import scan_key
+from Planner import TargetPlanner
+from ScanQueue import read_scans
+
+
+class ReadScansTest(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp()
+        os.write(handle, "# weekly\nweekly,10.0.0.0/24,Full Scan\n\nweekly,10.0.0.0/24,Full Scan\n")
+        os.close(handle)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_lines(self):
+        self.assertEqual([scan['line'] for scan in read_scans(self.path)], [2, 4])
+
+    def test_repeated_lines_are_separate_scans(self):
+        keys = [scan_key(scan) for scan in read_scans(self.path)]
+        self.assertEqual(len(set(keys)), 2)
+
+    def test_repeated_lines_split_into_separate_parts(self):
+        parts = list(TargetPlanner(chunk=128).plan(read_scans(self.path)))
+        self.assertEqual(len(parts), 4)
+        self.assertEqual(len(set(scan_key(part) for part in parts)), 4)
+        self.assertEqual(len(set(part['group'] for part in parts)), 2)
+
+    def test_key_without_line(self):
+        self.assertEqual(scan_key({'name': 'weekly', 'target': '10.0.0.1', 'policy': 'Full Scan'}),
+                         'weekly|10.0.0.1|Full Scan')
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vim: expandtab sw=4 ts=4 ai
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+What a TraceRing dump writes out, and what it must not.
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from Trace import Exchange
+
+
+class ExchangeTest(unittest.TestCase):
+    def login(self, body):
+        exchange = Exchange('POST', '/login', 'login=nessus&password=secret&seq=1')
+        exchange.elapsed = 0.1
+        exchange.status = 200
+        exchange.reason = 'OK'
+        exchange.headers = [('content-type', 'text/xml'), ('set-cookie', 'token=0123456789abcdef')]
+        exchange.body = body
+        exchange.size = 200
+        return exchange.format()
+
+    def test_secrets_are_masked(self):
+        dump = self.login('<reply><contents><token>0123456789abcdef</token><user>nessus</user></contents></reply>')
+        self.assertFalse('secret' in dump)
+        self.assertFalse('0123456789abcdef' in dump)
+        self.assertTrue('password=***' in dump)
+        self.assertTrue('<token>***</token><user>nessus</user>' in dump)
+        self.assertTrue('more bytes' in dump)
+
+    def test_token_cut_short_is_masked(self):
+        dump = self.login('<reply><contents><token>01234567')
+        self.assertFalse('01234567' in dump)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vim: expandtab sw=4 ts=4 ai